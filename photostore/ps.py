@@ -2,15 +2,23 @@ import argparse
 import logging
 import os
 from pathlib import Path
-from store import files, directories, process
+from store import files, directories, metrics, perceptual, plan, process, shards, verify
 
 
 # Main photo processing function
 def store(args):
     logger.debug('Calling process')
 
+    # Apply a plan made earlier, everything about the source was worked out when it was made
+    if args.execute is not None:
+        if not os.path.exists(args.destination):
+            logger.error('Destination directory does not exist')
+            exit(1)
+        plan.execute(args.execute, args.destination, resume=args.resume, dup_mode=args.dup_mode)
+        return
+
     # Check that the source is good
-    if not os.path.exists(args.source):
+    if args.source is None or not os.path.exists(args.source):
         logger.error('Source directory does not exist')
         exit(1)
 
@@ -20,12 +28,38 @@ def store(args):
         exit(1)
 
     # Check that the exiftool exists
-    if not os.path.exists(args.exiftool):
+    if args.exiftool is None or not os.path.exists(args.exiftool):
         logger.error('Exiftool does not exist')
         exit(1)
 
-    # Don't create directories if it's a dry run
-    if not args.dryrun:
+    # Shards are for several workers storing one pass over the source
+    if args.shards and (args.dryrun or args.plan is not None or args.watch):
+        logger.error('Shards cannot be used with a dry run, a plan or watch mode')
+        exit(1)
+
+    # The shards are coordinated through files in the destination, which is only reliable with every worker on one
+    # host. A destination on a network filesystem could be shared with other hosts
+    if args.shards:
+        filesystem = shards.filesystem_type(args.destination)
+        if filesystem in shards.NETWORK_FILESYSTEMS:
+            logger.error('Shards must all run on one host, the destination is on a {} filesystem'.format(filesystem))
+            exit(1)
+        if filesystem is None:
+            logger.warning('Unable to tell whether the destination is on a network filesystem, shards must all run '
+                           'on one host')
+
+    # Near duplicate checking needs the optional image packages
+    if args.near_dup != 'off' and not perceptual.available():
+        logger.error('Near duplicate checking needs numpy and Pillow')
+        exit(1)
+
+    # A plan is a record of one pass over the source
+    if args.watch and args.plan is not None:
+        logger.error('A plan cannot be made in watch mode')
+        exit(1)
+
+    # Don't create directories if it's a dry run or only a plan
+    if not args.dryrun and args.plan is None:
         Path(args.destination).mkdir(parents=True, exist_ok=True)
         dup_path = os.path.join(args.destination, 'Dup')
         bad_path = os.path.join(args.destination, 'Bad')
@@ -33,7 +67,25 @@ def store(args):
         Path(bad_path).mkdir(parents=True, exist_ok=True)
 
     # Process files
-    process.processing(args.source, args.destination, args.dryrun, args.exiftool)
+    workers = {stage: getattr(args, '{}_workers'.format(stage)) for stage in process.DEFAULT_WORKERS}
+    # With shards each worker stores the shards it can lease, a shard taken over from a worker that died is resumed
+    coordinator = None
+    if args.shards:
+        coordinator = shards.Coordinator(args.destination, args.source, args.shards, args.lease).start()
+        hosts = coordinator.other_hosts()
+        if hosts:
+            coordinator.close()
+            logger.error('Shards must all run on one host, workers are running on {}'.format(', '.join(sorted(hosts))))
+            exit(1)
+    try:
+        process.processing(args.source, args.destination, args.dryrun, args.exiftool, batch_size=args.batch,
+                           workers=workers, queue_size=args.queue, jobs=args.jobs, native=not args.exiftool_only,
+                           resume=args.resume, plan_file=args.plan, dup_mode=args.dup_mode, watch_source=args.watch,
+                           settle=args.settle, poll=args.poll, near_dup=args.near_dup,
+                           near_distance=args.near_distance, coordinator=coordinator)
+    finally:
+        if coordinator is not None:
+            coordinator.close()
 
     return
 
@@ -48,7 +100,10 @@ def file(args):
         exit(1)
 
     # Perform checksums
-    files.checksums(args.destination)
+    if args.phash and not perceptual.available():
+        logger.error('Perceptual hashes need numpy and Pillow')
+        exit(1)
+    files.checksums(args.destination, args.full, args.jobs, args.pool == 'process', args.phash)
     return
 
 
@@ -61,8 +116,30 @@ def directory(args):
         logger.error('Directory does not exist')
         exit(1)
 
+    # Archives are encrypted with a password from the command line or the environment
+    password = args.password or os.environ.get('PHOTOSTORE_ZIP_PASSWORD')
+    if args.compress and not password:
+        logger.error('Archive password not set, use --password or PHOTOSTORE_ZIP_PASSWORD')
+        exit(1)
+
     # Perform directory checksums and compress (if requested)
-    directories.checksums(args.destination, args.compress)
+    if directories.checksums(args.destination, args.compress, password, args.jobs):
+        exit(1)
+    return
+
+
+# Verify functions
+def verify_library(args):
+    logger.debug('Calling verify')
+
+    # Confirm the destination is good
+    if not os.path.exists(args.destination):
+        logger.error('Directory does not exist')
+        exit(1)
+
+    # Rehash the library, failing if anything doesn't match the catalog
+    if verify.verify(args.destination, args.rate, args.time_limit, args.restart):
+        exit(1)
     return
 
 
@@ -77,29 +154,115 @@ def main():
     parser.set_defaults(func=default)
     sub_parser = parser.add_subparsers()
 
+    # Options shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--profile', required=False, action='store_true',
+                        help='Record counts, bytes and timings for each operation and print a summary at the end')
+    common.add_argument('--metrics-file', required=False, type=str,
+                        help='Write the metrics to this file, as JSON if it ends in .json otherwise Prometheus text')
+    common.add_argument('--log-level', required=False, choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='DEBUG',
+                        help='Only log messages at this level or above')
+
     # Configure separate subparsers for the individual functions
-    parser_process = sub_parser.add_parser('store', help='Sort image files')
-    parser_process.add_argument('-s', '--source', required=True, type=str, help='Source directory')
+    parser_process = sub_parser.add_parser('store', parents=[common], help='Sort image files')
+    parser_process.add_argument('-s', '--source', required=False, type=str,
+                                help='Source directory (not needed with --execute)')
     parser_process.add_argument('-d', '--destination', required=True, type=str, help='Destination directory')
     parser_process.add_argument('-e', '--exiftool', required=False, type=str, help='Location of exiftool executable')
     parser_process.add_argument('-t', '--dryrun', required=False, action='store_true',
                                 help='Run without copying any files')
+    parser_process.add_argument('-b', '--batch', required=False, type=int, default=100,
+                                help='Number of files sent to exiftool at a time')
+    parser_process.add_argument('-q', '--queue', required=False, type=int, default=100,
+                                help='Number of files held between each processing stage')
+    for stage, workers in process.DEFAULT_WORKERS.items():
+        parser_process.add_argument('--{}-workers'.format(stage), required=False, type=int, default=workers,
+                                    help='Number of workers for the {} stage'.format(stage))
+    parser_process.add_argument('-j', '--jobs', required=False, type=int,
+                                help='Hash files on a pool of this many processes')
+    parser_process.add_argument('--exiftool-only', required=False, action='store_true',
+                                help='Always use exiftool, rather than reading dates directly from JPEG/HEIC/MOV')
+    parser_process.add_argument('-r', '--resume', required=False, action='store_true',
+                                help='Skip the files finished by an interrupted run, rather than starting over')
+    parser_process.add_argument('--plan', required=False, type=str,
+                                help='Write the decisions for every file to this plan rather than copying anything. '
+                                     'Plans leave out moving a smaller near duplicate to Review')
+    parser_process.add_argument('--execute', required=False, type=str,
+                                help='Copy the files in a plan written by --plan')
+    parser_process.add_argument('--dup-mode', required=False, choices=process.DUP_MODES, default='link',
+                                help='Store duplicates as links to the library copy, as copies or only in the catalog')
+    parser_process.add_argument('-w', '--watch', required=False, action='store_true',
+                                help='Keep running, storing new files as they arrive in the source')
+    parser_process.add_argument('--settle', required=False, type=float, default=2.0,
+                                help='Seconds a file must go unchanged before it is stored in watch mode')
+    parser_process.add_argument('--poll', required=False, type=float,
+                                help='Scan the source every this many seconds in watch mode, rather than using inotify')
+    parser_process.add_argument('--near-dup', required=False, choices=perceptual.NEAR_DUP_MODES, default='off',
+                                help='Log new photos that look like a stored photo, or store them in Review. Of two '
+                                     'new photos alike the larger image is kept in the library')
+    parser_process.add_argument('--near-distance', required=False, type=int, default=perceptual.DEFAULT_DISTANCE,
+                                help='Most bits the perceptual hashes of near duplicates can differ by (out of 64)')
+    parser_process.add_argument('--shards', required=False, type=int,
+                                help='Split the source into this many shards, shared with other store processes '
+                                     'on this host using the same source, destination and number of shards')
+    parser_process.add_argument('--lease', required=False, type=float, default=shards.LEASE_SECONDS,
+                                help='Seconds before the shard of a worker that has stopped responding is taken over')
     parser_process.set_defaults(func=store)
 
-    parser_file = sub_parser.add_parser('file', help='Build file checksums')
+    parser_file = sub_parser.add_parser('file', parents=[common], help='Build file checksums')
     parser_file.add_argument('-d', '--destination', required=True, type=str,
                              help='Destination directory to process')
+    parser_file.add_argument('-f', '--full', required=False, action='store_true',
+                             help='Rehash every file, even if it is unchanged')
+    parser_file.add_argument('-j', '--jobs', required=False, type=int,
+                             help='Number of files to hash at once (defaults to the number of CPUs)')
+    parser_file.add_argument('-p', '--pool', required=False, choices=['process', 'thread'], default='process',
+                             help='Hash files on a pool of processes or threads')
+    parser_file.add_argument('--phash', required=False, action='store_true',
+                             help='Work out perceptual hashes for the files that have none, for --near-dup')
     parser_file.set_defaults(func=file)
 
-    parser_directory = sub_parser.add_parser('directory', help='Directory processing')
+    parser_directory = sub_parser.add_parser('directory', parents=[common], help='Directory processing')
     parser_directory.add_argument('-d', '--destination', required=True, type=str,
                                   help='Destination directory to process')
     parser_directory.add_argument('-c', '--compress', required=False, action='store_true',
                                   help='Compress directories where the hashes do not match')
+    parser_directory.add_argument('--password', required=False, type=str,
+                                  help='Archive password (defaults to PHOTOSTORE_ZIP_PASSWORD from the environment)')
+    parser_directory.add_argument('-j', '--jobs', required=False, type=int,
+                                  help='Number of directories to compress at once (defaults to the number of CPUs)')
     parser_directory.set_defaults(func=directory)
 
+    parser_verify = sub_parser.add_parser('verify', parents=[common], help='Check the library against the catalog')
+    parser_verify.add_argument('-d', '--destination', required=True, type=str,
+                               help='Destination directory to verify')
+    parser_verify.add_argument('--rate', required=False, type=float,
+                               help='Read at most this many MB a second')
+    parser_verify.add_argument('--time-limit', required=False, type=float,
+                               help='Stop after this many seconds, the next run carries on from there')
+    parser_verify.add_argument('--restart', required=False, action='store_true',
+                               help='Start a new pass rather than carrying on from the last run')
+    parser_verify.set_defaults(func=verify_library)
+
     args = parser.parse_args()
+    if args.func is not default:
+        set_log_level(args.log_level)
+        if args.profile or args.metrics_file:
+            metrics.registry.enable()
     args.func(args)
+    if args.func is not default:
+        if args.profile:
+            print(metrics.registry.summary())
+        if args.metrics_file:
+            metrics.registry.write(args.metrics_file)
+    return
+
+
+# Set the level of this module's logger and every store module's logger
+def set_log_level(level):
+    for name in list(logging.root.manager.loggerDict):
+        if name == __name__ or name.startswith('store'):
+            logging.getLogger(name).setLevel(level)
     return
 
 
@@ -0,0 +1,309 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Schema changes, applied in order and tracked with the database user_version
+MIGRATIONS = [
+    '''CREATE TABLE files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, size INTEGER, mtime_ns INTEGER,
+                           sha256 TEXT, directory_date TEXT, exif_tag TEXT);
+       CREATE INDEX files_sha256 ON files (sha256);
+       CREATE INDEX files_directory ON files (directory);
+       CREATE TABLE directories (path TEXT PRIMARY KEY, hash TEXT);
+       CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);''',
+    '''ALTER TABLE files ADD COLUMN inode INTEGER;''',
+    '''ALTER TABLE files ADD COLUMN fingerprint TEXT;
+       CREATE INDEX files_size ON files (size);''',
+    '''CREATE TABLE duplicates (source TEXT PRIMARY KEY, size INTEGER, sha256 TEXT, original TEXT, path TEXT,
+                                status TEXT);
+       CREATE INDEX duplicates_sha256 ON duplicates (sha256);''',
+    '''CREATE TABLE archive_members (archive TEXT NOT NULL, name TEXT NOT NULL, sha256 TEXT,
+                                     PRIMARY KEY (archive, name));''',
+    '''ALTER TABLE files ADD COLUMN phash TEXT;''',
+]
+
+# Pending writes are committed together once there are this many
+BATCH_SIZE = 500
+
+
+# Catalog of every file and directory in the destination library, paths are stored relative to the destination
+class Catalog:
+    def __init__(self, destination, create=True):
+        self.destination = destination
+        self.catalog_file = os.path.join(destination, 'catalog.db')
+        self.lock = threading.RLock()
+        self.pending = []
+        # Set when the files have changed, so the hash snapshot made from them is out of date
+        self.files_changed = False
+
+        # Without create a missing catalog is held in memory, so a dry run doesn't write to the destination
+        if create or os.path.isfile(self.catalog_file):
+            self.connection = sqlite3.connect(self.catalog_file, timeout=60, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        else:
+            self.connection = sqlite3.connect(':memory:', check_same_thread=False)
+        self.migrate()
+        self.import_pickles()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Bring the schema up to date
+    def migrate(self):
+        with self.lock:
+            while True:
+                # The write lock is taken before the version is read, so processes opening a new catalog at the same
+                # time can't both apply a migration
+                self.connection.execute('BEGIN IMMEDIATE')
+                try:
+                    version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+                    if version >= len(MIGRATIONS):
+                        self.connection.execute('COMMIT')
+                        return
+                    logger.debug('Applying catalog migration {}'.format(version + 1))
+                    for statement in MIGRATIONS[version].split(';'):
+                        if statement.strip():
+                            self.connection.execute(statement)
+                    self.connection.execute('PRAGMA user_version = {}'.format(version + 1))
+                    self.connection.execute('COMMIT')
+                except BaseException:
+                    self.connection.execute('ROLLBACK')
+                    raise
+
+    # Commit any pending writes and close the database
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.connection.close()
+        return
+
+    # Convert between absolute paths and the relative paths stored in the catalog
+    def relative(self, path):
+        return os.path.relpath(path, self.destination)
+
+    def absolute(self, path):
+        return os.path.join(self.destination, path)
+
+    # Queue up a write, committing the batch once it's big enough
+    def write(self, sql, parameters):
+        with self.lock:
+            self.pending.append((sql, parameters))
+            if len(self.pending) >= BATCH_SIZE:
+                self.flush()
+        return
+
+    # Commit all the pending writes in one transaction
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            with self.connection:
+                for sql, parameters in self.pending:
+                    self.connection.execute(sql, parameters)
+                if self.files_changed:
+                    self.connection.execute("DELETE FROM meta WHERE key = 'hash_snapshot'")
+            self.pending = []
+            self.files_changed = False
+        return
+
+    # Run a query against the catalog, pending writes are committed first so they're visible
+    def query(self, sql, parameters=()):
+        with self.lock:
+            self.flush()
+            return self.connection.execute(sql, parameters).fetchall()
+
+    # Record a file, keeping the existing date details if they're not given
+    def put_file(self, path, size, mtime_ns, sha256, directory_date=None, exif_tag=None, inode=None):
+        path = self.relative(path)
+        with self.lock:
+            self.files_changed = True
+            self.write('''INSERT INTO files (path, directory, size, mtime_ns, inode, sha256, directory_date, exif_tag)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                          ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns,
+                          inode = excluded.inode, sha256 = excluded.sha256,
+                          fingerprint = CASE WHEN files.sha256 = excluded.sha256 THEN files.fingerprint END,
+                          phash = CASE WHEN files.sha256 = excluded.sha256 THEN files.phash END,
+                          directory_date = COALESCE(excluded.directory_date, files.directory_date),
+                          exif_tag = COALESCE(excluded.exif_tag, files.exif_tag)''',
+                       (path, os.path.dirname(path), size, mtime_ns, inode, sha256, directory_date, exif_tag))
+        return
+
+    # Forget a file
+    def remove_file(self, path):
+        with self.lock:
+            self.files_changed = True
+            self.write('DELETE FROM files WHERE path = ?', (self.relative(path),))
+        return
+
+    # Record that a file has moved, along with the duplicates that refer to it
+    def move_file(self, path, new_path):
+        path = self.relative(path)
+        new_path = self.relative(new_path)
+        with self.lock:
+            self.files_changed = True
+            self.write('UPDATE files SET path = ?, directory = ? WHERE path = ?',
+                       (new_path, os.path.dirname(new_path), path))
+            self.write('UPDATE duplicates SET original = ? WHERE original = ?', (new_path, path))
+        return
+
+    # Return the stored path for a hash, None if it isn't known
+    def find_hash(self, sha256):
+        rows = self.query('SELECT path FROM files WHERE sha256 = ? LIMIT 1', (sha256,))
+        return self.absolute(rows[0][0]) if rows else None
+
+    # Yield every hash with its relative path in hash order, excluding the duplicate and bad directories. The rows are
+    # read from the sha256 index as they're asked for rather than all at once
+    def hashes(self):
+        with self.lock:
+            self.flush()
+            yield from self.connection.execute('''SELECT sha256, path FROM files
+                                                  WHERE sha256 IS NOT NULL AND directory NOT IN ('Dup', 'Bad')
+                                                  ORDER BY sha256, rowid''')
+
+    # Return the sizes of the files in the library, excluding the duplicate and bad directories
+    def sizes(self):
+        rows = self.query("SELECT DISTINCT size FROM files WHERE directory NOT IN ('Dup', 'Bad')")
+        return set(size for size, in rows)
+
+    # Return the path and fingerprint of every library file of the given size
+    def size_fingerprints(self, size):
+        rows = self.query("SELECT path, fingerprint FROM files WHERE size = ? AND directory NOT IN ('Dup', 'Bad')",
+                          (size,))
+        return [(self.absolute(path), fingerprint) for path, fingerprint in rows]
+
+    # Record the quick fingerprint of a file
+    def put_fingerprint(self, path, fingerprint):
+        self.write('UPDATE files SET fingerprint = ? WHERE path = ?', (fingerprint, self.relative(path)))
+        return
+
+    # Record the perceptual hash of a file, an empty string if it isn't an image
+    def put_phash(self, path, phash):
+        self.write('UPDATE files SET phash = ? WHERE path = ?', (phash, self.relative(path)))
+        return
+
+    # Return the path and perceptual hash of every library image
+    def phashes(self):
+        rows = self.query("SELECT path, phash FROM files WHERE phash IS NOT NULL AND phash != '' "
+                          "AND directory NOT IN ('Dup', 'Bad')")
+        return [(self.absolute(path), phash) for path, phash in rows]
+
+    # Return the library files that haven't had a perceptual hash worked out
+    def missing_phashes(self):
+        rows = self.query("SELECT path FROM files WHERE phash IS NULL AND directory NOT IN ('Dup', 'Bad')")
+        return [self.absolute(path) for path, in rows]
+
+    # Record a source file whose content is already in the library, with the library copy and the link made to it
+    # (if any). Source paths are outside the destination so they're kept as they are
+    def put_duplicate(self, source, size, sha256, original, path=None, status='dup'):
+        self.write('INSERT OR REPLACE INTO duplicates (source, size, sha256, original, path, status) '
+                   'VALUES (?, ?, ?, ?, ?, ?)',
+                   (os.path.abspath(source), size, sha256, self.relative(original), path and self.relative(path),
+                    status))
+        return
+
+    # Return the stored (size, mtime_ns, inode, sha256) of the files in a directory, keyed by absolute path
+    def directory_files(self, directory):
+        rows = self.query('SELECT path, size, mtime_ns, inode, sha256 FROM files WHERE directory = ?',
+                          (self.relative(directory),))
+        return {self.absolute(row[0]): tuple(row[1:]) for row in rows}
+
+    # Return the names of the directories holding files
+    def file_directories(self):
+        return set(directory for directory, in self.query('SELECT DISTINCT directory FROM files'))
+
+    # Return the directory hashes, keyed by absolute path
+    def directory_hashes(self):
+        rows = self.query('SELECT path, hash FROM directories')
+        return {self.absolute(path): dir_hash for path, dir_hash in rows}
+
+    # Record a directory hash
+    def put_directory(self, path, dir_hash):
+        self.write('INSERT OR REPLACE INTO directories (path, hash) VALUES (?, ?)', (self.relative(path), dir_hash))
+        return
+
+    # Return the sha256 of each member of a directory archive, keyed by name
+    def archive_members(self, archive):
+        rows = self.query('SELECT name, sha256 FROM archive_members WHERE archive = ?', (self.relative(archive),))
+        return dict(rows)
+
+    # Record the members added to an archive, replacing any existing members if it was rebuilt
+    def put_archive_members(self, archive, members, replace=False):
+        archive = self.relative(archive)
+        with self.lock:
+            if replace:
+                self.write('DELETE FROM archive_members WHERE archive = ?', (archive,))
+            for name, sha256 in members.items():
+                self.write('INSERT OR REPLACE INTO archive_members (archive, name, sha256) VALUES (?, ?, ?)',
+                           (archive, name, sha256))
+        return
+
+    # Read and write single values
+    def get_meta(self, key, default=None):
+        rows = self.query('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else default
+
+    def put_meta(self, key, value):
+        self.write('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+        return
+
+    def remove_meta(self, key):
+        self.write('DELETE FROM meta WHERE key = ?', (key,))
+        return
+
+    # One time import of the pickle files used before the catalog existed
+    def import_pickles(self):
+        if self.get_meta('pickles_imported'):
+            return
+        logger.debug('Importing pickle files')
+        count = 0
+
+        # The hashes from the store index, then the file checksums which are more up to date
+        hash_maps = []
+        index_file = os.path.join(self.destination, 'hash_index.pkl')
+        if os.path.isfile(index_file):
+            with open(index_file, 'rb') as f:
+                hash_maps.append({file: photo_hash for photo_hash, file in pickle.load(f).items()})
+        for path in [dir.path for dir in os.scandir(self.destination) if dir.is_dir()]:
+            hash_file = os.path.join(path, 'file_hash.pkl')
+            if os.path.isfile(hash_file):
+                with open(hash_file, 'rb') as f:
+                    hash_maps.append(pickle.load(f))
+
+        for hash_map in hash_maps:
+            for file, photo_hash in hash_map.items():
+                # Skip anything that has since been removed
+                try:
+                    stat = os.stat(file)
+                except OSError:
+                    continue
+                directory = os.path.dirname(file)
+                directory_date = os.path.basename(directory) if directory != self.destination else None
+                self.put_file(file, stat.st_size, stat.st_mtime_ns, photo_hash, directory_date, inode=stat.st_ino)
+                count += 1
+
+        dir_hash_file = os.path.join(self.destination, 'dir_hash.pkl')
+        if os.path.isfile(dir_hash_file):
+            with open(dir_hash_file, 'rb') as f:
+                for path, dir_hash in pickle.load(f).items():
+                    self.put_directory(path, dir_hash)
+
+        self.put_meta('pickles_imported', '1')
+        self.flush()
+        if count:
+            logger.info('Imported {} file hashes from pickle files'.format(count))
+        return
@@ -0,0 +1,157 @@
+import logging
+import threading
+from store import photos
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+# A file accepted as new during this run, its hash is filled in once it has been copied. Only what's needed to compare
+# against it is kept, as there's one for every new file in the run
+class Candidate:
+    __slots__ = ['fullname', 'size', 'fingerprint', 'hash', 'done']
+
+    def __init__(self, photo, fingerprint=None):
+        self.fullname = photo.fullname
+        self.size = photo.size
+        self.fingerprint = fingerprint
+        self.hash = photo.hash
+        # Cleared once the hash is known, so finished candidates don't each hold on to an Event
+        self.done = threading.Event()
+
+    # Fingerprint the file the first time another file of the same size turns up. Two threads asking at once may
+    # both read the file, which gives the same answer
+    def get_fingerprint(self):
+        if self.fingerprint is None:
+            self.fingerprint = photos.photo_fingerprint(self.fullname, self.size)
+        return self.fingerprint
+
+    # Wait for the full hash, None if the file was never stored
+    def get_hash(self):
+        done = self.done
+        if done is not None:
+            done.wait()
+        return self.hash
+
+    # The hash is known, or None if the file won't be stored
+    def finish(self, photo_hash):
+        self.hash = photo_hash
+        done = self.done
+        if done is not None:
+            done.set()
+            self.done = None
+        return
+
+
+# Tiered duplicate check, a file is only fingerprinted when its size matches another file and only fully hashed
+# when its fingerprint matches too. Files with a size of their own are new without being read at all
+class DuplicateDetector:
+    def __init__(self, library, index, hash_file=photos.photo_hash):
+        self.library = library
+        self.index = index
+        self.hash_file = hash_file
+        self.lock = threading.Lock()
+        # Sizes of the files already in the library, and their fingerprints once needed
+        self.library_sizes = library.sizes()
+        self.library_fingerprints = dict()
+        # Files accepted this run, by size
+        self.candidates = dict()
+
+    # Classify the photo as 'new', 'dup' (of a file from this run) or 'exists' (in the library), setting its
+    # original and, if it had to be calculated, its hash
+    def check(self, photo):
+        with self.lock:
+            in_library = photo.size in self.library_sizes
+            candidates = list(self.candidates.get(photo.size, []))
+            # Nothing else this size so it must be new
+            if not in_library and not candidates:
+                self.candidates[photo.size] = [Candidate(photo)]
+                return 'new'
+
+        fingerprint = photos.photo_fingerprint(photo.fullname, photo.size)
+
+        # Compare against the library
+        if in_library and fingerprint in self.get_library_fingerprints(photo.size):
+            if photo.hash is None:
+                photo.set_hash(self.hash_file(photo.fullname))
+            if photo.hash in self.index:
+                photo.original = self.index[photo.hash]
+                return 'exists'
+
+        # Compare against the files from this run, until there are no more to check
+        checked = set()
+        while True:
+            for candidate in candidates:
+                checked.add(candidate)
+                if candidate.get_fingerprint() != fingerprint:
+                    continue
+                if photo.hash is None:
+                    photo.set_hash(self.hash_file(photo.fullname))
+                if candidate.get_hash() == photo.hash:
+                    photo.original = candidate.fullname
+                    return 'dup'
+            with self.lock:
+                candidates = [candidate for candidate in self.candidates.get(photo.size, [])
+                              if candidate not in checked]
+                if not candidates:
+                    self.candidates.setdefault(photo.size, []).append(Candidate(photo, fingerprint))
+                    return 'new'
+
+    # The new photo has been stored, release anything waiting on its hash
+    def stored(self, photo):
+        candidate = self.find(photo)
+        if candidate is not None:
+            candidate.finish(photo.hash)
+        return
+
+    # The new photo won't be stored after all
+    def release(self, photo):
+        candidate = self.find(photo)
+        if candidate is not None:
+            with self.lock:
+                self.candidates[photo.size].remove(candidate)
+            candidate.finish(None)
+        return
+
+    # Treat the files accepted so far as library files, so a long running ingest doesn't hold on to them. Only to be
+    # called between runs, once everything has been stored or released
+    def reset(self):
+        with self.lock:
+            for size in self.candidates:
+                self.library_sizes.add(size)
+                self.library_fingerprints.pop(size, None)
+            self.candidates = dict()
+        return
+
+    # Find the candidate for a photo
+    def find(self, photo):
+        with self.lock:
+            for candidate in self.candidates.get(photo.size, []):
+                if candidate.fullname == photo.fullname:
+                    return candidate
+        return None
+
+    # Fingerprints of the library files of a given size, calculated and saved the first time they're needed
+    def get_library_fingerprints(self, size):
+        with self.lock:
+            if size in self.library_fingerprints:
+                return self.library_fingerprints[size]
+        fingerprints = set()
+        for path, fingerprint in self.library.size_fingerprints(size):
+            if fingerprint is None:
+                try:
+                    fingerprint = photos.photo_fingerprint(path, size)
+                except OSError:
+                    continue
+                self.library.put_fingerprint(path, fingerprint)
+            fingerprints.add(fingerprint)
+        with self.lock:
+            self.library_fingerprints[size] = fingerprints
+        return fingerprints
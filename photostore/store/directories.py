@@ -1,10 +1,13 @@
+import hashlib
 import logging
+import multiprocessing
 import os
-from dirhash import dirhash
-import pickle
+import tempfile
+import time
 from itertools import repeat
 import concurrent.futures
-import pyminizip
+import pyzipper
+from store import catalog, files, metrics
 
 
 # Setup logging
@@ -16,27 +19,30 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
+# Types that are already compressed are stored as they are, anything else is deflated at this level
+STORED_TYPES = ['.jpg', '.jpeg', '.heic', '.heif', '.mov', '.mp4', '.m4v', '.3gp', '.png', '.gif', '.zip']
+DEFLATE_LEVEL = 6
 
-# Main entrypoint to perform checksums for all directories
-def checksums(destination, compress):
+
+# Main entrypoint to perform checksums for all directories, returns the number of archives that failed
+def checksums(destination, compress, password=None, jobs=None):
     logger.debug('Calling checksums')
     workers = 5
 
     dup_path = os.path.join(destination, 'Dup')
     bad_path = os.path.join(destination, 'Bad')
+    review_path = os.path.join(destination, 'Review')
 
-    hash_file = os.path.join(destination, 'dir_hash.pkl')
-    if os.path.isfile(hash_file):
-        with open(hash_file, 'rb') as f:
-            hash_map = pickle.load(f)
-    else:
-        hash_map = dict()
+    library = catalog.Catalog(destination)
+    hash_map = library.directory_hashes()
 
     # Create list of all the directories
     paths = [dir.path for dir in os.scandir(destination) if dir.is_dir()]
     # Remote the duplicate and bad paths - don't want to process these
     paths.remove(dup_path) if os.path.isdir(dup_path) else False
     paths.remove(bad_path) if os.path.isdir(bad_path) else False
+    # Photos waiting for review aren't settled in the library yet
+    paths.remove(review_path) if os.path.isdir(review_path) else False
     # Remove directories that are empty
     [paths.remove(path) for path in paths if not os.listdir(path)]
     # Record whether path is already known about or not
@@ -45,54 +51,122 @@ def checksums(destination, compress):
     # Setup thread pool
     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
         # Process each directory
-        hash_matches = list(executor.map(directory_checksum, paths, hashes))
+        hash_matches = list(executor.map(directory_checksum, paths, hashes, repeat(library)))
 
-    # Determine if the directory needs to be compressed, i.e. it's hash is not in the hash_map, and
-    # it doesn't match the existing hash
-    compress_list = [False if path in hash_map and hash_map[path] == hash else True for path, hash in
-                     zip(paths, hash_matches)]
-    # Updating the hash_map with the current hashes
+    # Updating the catalog with the current hashes
     for path, hash in zip(paths, hash_matches):
-        hash_map[path] = hash
+        library.put_directory(path, hash)
 
+    failures = 0
     if compress:
-        # Setup thread pool
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            # Process each directory
-            executor.map(directory_compress, paths, compress_list)
+        failures = compress_directories(paths, library, password, jobs)
 
     # Save the hashes
-    hash_file = os.path.join(destination, 'dir_hash.pkl')
-    with open(hash_file, 'wb') as f:
-        pickle.dump(hash_map, f)
+    library.close()
 
-    return
+    return failures
 
 
 # Individual directory checksum
-def directory_checksum(directory, hash):
-    logger.debug('Processing {}'.format(directory))
-    # Calculate the directory hash
-    dir_hash = dirhash(directory, 'md5')
+def directory_checksum(directory, hash, library):
+    logger.debug('Processing %s', directory)
+    start = metrics.registry.start()
+    # Bring the file hashes up to date, only new or changed files are read
+    files.file_checksum(directory, library)
+    # Calculate the directory hash from the file hashes
+    known_files = library.directory_files(directory)
+    dir_hash = combine_hashes({path: known[3] for path, known in known_files.items()})
+    metrics.registry.record('dirhash', start, sum(known[0] or 0 for known in known_files.values()))
     match = '✔' if hash == dir_hash else '✘'
     logger.info('{} - {} {}'.format(directory, dir_hash, match))
     # Return true if hashes match else false
     return dir_hash
 
 
-# Check if directory compression is necessary
-def directory_compress(directory, compress):
-    logger.debug('Compression check {}'.format(directory))
-    zip = '.'.join([directory, 'zip'])
-    if compress or not os.path.isfile(zip):
-        # Compress the directory
-        compress_directory(directory, zip, '%Od.$H@sgq0O4jj6xKn8')
-        return
-
-
-# Individual directory compression
-def compress_directory(directory, zip, password):
-    logger.debug('Compressing {}'.format(directory))
-    files = [file.path for file in os.scandir(directory) if file.is_file()]
-    pyminizip.compress_multiple(files, [], zip, password, 0)
-    return
+# Combine the name and hash of each file into a hash for the directory, so any file being added, removed, renamed or
+# changed gives a new directory hash
+def combine_hashes(file_hashes):
+    dir_hash = hashlib.sha256()
+    for path in sorted(file_hashes):
+        dir_hash.update('{}\0{}\n'.format(os.path.basename(path), file_hashes[path]).encode())
+    return dir_hash.hexdigest()
+
+
+# Bring the archive of each directory up to date on a pool of processes, returns the number that failed
+def compress_directories(directories, library, password, jobs=None):
+    tasks = [task for task in (archive_changes(directory, library) for directory in directories) if task is not None]
+    if not tasks:
+        return 0
+
+    failures = 0
+    # The pool processes start with fresh loggers, so they're given this one's level
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=logger.setLevel, initargs=(logger.level,)) as executor:
+        futures = {executor.submit(compress_directory, zip_file, members, rebuild, password):
+                   (zip_file, members, rebuild) for zip_file, members, rebuild in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            zip_file, members, rebuild = futures[future]
+            try:
+                seconds, size = future.result()
+            except Exception as e:
+                logger.error('Failed to compress {}: {}'.format(zip_file, e))
+                failures += 1
+                continue
+            metrics.registry.observe('zip', seconds, size)
+            # The members are only recorded once the archive has been written
+            library.put_archive_members(zip_file, {name: sha256 for path, name, sha256 in members}, rebuild)
+            logger.info('{} {} with {} files'.format(zip_file, 'rebuilt' if rebuild else 'updated', len(members)))
+    if failures:
+        logger.error('{} archives failed'.format(failures))
+    return failures
+
+
+# Work out what the archive of a directory is missing, returns (zip, [(path, name, sha256)], rebuild) or None if
+# it's up to date. Members can only be added to a zip, so a file that has changed or gone means rebuilding it
+def archive_changes(directory, library):
+    logger.debug('Compression check %s', directory)
+    zip_file = '.'.join([directory, 'zip'])
+    current = {os.path.basename(path): (path, known[3]) for path, known in library.directory_files(directory).items()}
+    members = library.archive_members(zip_file)
+    rebuild = any(name not in current or current[name][1] != sha256 for name, sha256 in members.items())
+    # Make sure the archive holds what the catalog says it does, it may have been replaced or left part written
+    if not rebuild:
+        try:
+            with pyzipper.AESZipFile(zip_file) as archive:
+                rebuild = set(archive.namelist()) != set(members)
+        except (OSError, pyzipper.BadZipFile):
+            rebuild = True
+    new_members = [(path, name, sha256) for name, (path, sha256) in sorted(current.items())
+                   if rebuild or name not in members]
+    if not new_members:
+        return None
+    return zip_file, new_members, rebuild
+
+
+# Add files to a directory archive, or write it from scratch to a temporary file that replaces it. Run in the pool
+# processes, returns the seconds taken and bytes added
+def compress_directory(zip_file, members, rebuild, password):
+    logger.debug('Compressing %s', zip_file)
+    start = time.perf_counter()
+    size = 0
+    target = zip_file
+    if rebuild:
+        directory, name = os.path.split(zip_file)
+        fd, target = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(name), suffix='.tmp')
+        os.close(fd)
+    try:
+        with pyzipper.AESZipFile(target, 'w' if rebuild else 'a', encryption=pyzipper.WZ_AES) as archive:
+            archive.setpassword(password.encode())
+            for path, name, sha256 in members:
+                size += os.path.getsize(path)
+                if os.path.splitext(name)[1].lower() in STORED_TYPES:
+                    archive.write(path, name, compress_type=pyzipper.ZIP_STORED)
+                else:
+                    archive.write(path, name, compress_type=pyzipper.ZIP_DEFLATED, compresslevel=DEFLATE_LEVEL)
+        if rebuild:
+            os.replace(target, zip_file)
+    except BaseException:
+        if rebuild:
+            os.remove(target)
+        raise
+    return time.perf_counter() - start, size
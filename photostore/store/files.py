@@ -1,9 +1,7 @@
+import concurrent.futures
 import logging
 import os
-from dirhash import dirhash
-import pickle
-import concurrent.futures
-from store import photos
+from store import catalog, hashing, metrics, perceptual, walker
 
 
 # Setup logging
@@ -17,9 +15,8 @@ logger.addHandler(console_handler)
 
 
 # Main entrypoint to perform checksums for all files
-def checksums(destination):
+def checksums(destination, full=False, jobs=None, processes=True, phash=False):
     logger.debug('Calling checksums')
-    workers = 5
 
     dup_path = os.path.join(destination, 'Dup')
     bad_path = os.path.join(destination, 'Bad')
@@ -30,33 +27,90 @@ def checksums(destination):
     paths.remove(dup_path)
     paths.remove(bad_path)
 
-    # Setup thread pool
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        # Process each directory
-        executor.map(file_checksum, paths)
+    with catalog.Catalog(destination) as library, hashing.HashScheduler(jobs, processes) as scheduler:
+        # Find the new and changed files in every directory, then hash them all together so the work is spread
+        # across the pool by file rather than by directory
+        changed = []
+        skipped = removed = 0
+        for path in paths:
+            directory_changed, directory_skipped, directory_removed = changed_files(path, library, full)
+            changed.extend(directory_changed)
+            skipped += directory_skipped
+            removed += directory_removed
+        rehashed = store_hashes(changed, library, scheduler)
+        if phash:
+            logger.info('{} perceptual hashes added'.format(store_phashes(library, jobs)))
 
+    logger.info('{} files unchanged, {} rehashed, {} removed'.format(skipped, rehashed, removed))
     return
 
 
-# Individual file checksum
-def file_checksum(directory):
+# Individual directory file checksums. Returns the number of files skipped, rehashed and removed
+def file_checksum(directory, library, full=False, scheduler=None):
     logger.debug('Processing {}'.format(directory))
-    # Setup hash dictionary
-    photo_hashes = dict()
+    changed, skipped, removed = changed_files(directory, library, full)
+    rehashed = store_hashes(changed, library, scheduler)
+    return skipped, rehashed, removed
+
+
+# Find the files in a directory that need hashing, files whose size, modified time and inode match the catalog keep
+# their stored hash unless full is set. Files that have gone, or are only left over from an interrupted store, are
+# removed from the catalog. Returns the (file, stat) to hash and the number skipped and removed
+def changed_files(directory, library, full=False):
+    changed = []
+    skipped = 0
+    # Files the catalog already knows about in this directory
+    known_files = library.directory_files(directory)
     # Create list of files in the current directory
-    files = [file.path for file in os.scandir(directory) if file.is_file()]
+    files = [file for file in os.scandir(directory) if file.is_file()]
     # Loop over each file
     for file in files:
         # Ignore logs or metadata
-        if os.path.splitext(file)[1].lower() in ['.log', '.txt', '.pkl']:
+        if os.path.splitext(file.name)[1].lower() in ['.log', '.txt', '.pkl']:
             continue
-        # Determine file hash and add to the dictionary
-        photo_hash = photos.photo_hash(file)
-        photo_hashes[file] = photo_hash
+        # Nor anything an interrupted store left behind
+        if walker.leftover(file):
+            continue
+        stat = file.stat()
+        known = known_files.pop(file.path, None)
+        if not full and known is not None and known[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            skipped += 1
+            continue
+        changed.append((file.path, stat))
 
-    # Save the hashes into the dictionary
-    hash_file = os.path.join(directory, 'file_hash.pkl')
-    with open(hash_file, 'wb') as f:
-        pickle.dump(photo_hashes, f)
+    # Anything left has been removed from the directory
+    for file in known_files:
+        library.remove_file(file)
 
-    return
+    return changed, skipped, len(known_files)
+
+
+# Work out the perceptual hashes the catalog doesn't have, so photos stored before near duplicate checking was turned
+# on can be matched. Pillow lets go of the GIL while decoding so threads are enough. Returns the number added
+def store_phashes(library, jobs=None):
+    missing = library.missing_phashes()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        for file, phash in zip(missing, executor.map(perceptual.photo_phash, missing)):
+            library.put_phash(file, phash if phash is not None else perceptual.NOT_AN_IMAGE)
+    return len(missing)
+
+
+# Hash the files, on the scheduler if there is one, and add them to the catalog. Returns the number hashed
+def store_hashes(changed, library, scheduler=None):
+    stats = dict(changed)
+    if scheduler is not None:
+        results = scheduler.map([(file, stat.st_size) for file, stat in changed])
+    else:
+        results = hashing.hash_files(list(stats))
+
+    rehashed = 0
+    for file, photo_hash, error, seconds in results:
+        if error is not None:
+            logger.warning('Unable to hash {}: {}'.format(file, error))
+            continue
+        stat = stats[file]
+        metrics.registry.observe('sha256', seconds, stat.st_size)
+        library.put_file(file, stat.st_size, stat.st_mtime_ns, photo_hash, os.path.basename(os.path.dirname(file)),
+                         inode=stat.st_ino)
+        rehashed += 1
+    return rehashed
@@ -0,0 +1,85 @@
+import logging
+import multiprocessing
+import os
+import time
+import concurrent.futures
+from store import metrics, photos
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Small files are grouped into tasks of about this many bytes (or files) to cut the per task overhead
+TASK_BYTES = 16 * 1024 * 1024
+TASK_FILES = 64
+
+
+# Hash a group of files, returns (file, hash, error, seconds) for each, run inside the pool workers
+def hash_files(files):
+    results = []
+    for file in files:
+        start = time.perf_counter()
+        try:
+            results.append((file, photos.photo_hash(file), None, time.perf_counter() - start))
+        except OSError as e:
+            results.append((file, None, str(e), time.perf_counter() - start))
+    return results
+
+
+# Hashes files on a pool of threads or processes, with work handed out per file rather than per directory
+class HashScheduler:
+    def __init__(self, jobs=None, processes=True):
+        self.jobs = jobs or os.cpu_count() or 1
+        # Workers are spawned rather than forked as the pool may be started while other threads are running
+        if processes:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs,
+                                                                   mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    # Hash a single file, for callers already running on their own worker thread
+    def hash(self, file):
+        file, photo_hash, error, seconds = self.executor.submit(hash_files, [file]).result()[0]
+        if error is not None:
+            raise OSError(error)
+        metrics.registry.observe('sha256', seconds, os.path.getsize(file) if metrics.registry.enabled else 0)
+        return photo_hash
+
+    # Hash a list of (file, size), yielding (file, hash, error, seconds) as they finish. The largest files are handed
+    # out first so the workers finish together, small files are grouped to keep the pool busy
+    def map(self, files):
+        tasks = []
+        group = []
+        group_size = 0
+        for file, size in sorted(files, key=lambda file: file[1], reverse=True):
+            if size >= TASK_BYTES:
+                tasks.append([file])
+                continue
+            group.append(file)
+            group_size += size
+            if group_size >= TASK_BYTES or len(group) >= TASK_FILES:
+                tasks.append(group)
+                group = []
+                group_size = 0
+        if group:
+            tasks.append(group)
+
+        futures = [self.executor.submit(hash_files, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            for result in future.result():
+                yield result
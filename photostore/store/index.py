@@ -0,0 +1,275 @@
+import io
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import uuid
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Snapshot file layout: header (magic, version, entry count, path blob size, catalog token), the sorted 32 byte
+# digests, an offset into the path blob for each entry plus one for the end, then the blob of relative paths
+SNAPSHOT_FILE = 'hash_index.bin'
+SNAPSHOT_MAGIC = b'PSHI'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sIQQ32s')
+DIGEST_SIZE = 32
+OFFSET = struct.Struct('<QQ')
+
+
+# Read only table of digest to path, held in one buffer so it can be memory mapped straight from the snapshot file
+# and only the pages that are looked at get read. Per million entries it takes 32 MB of digests, 8 MB of offsets and
+# the relative paths (about 20 MB for names like 2021_05/IMG_1234.JPG), around 62 MB in all, shared through the
+# page cache. The dict of hex strings to absolute path strings it replaces took over 250 MB per million
+class HashSnapshot:
+    def __init__(self, buffer, mapping=None):
+        magic, version, self.count, blob_size, token = SNAPSHOT_HEADER.unpack_from(buffer)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not a version {} hash snapshot'.format(SNAPSHOT_VERSION))
+        self.token = token.decode('ascii')
+        self.buffer = buffer
+        self.mapping = mapping
+        self.digests_start = SNAPSHOT_HEADER.size
+        self.offsets_start = self.digests_start + self.count * DIGEST_SIZE
+        self.paths_start = self.offsets_start + (self.count + 1) * 8
+        if len(buffer) != self.paths_start + blob_size:
+            raise ValueError('Hash snapshot is truncated')
+
+    def __len__(self):
+        return self.count
+
+    # Binary search for a digest, returns the relative path or None
+    def find(self, digest):
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            start = self.digests_start + middle * DIGEST_SIZE
+            if self.buffer[start:start + DIGEST_SIZE] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        start = self.digests_start + low * DIGEST_SIZE
+        if low == self.count or self.buffer[start:start + DIGEST_SIZE] != digest:
+            return None
+        path_start, path_end = OFFSET.unpack_from(self.buffer, self.offsets_start + low * 8)
+        return self.buffer[self.paths_start + path_start:self.paths_start + path_end].decode('utf-8')
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+        return
+
+
+# Write (hex sha256, relative path) pairs, sorted by hash, as a snapshot to a seekable file. Entries are written as they
+# arrive so memory use doesn't grow with the library, the offsets and paths go to temporary files until the digests
+# are all written. A later path for the same hash replaces an earlier one
+def write_snapshot(entries, token, fh):
+    count = 0
+    blob_size = 0
+    fh.write(bytes(SNAPSHOT_HEADER.size))
+    with tempfile.TemporaryFile() as offsets, tempfile.TemporaryFile() as paths:
+        offsets.write(struct.pack('<Q', 0))
+        last = None
+        path = None
+        for photo_hash, next_path in entries:
+            try:
+                digest = bytes.fromhex(photo_hash)
+            except ValueError:
+                digest = b''
+            if len(digest) != DIGEST_SIZE or (last is not None and digest < last):
+                logger.warning('Skipping bad hash {} for {}'.format(photo_hash, next_path))
+                continue
+            if digest != last and last is not None:
+                blob_size += write_entry(fh, offsets, paths, last, path, blob_size)
+                count += 1
+            last = digest
+            path = next_path.encode('utf-8')
+        if last is not None:
+            blob_size += write_entry(fh, offsets, paths, last, path, blob_size)
+            count += 1
+        for part in (offsets, paths):
+            part.seek(0)
+            shutil.copyfileobj(part, fh)
+    fh.seek(0)
+    fh.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count, blob_size, token.encode('ascii')))
+    fh.seek(0, os.SEEK_END)
+    return count
+
+
+# Write one digest, the offset of the end of its path and the path, returns the size of the path
+def write_entry(fh, offsets, paths, digest, path, blob_size):
+    fh.write(digest)
+    offsets.write(struct.pack('<Q', blob_size + len(path)))
+    paths.write(path)
+    return len(path)
+
+
+# Map a snapshot file into memory, None if it's missing or damaged
+def open_snapshot(snapshot_file):
+    try:
+        with open(snapshot_file, 'rb') as fh:
+            mapping = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        return HashSnapshot(mapping, mapping)
+    except (ValueError, struct.error) as e:
+        logger.warning('Ignoring hash snapshot: {}'.format(e))
+        mapping.close()
+        return None
+
+
+# Content hash to file location for everything already stored in the destination library. The library is read from
+# a snapshot of the catalog that is rebuilt whenever the catalog's files have changed since it was made, files
+# stored during the run are held in memory on top of it
+class HashIndex:
+    def __init__(self, catalog, writable=True):
+        self.catalog = catalog
+        self.writable = writable
+        self.snapshot_file = os.path.join(catalog.destination, SNAPSHOT_FILE)
+        self.snapshot = None
+        self.hashes = dict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, photo_hash):
+        return self.get(photo_hash) is not None
+
+    def __getitem__(self, photo_hash):
+        file = self.get(photo_hash)
+        if file is None:
+            raise KeyError(photo_hash)
+        return file
+
+    # Number of different hashes in the library. Files moved or remembered this run can already be in the snapshot
+    def __len__(self):
+        if self.snapshot is None:
+            return len(self.hashes)
+        with self.lock:
+            hashes = list(self.hashes)
+        return len(self.snapshot) + sum(1 for photo_hash in hashes if not self.in_snapshot(photo_hash))
+
+    # Whether a hash is in the snapshot, rather than only known about this run
+    def in_snapshot(self, photo_hash):
+        try:
+            return self.snapshot.find(bytes.fromhex(photo_hash)) is not None
+        except (TypeError, ValueError):
+            return False
+
+    # Map the snapshot, rebuilding it first if the catalog has changed since it was made
+    def load(self):
+        token = self.catalog.get_meta('hash_snapshot')
+        snapshot = open_snapshot(self.snapshot_file) if token else None
+        if snapshot is not None and snapshot.token != token:
+            snapshot.close()
+            snapshot = None
+        if snapshot is None:
+            snapshot = self.rebuild()
+        self.snapshot = snapshot
+        logger.debug('Loaded {} hashes'.format(len(self.snapshot)))
+        return self
+
+    # Build a snapshot from the catalog, written to disk and mapped unless the index is read only
+    def rebuild(self):
+        token = uuid.uuid4().hex
+        if not self.writable:
+            buffer = io.BytesIO()
+            write_snapshot(self.catalog.hashes(), token, buffer)
+            return HashSnapshot(buffer.getvalue())
+        tmp_file = '{}.{}.tmp'.format(self.snapshot_file, token)
+        try:
+            with open(tmp_file, 'wb') as fh:
+                write_snapshot(self.catalog.hashes(), token, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        self.catalog.put_meta('hash_snapshot', token)
+        self.catalog.flush()
+        snapshot = open_snapshot(self.snapshot_file)
+        if snapshot is None:
+            # Where the file can't be memory mapped it's read in instead
+            with open(self.snapshot_file, 'rb') as fh:
+                snapshot = HashSnapshot(fh.read())
+        return snapshot
+
+    # Record a newly stored file, in memory and in the catalog
+    def add(self, photo_hash, file, directory_date=None, exif_tag=None):
+        stat = os.stat(file)
+        with self.lock:
+            self.hashes[photo_hash] = file
+        self.catalog.put_file(file, stat.st_size, stat.st_mtime_ns, photo_hash, directory_date, exif_tag,
+                              stat.st_ino)
+        return
+
+    # Note where another process has stored a hash, without recording it in the catalog
+    def remember(self, photo_hash, file):
+        with self.lock:
+            self.hashes[photo_hash] = file
+        return
+
+    # Record that a file stored this run has been moved within the library
+    def move(self, photo_hash, file, new_file):
+        with self.lock:
+            self.hashes[photo_hash] = new_file
+        self.catalog.move_file(file, new_file)
+        return
+
+    # Find where a hash is stored, None if it isn't in the library
+    def get(self, photo_hash):
+        with self.lock:
+            file = self.hashes.get(photo_hash)
+        if file is not None or self.snapshot is None:
+            return file
+        try:
+            path = self.snapshot.find(bytes.fromhex(photo_hash))
+        except (TypeError, ValueError):
+            return None
+        return self.catalog.absolute(path) if path is not None else None
+
+    # Record a file whose content is already stored, and the link to it if one was made
+    def add_duplicate(self, photo, original, file=None):
+        self.catalog.put_duplicate(photo.fullname, photo.size, photo.hash, original, file, photo.status)
+        return
+
+    # Commit the new entries to the catalog, and bring the snapshot up to date for the next run if files were added
+    def save(self):
+        self.catalog.flush()
+        if self.writable and self.hashes:
+            if self.snapshot is not None:
+                self.snapshot.close()
+            self.snapshot = self.rebuild()
+            with self.lock:
+                self.hashes = dict()
+        return
+
+    # Read the library again from the catalog, after files have been taken out of it
+    def reload(self):
+        self.catalog.flush()
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = self.rebuild()
+        with self.lock:
+            self.hashes = dict()
+        return self
+
+    def close(self):
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        return
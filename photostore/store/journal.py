@@ -0,0 +1,187 @@
+import glob
+import json
+import logging
+import os
+import threading
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Decisions are written out together once there are this many
+FLUSH_SIZE = 100
+
+
+# Append only record of what happened to each source file, one JSON object per line. A begin record is written
+# before a file is copied and a done record once it's in place (or found to exist already), or a cancel record if
+# nothing was written, so a run that is killed can be picked up again. A stored file being moved has a begin record
+# saying where it came from and a moved record. Destination paths are stored relative to the destination like the
+# catalog
+class Journal:
+    def __init__(self, destination, before_flush=None, journal_file=None):
+        self.destination = destination
+        self.journal_file = journal_file or os.path.join(destination, 'journal.log')
+        # Called before decisions are written, the catalog is committed first so a done record is never ahead of it
+        self.before_flush = before_flush
+        self.lock = threading.Lock()
+        self.pending = []
+        self.fh = None
+        # (source, size, mtime_ns) of every finished file and the destinations that were started but not finished
+        self.completed = set()
+        self.unfinished = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Read the journal left by the previous run, a partly written last line is ignored
+    def load(self):
+        if not os.path.isfile(self.journal_file):
+            return self
+        with open(self.journal_file, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('Ignoring damaged journal entry')
+                    continue
+                dest = self.absolute(record['dest']) if record.get('dest') else None
+                if record['op'] == 'begin':
+                    self.unfinished[dest] = record
+                elif record['op'] in ['cancel', 'moved']:
+                    self.unfinished.pop(dest, None)
+                elif record['op'] == 'done':
+                    self.unfinished.pop(dest, None)
+                    self.completed.add((record['source'], record['size'], record['mtime_ns']))
+        logger.debug('Journal has {} finished and {} unfinished files'.format(len(self.completed),
+                                                                               len(self.unfinished)))
+        return self
+
+    # Remove the destination files the previous run was part way through, along with their temporary files and any
+    # catalog entry made for them. A stored file that was being moved goes back where it was, unless that was rolled
+    # back too
+    def rollback(self, library=None):
+        for dest, record in self.unfinished.items():
+            moved = self.absolute(record['from']) if record.get('from') else None
+            if moved is not None and moved not in self.unfinished:
+                if os.path.exists(dest) and not os.path.exists(moved):
+                    logger.info('Moving {} back to {}'.format(dest, moved))
+                    os.replace(dest, moved)
+                elif os.path.exists(dest) and os.path.getsize(dest) == 0:
+                    os.remove(dest)
+                if library is not None:
+                    library.move_file(dest, moved)
+                continue
+            name = os.path.basename(dest)
+            for tmp_file in glob.glob(os.path.join(glob.escape(os.path.dirname(dest)),
+                                                   '.{}.*.tmp'.format(glob.escape(name)))):
+                os.remove(tmp_file)
+            if os.path.exists(dest):
+                logger.info('Rolling back {}'.format(dest))
+                os.remove(dest)
+            if library is not None:
+                library.remove_file(dest)
+        self.unfinished = dict()
+        return
+
+    # Open the journal for writing, a resumed run adds to the existing journal otherwise a new one is started
+    def open(self, resume=False):
+        if not resume:
+            self.completed = set()
+        self.fh = open(self.journal_file, 'a' if resume else 'w', encoding='utf-8')
+        # Finish off a line cut short by the interrupted run so it doesn't swallow the next record
+        if self.fh.tell() > 0:
+            with open(self.journal_file, 'rb') as fh:
+                fh.seek(-1, os.SEEK_END)
+                if fh.read(1) != b'\n':
+                    self.fh.write('\n')
+        return self
+
+    # Check whether a file was finished by a previous run and hasn't changed since
+    def finished(self, photo):
+        return (os.path.abspath(photo.fullname), photo.stat.st_size, photo.stat.st_mtime_ns) in self.completed
+
+    # Record that a file is about to be written to dest, or a stored file moved there from moved. This is written
+    # straight away, ahead of any pending done records, so the file can be rolled back
+    def begin(self, photo, dest, moved=None):
+        record = {'op': 'begin', 'source': os.path.abspath(photo.fullname), 'dest': self.relative(dest)}
+        if moved is not None:
+            record['from'] = self.relative(moved)
+        with self.lock:
+            self.fh.write(json.dumps(record) + '\n')
+            self.fh.flush()
+        return
+
+    # Record that nothing was written to dest after all, written straight away like the begin record
+    def cancel(self, dest):
+        record = {'op': 'cancel', 'dest': self.relative(dest)}
+        with self.lock:
+            self.fh.write(json.dumps(record) + '\n')
+            self.fh.flush()
+        return
+
+    # Record the decision made for a file and where it ended up
+    def done(self, photo, dest):
+        record = {'op': 'done', 'status': photo.status, 'source': os.path.abspath(photo.fullname),
+                  'size': photo.stat.st_size, 'mtime_ns': photo.stat.st_mtime_ns,
+                  'dest': self.relative(dest) if dest else None, 'hash': photo.hash}
+        with self.lock:
+            self.pending.append(json.dumps(record))
+            if len(self.pending) >= FLUSH_SIZE:
+                self.flush()
+        return
+
+    # Record that a stored file has been moved to dest, written with the done records once the catalog has the move
+    def moved(self, dest):
+        record = {'op': 'moved', 'dest': self.relative(dest)}
+        with self.lock:
+            self.pending.append(json.dumps(record))
+            if len(self.pending) >= FLUSH_SIZE:
+                self.flush()
+        return
+
+    # Start the journal again once everything in it has been committed, so a long running watch doesn't grow it
+    # forever. Only to be called when no file is part way through being stored
+    def truncate(self):
+        with self.lock:
+            self.flush()
+            if self.fh is not None:
+                # Back to the start, otherwise the next record is written at the old offset after a gap of NULs
+                self.fh.seek(0)
+                self.fh.truncate(0)
+        return
+
+    # Write out the pending records, must be called with the lock held
+    def flush(self):
+        if not self.pending or self.fh is None:
+            return
+        if self.before_flush is not None:
+            self.before_flush()
+        self.fh.write('\n'.join(self.pending) + '\n')
+        self.fh.flush()
+        self.pending = []
+        return
+
+    # Write out anything left and make sure it's on disk
+    def close(self):
+        with self.lock:
+            self.flush()
+            if self.fh is not None:
+                os.fsync(self.fh.fileno())
+                self.fh.close()
+                self.fh = None
+        return
+
+    def relative(self, path):
+        return os.path.relpath(path, self.destination)
+
+    def absolute(self, path):
+        return os.path.join(self.destination, path)
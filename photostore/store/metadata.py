@@ -0,0 +1,288 @@
+import datetime
+import logging
+import os
+import struct
+from store import metrics
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Brands of ISO media files holding HEIF images rather than movies
+heif_brands = [b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif']
+# Largest metadata block that will be read, anything bigger is left to exiftool
+MAX_BLOCK = 16 * 1024 * 1024
+# QuickTime dates count seconds from 1904
+QUICKTIME_EPOCH = datetime.datetime(1904, 1, 1)
+
+
+# Read the date tags Photo.extract_date uses straight from the file, in the same form exiftool returns them. Returns
+# None if the file isn't a JPEG, HEIF or QuickTime/MP4 file or can't be parsed, so exiftool can be used instead
+def read_dates(file):
+    start = metrics.registry.start()
+    try:
+        with open(file, 'rb') as fh:
+            stat = os.fstat(fh.fileno())
+            header = fh.read(12)
+            fh.seek(0)
+            if header[0:2] == b'\xff\xd8':
+                tags = jpeg_dates(fh)
+            elif header[4:8] == b'ftyp' and header[8:12] in heif_brands:
+                tags = heif_dates(fh, stat.st_size)
+            elif header[4:8] in [b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip', b'pnot']:
+                tags = quicktime_dates(fh, stat.st_size)
+            else:
+                return None
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        logger.debug('Unable to read dates from %s: %s', file, e)
+        return None
+    metrics.registry.record('native_metadata', start)
+    if tags is None:
+        return None
+
+    # The file system dates, as exiftool reports them for this platform
+    tags['File:FileModifyDate'] = file_date(stat.st_mtime)
+    if hasattr(stat, 'st_birthtime'):
+        tags['File:FileCreateDate'] = file_date(stat.st_birthtime)
+    elif os.name == 'nt':
+        tags['File:FileCreateDate'] = file_date(stat.st_ctime)
+    return tags
+
+
+# Format a file system timestamp like exiftool, in local time with the offset
+def file_date(timestamp):
+    date = datetime.datetime.fromtimestamp(timestamp).astimezone()
+    offset = date.strftime('%z')
+    return date.strftime('%Y:%m:%d %H:%M:%S') + offset[:3] + ':' + offset[3:]
+
+
+# Walk the JPEG segments up to the image data looking for the EXIF block
+def jpeg_dates(fh):
+    fh.read(2)
+    while True:
+        marker = fh.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            raise ValueError('Bad JPEG marker')
+        # Padding before the marker
+        while marker[1] == 0xff:
+            marker = marker[1:] + fh.read(1)
+        # Start of scan or end of image, no EXIF
+        if marker[1] in [0xda, 0xd9]:
+            return dict()
+        # Markers without a length
+        if 0xd0 <= marker[1] <= 0xd7 or marker[1] == 0x01:
+            continue
+        length = struct.unpack('>H', fh.read(2))[0]
+        if marker[1] == 0xe1:
+            segment = fh.read(length - 2)
+            if segment.startswith(b'Exif\x00\x00'):
+                return exif_dates(segment[6:])
+        else:
+            fh.seek(length - 2, os.SEEK_CUR)
+
+
+# Pull the original date out of a TIFF formatted EXIF block
+def exif_dates(tiff):
+    if tiff[0:2] == b'II':
+        order = '<'
+    elif tiff[0:2] == b'MM':
+        order = '>'
+    else:
+        raise ValueError('Bad TIFF header')
+    if struct.unpack(order + 'H', tiff[2:4])[0] != 42:
+        raise ValueError('Bad TIFF header')
+
+    tags = dict()
+    ifd0 = struct.unpack(order + 'I', tiff[4:8])[0]
+    exif_ifd = ifd_entries(tiff, order, ifd0).get(0x8769)
+    if exif_ifd is not None:
+        exif_offset = struct.unpack(order + 'I', exif_ifd[2])[0]
+        original = ifd_entries(tiff, order, exif_offset).get(0x9003)
+        if original is not None:
+            tags['EXIF:DateTimeOriginal'] = ifd_string(tiff, order, original)
+    return tags
+
+
+# Read the entries in an IFD, returning tag: (type, count, value/offset bytes)
+def ifd_entries(tiff, order, offset):
+    count = struct.unpack(order + 'H', tiff[offset:offset + 2])[0]
+    entries = dict()
+    for index in range(count):
+        start = offset + 2 + index * 12
+        tag, tag_type, tag_count = struct.unpack(order + 'HHI', tiff[start:start + 8])
+        entries[tag] = (tag_type, tag_count, tiff[start + 8:start + 12])
+    return entries
+
+
+# Read an ASCII IFD value, up to the first NUL. Whitespace is kept as exiftool keeps it, a blank date is all spaces
+# and colons
+def ifd_string(tiff, order, entry):
+    tag_type, count, value = entry
+    if count > 4:
+        offset = struct.unpack(order + 'I', value)[0]
+        value = tiff[offset:offset + count]
+        if len(value) < count:
+            raise ValueError('Truncated EXIF string')
+    return value[:count].split(b'\x00')[0].decode('ascii', 'replace')
+
+
+# Iterate over the ISO media boxes from the current position to end, yielding (type, data offset, data size)
+def boxes(fh, end):
+    position = fh.tell()
+    while position + 8 <= end:
+        fh.seek(position)
+        size, box_type = struct.unpack('>I4s', fh.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', fh.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header or position + size > end:
+            raise ValueError('Bad box size')
+        yield box_type, position + header, size - header
+        position += size
+
+
+# Read a box into memory
+def read_box(fh, offset, size):
+    if size > MAX_BLOCK:
+        raise ValueError('Box too large')
+    fh.seek(offset)
+    data = fh.read(size)
+    if len(data) < size:
+        raise ValueError('Truncated box')
+    return data
+
+
+# Iterate over the boxes held in a block of memory
+def child_boxes(data, start=0):
+    position = start
+    while position + 8 <= len(data):
+        size, box_type = struct.unpack('>I4s', data[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+            header = 16
+        elif size == 0:
+            size = len(data) - position
+        if size < header or position + size > len(data):
+            raise ValueError('Bad box size')
+        yield box_type, data[position + header:position + size]
+        position += size
+
+
+# Creation date from a movie or media header, exiftool shows these without any time zone conversion
+def header_date(data):
+    if data[0] == 1:
+        seconds = struct.unpack('>Q', data[4:12])[0]
+    else:
+        seconds = struct.unpack('>I', data[4:8])[0]
+    if seconds == 0:
+        return '0000:00:00 00:00:00'
+    return (QUICKTIME_EPOCH + datetime.timedelta(seconds=seconds)).strftime('%Y:%m:%d %H:%M:%S')
+
+
+# Find the movie and first track media headers in the moov box
+def quicktime_dates(fh, size):
+    for box_type, offset, box_size in boxes(fh, size):
+        if box_type != b'moov':
+            continue
+        tags = dict()
+        for child_type, child in child_boxes(read_box(fh, offset, box_size)):
+            if child_type == b'mvhd':
+                tags['QuickTime:CreateDate'] = header_date(child)
+            elif child_type == b'trak' and 'QuickTime:MediaCreateDate' not in tags:
+                for trak_type, trak in child_boxes(child):
+                    if trak_type != b'mdia':
+                        continue
+                    for mdia_type, mdia in child_boxes(trak):
+                        if mdia_type == b'mdhd':
+                            tags['QuickTime:MediaCreateDate'] = header_date(mdia)
+        return tags
+    # No movie header at all, something exiftool should look at
+    return None
+
+
+# Find the Exif item through the item info and location boxes in the meta box
+def heif_dates(fh, size):
+    for box_type, offset, box_size in boxes(fh, size):
+        if box_type != b'meta':
+            continue
+        # meta is a full box, skip the version and flags
+        meta = read_box(fh, offset, box_size)
+        exif_id = None
+        locations = dict()
+        for child_type, child in child_boxes(meta, 4):
+            if child_type == b'iinf':
+                exif_id = exif_item(child)
+            elif child_type == b'iloc':
+                locations = item_locations(child)
+        if exif_id is None:
+            return dict()
+        if exif_id not in locations:
+            raise ValueError('Exif item has no location')
+        extents = locations[exif_id]
+        data = b''.join(read_box(fh, extent_offset, extent_length) for extent_offset, extent_length in extents)
+        # The item starts with the offset to the TIFF header
+        tiff_offset = struct.unpack('>I', data[0:4])[0]
+        return exif_dates(data[4 + tiff_offset:])
+    return None
+
+
+# Return the ID of the Exif item from the item info box
+def exif_item(iinf):
+    version = iinf[0]
+    start = 6 if version == 0 else 8
+    for box_type, infe in child_boxes(iinf, start):
+        if box_type != b'infe' or infe[0] < 2:
+            continue
+        if infe[0] == 2:
+            item_id = struct.unpack('>H', infe[4:6])[0]
+            item_type = infe[8:12]
+        else:
+            item_id = struct.unpack('>I', infe[4:8])[0]
+            item_type = infe[10:14]
+        if item_type == b'Exif':
+            return item_id
+    return None
+
+
+# Return the (offset, length) extents of each item from the item location box
+def item_locations(iloc):
+    version = iloc[0]
+    offset_size = iloc[4] >> 4
+    length_size = iloc[4] & 0x0f
+    base_offset_size = iloc[5] >> 4
+    index_size = iloc[5] & 0x0f if version in [1, 2] else 0
+    position = 6
+
+    def read(size):
+        nonlocal position
+        value = int.from_bytes(iloc[position:position + size], 'big') if size else 0
+        position += size
+        return value
+
+    locations = dict()
+    item_count = read(2 if version < 2 else 4)
+    for _ in range(item_count):
+        item_id = read(2 if version < 2 else 4)
+        construction_method = read(2) & 0x0f if version in [1, 2] else 0
+        read(2)
+        base_offset = read(base_offset_size)
+        extents = []
+        for _ in range(read(2)):
+            read(index_size)
+            extent_offset = read(offset_size)
+            extent_length = read(length_size)
+            extents.append((base_offset + extent_offset, extent_length))
+        # Only data stored in the file itself is supported
+        if construction_method == 0:
+            locations[item_id] = extents
+    return locations
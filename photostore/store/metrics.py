@@ -0,0 +1,134 @@
+import json
+import logging
+import threading
+import time
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Upper bounds of the latency histogram buckets in seconds, the last bucket takes everything else
+BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, float('inf')]
+
+
+# Count, bytes and latency histogram of one operation
+class Metric:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds, size):
+        self.count += 1
+        self.bytes += size
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+                break
+        return
+
+    # Estimate a percentile from the histogram, as the upper bound of the bucket it falls in
+    def percentile(self, fraction):
+        target = self.count * fraction
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+
+# Metrics for a run, shared by every module. Nothing is recorded until it's enabled, so when it's off the cost of
+# instrumenting a call is start() returning None and record() returning straight away
+class Registry:
+    def __init__(self):
+        self.enabled = False
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        return
+
+    # Start timing an operation, returns None when disabled
+    def start(self):
+        return time.perf_counter() if self.enabled else None
+
+    # Finish timing an operation started with start(), size is the number of bytes it handled
+    def record(self, name, start, size=0):
+        if start is None:
+            return
+        self.observe(name, time.perf_counter() - start, size)
+        return
+
+    # Record an operation timed elsewhere, such as in a pool process
+    def observe(self, name, seconds, size=0):
+        if not self.enabled:
+            return
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric(name)
+            metric.observe(seconds, size)
+        return
+
+    # Table of the metrics, one row each
+    def summary(self):
+        lines = ['{:<20} {:>9} {:>10} {:>9} {:>9} {:>10} {:>10} {:>10}'.format(
+            'operation', 'count', 'MB', 'seconds', 'MB/s', 'mean ms', 'p95 ms', 'max ms')]
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                mb = metric.bytes / 1024 / 1024
+                lines.append('{:<20} {:>9} {:>10.1f} {:>9.2f} {:>9.1f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                    name, metric.count, mb, metric.seconds, mb / metric.seconds if metric.seconds else 0,
+                    metric.seconds / metric.count * 1000, metric.percentile(0.95) * 1000,
+                    metric.max_seconds * 1000))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        with self.lock:
+            return {name: {'count': metric.count, 'bytes': metric.bytes, 'seconds': metric.seconds,
+                           'max_seconds': metric.max_seconds,
+                           'buckets': {str(bound): count for bound, count in zip(BUCKETS, metric.buckets)}}
+                    for name, metric in sorted(self.metrics.items())}
+
+    # Prometheus text exposition format, the histogram buckets are cumulative
+    def to_prometheus(self):
+        lines = ['# TYPE photostore_operation_seconds histogram',
+                 '# TYPE photostore_operation_bytes_total counter']
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, metric.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('photostore_operation_seconds_bucket{{operation="{}",le="{}"}} {}'.format(
+                        name, le, cumulative))
+                lines.append('photostore_operation_seconds_sum{{operation="{}"}} {}'.format(name, metric.seconds))
+                lines.append('photostore_operation_seconds_count{{operation="{}"}} {}'.format(name, metric.count))
+                lines.append('photostore_operation_bytes_total{{operation="{}"}} {}'.format(name, metric.bytes))
+        return '\n'.join(lines) + '\n'
+
+    # Write the metrics to a file, as JSON if the name ends in .json otherwise as Prometheus text
+    def write(self, metrics_file):
+        with open(metrics_file, 'w') as fh:
+            if metrics_file.endswith('.json'):
+                json.dump(self.to_dict(), fh, indent=2)
+            else:
+                fh.write(self.to_prometheus())
+        logger.info('Metrics written to {}'.format(metrics_file))
+        return
+
+
+registry = Registry()
@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+# The names in use in a destination directory, with the next number to try for each renamed file
+class DirectoryNames:
+    def __init__(self, directory):
+        self.names = set()
+        self.counters = dict()
+        if os.path.isdir(directory):
+            with os.scandir(directory) as entries:
+                self.names = {entry.name for entry in entries}
+
+
+# Hands out unused file names in the destination directories. Each directory is read once, the first time a file is
+# placed in it, and the names are tracked in memory from then on. A clash is renamed by inserting a number before
+# the extension, carrying on from the last number used for that name so it doesn't probe from 1 each time. When
+# other processes are storing into the same directories the names are reserved by creating an empty file, which the
+# copy then replaces
+class NameRegistry:
+    def __init__(self, exclusive=False):
+        self.directories = dict()
+        self.exclusive = exclusive
+        self.lock = threading.Lock()
+
+    # Reserve a name for the file, returns the path to use and ' (renamed)' if it had to be changed. When names are
+    # exclusive, begin is called with each name before its empty file is created and cancel if it was already taken
+    def reserve(self, file, begin=None, cancel=None):
+        directory, name = os.path.split(file)
+        with self.lock:
+            names = self.directories.get(directory)
+            if names is None:
+                logger.debug('Reading names in %s', directory)
+                names = self.directories[directory] = DirectoryNames(directory)
+            if name not in names.names and self.create(file, begin, cancel):
+                names.names.add(name)
+                return file, ''
+            names.names.add(name)
+            root, ext = os.path.splitext(name)
+            incr = names.counters.get(name, 1)
+            while True:
+                new_name = '{}.{}{}'.format(root, incr, ext)
+                incr += 1
+                if new_name not in names.names and self.create(os.path.join(directory, new_name), begin, cancel):
+                    break
+                # Taken by another process since the directory was read
+                names.names.add(new_name)
+            names.counters[name] = incr
+            names.names.add(new_name)
+        return os.path.join(directory, new_name), ' (renamed)'
+
+    # Create the reserved file if names are exclusive, returns False if another process already has the name
+    def create(self, file, begin=None, cancel=None):
+        if not self.exclusive:
+            return True
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        if begin is not None:
+            begin(file)
+        try:
+            os.close(os.open(file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            if cancel is not None:
+                cancel(file)
+            return False
+        return True
+
+    # Give back a name that wasn't used after all
+    def release(self, file):
+        directory, name = os.path.split(file)
+        with self.lock:
+            names = self.directories.get(directory)
+            if names is not None:
+                names.names.discard(name)
+        # Only the empty reserved file is removed, not one a copy has already replaced
+        if self.placeholder(file):
+            os.remove(file)
+        return
+
+    # Check whether a name is still held by its empty reserved file
+    def placeholder(self, file):
+        return self.exclusive and os.path.isfile(file) and os.path.getsize(file) == 0
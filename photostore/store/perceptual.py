@@ -0,0 +1,229 @@
+import functools
+import itertools
+import logging
+import threading
+import warnings
+try:
+    import numpy
+    from PIL import Image, ImageOps
+except ImportError:
+    numpy = None
+from store import metrics
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Ways of dealing with a new photo that looks like one already stored, off, a warning in the log or storing it in
+# the review directory
+NEAR_DUP_MODES = ['off', 'log', 'review']
+# Hashes within this many bits of each other are taken to be the same picture
+DEFAULT_DISTANCE = 8
+# Stored for files that can't be read as an image, so they aren't tried again
+NOT_AN_IMAGE = ''
+# The hashes are split into this many chunks for searching
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+# Perceptual hashing needs numpy and Pillow, which are only installed where near duplicate checking is wanted
+def available():
+    return numpy is not None
+
+
+# Difference hash of an image, 64 bits as 16 hex digits, None if it can't be read as an image. The image is cut
+# down to 9x8 greys and each bit says whether a pixel is brighter than the one to its right, so the hash survives
+# resizing, re-encoding and small colour changes. JPEGs are decoded at a reduced scale, which is much quicker than
+# decoding the whole image
+def photo_phash(file, size=8):
+    return image_phash(file, size)[0]
+
+
+# The difference hash of an image along with its size in pixels, (None, None) if it can't be read as an image
+def image_phash(file, size=8):
+    start = metrics.registry.start()
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(file) as image:
+                pixels = image.width * image.height
+                image.draft('L', (size * 8, size * 8))
+                image = ImageOps.exif_transpose(image).convert('L').resize((size + 1, size), Image.BILINEAR)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        return None, None
+    grid = numpy.asarray(image, dtype=numpy.int16)
+    bits = grid[:, 1:] > grid[:, :-1]
+    metrics.registry.record('phash', start)
+    return numpy.packbits(bits).tobytes().hex(), pixels
+
+
+# Number of bits that differ between two hashes
+def distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+# Masks with up to radius of the bits of a chunk set, for finding the chunk values within radius of another
+@functools.lru_cache(maxsize=None)
+def flip_masks(radius):
+    return [sum(1 << bit for bit in bits) for count in range(radius + 1)
+            for bits in itertools.combinations(range(CHUNK_BITS), count)]
+
+
+# Multi-index hash table over 64 bit hashes. Each hash is split into chunks of CHUNK_BITS bits with a table for each
+# chunk. Two hashes within k bits of each other must have a chunk within k // CHUNKS bits, so a search only has to
+# look up the chunk values that close to the query's and check the hashes found there, rather than every hash
+class HammingIndex:
+    def __init__(self):
+        self.values = []
+        self.items = []
+        self.tables = [dict() for _ in range(CHUNKS)]
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value, item):
+        number = len(self.values)
+        self.values.append(value)
+        self.items.append(item)
+        for table, chunk in zip(self.tables, chunks(value)):
+            table.setdefault(chunk, []).append(number)
+        return
+
+    # Return (distance, item) for everything within k of the value, closest first
+    def find(self, value, k):
+        masks = flip_masks(k // CHUNKS)
+        checked = set()
+        matches = []
+        for table, chunk in zip(self.tables, chunks(value)):
+            for mask in masks:
+                for number in table.get(chunk ^ mask, ()):
+                    if number in checked:
+                        continue
+                    checked.add(number)
+                    value_distance = distance(value, self.values[number])
+                    if value_distance <= k:
+                        matches.append((value_distance, self.items[number]))
+        return sorted(matches)
+
+
+# Split a hash into its chunks
+def chunks(value):
+    return [(value >> (index * CHUNK_BITS)) & CHUNK_MASK for index in range(CHUNKS)]
+
+
+# A new photo from this run kept in the library while it's compared with the rest of the run. Of two that look
+# alike the one with more pixels is kept, then the larger file, then the first by source name, so the same one is
+# kept whatever order they're stored in
+class Kept:
+    def __init__(self, photo, pixels):
+        self.fullname = photo.fullname
+        self.size = photo.size
+        self.pixels = pixels or 0
+        # Where it was stored and its content hash, once it has been
+        self.file = None
+        self.hash = None
+        # Set when a better photo has replaced it, or it wasn't stored after all
+        self.replaced = False
+        self.done = threading.Event()
+
+    def outranks(self, other):
+        return (self.pixels, self.size, other.fullname) > (other.pixels, other.size, self.fullname)
+
+    # The photo has been stored, or None if it wasn't
+    def stored(self, file, photo_hash=None):
+        self.file = file
+        self.hash = photo_hash
+        self.done.set()
+        return
+
+    # Wait for the photo to be stored, returns where it was or None
+    def wait(self):
+        self.done.wait()
+        return self.file
+
+
+# Perceptual hashes of the library and of the photos kept from this run, for finding a stored photo a new one looks
+# like. The library is loaded from the catalog once, photos are only added once they've been stored
+class NearDuplicateIndex:
+    def __init__(self, catalog, max_distance=DEFAULT_DISTANCE, replace=False):
+        self.catalog = catalog
+        self.max_distance = max_distance
+        # Whether a photo from this run is replaced by a better one that turns up later in the run
+        self.replace = replace
+        self.hashes = HammingIndex()
+        self.kept = HammingIndex()
+        self.lock = threading.Lock()
+
+    def load(self):
+        for path, phash in self.catalog.phashes():
+            self.hashes.add(int(phash, 16), path)
+        logger.debug('Loaded {} perceptual hashes'.format(len(self.hashes)))
+        return self
+
+    # Read the library's hashes again from the catalog, after files have been taken out of it
+    def reload(self):
+        hashes = HammingIndex()
+        for path, phash in self.catalog.phashes():
+            hashes.add(int(phash, 16), path)
+        with self.lock:
+            self.hashes = hashes
+        return self
+
+    # Compare a new photo with the library and the photos kept from this run. Returns the (distance, file) of the
+    # closest photo it looks like, or None with a Kept for the photo if it's to be stored in the library along with
+    # the photos from this run it replaces
+    def check(self, photo, pixels):
+        value = int(photo.phash, 16)
+        with self.lock:
+            matches = self.hashes.find(value, self.max_distance)
+            if matches:
+                return matches[0], None, []
+            kept = Kept(photo, pixels)
+            replaced = []
+            for distance_found, other in self.kept.find(value, self.max_distance):
+                if other.replaced:
+                    continue
+                if not self.replace or other.outranks(kept):
+                    return (distance_found, other), None, []
+                replaced.append(other)
+            self.kept.add(value, kept)
+            for other in replaced:
+                other.replaced = True
+        return None, kept, replaced
+
+    # Where the photo found by check is stored, waiting for it if it's from this run and still being stored
+    def location(self, item):
+        if isinstance(item, Kept):
+            return item.wait() or item.fullname
+        return item
+
+    # A photo that was to replace others wasn't stored, so they stay
+    def failed(self, kept, replaced):
+        with self.lock:
+            for other in replaced:
+                other.replaced = False
+            kept.replaced = True
+        kept.stored(None)
+        return
+
+    # Treat the photos kept so far as library photos, so a long running ingest doesn't hold on to them. Only to be
+    # called between runs, once everything has been stored
+    def reset(self):
+        with self.lock:
+            for value, kept in zip(self.kept.values, self.kept.items):
+                if kept.file is not None and not kept.replaced:
+                    self.hashes.add(value, kept.file)
+            self.kept = HammingIndex()
+        return
+
+    # Record the hash of a stored photo in the catalog
+    def store(self, file, phash):
+        self.catalog.put_phash(file, phash if phash is not None else NOT_AN_IMAGE)
+        return
@@ -1,8 +1,12 @@
 import hashlib
+import json
 import logging
+import threading
+import warnings
 import exiftool
 import datetime
 import os
+from store import metrics
 
 
 # Setup logging
@@ -27,23 +31,161 @@ def photo_hash(file):
         return hashlib.file_digest(fh, 'sha256').hexdigest()
 
 
-# Extract image/movie metadata
-def photo_metadata(exif_exe, file):
-    with exiftool.ExifToolHelper(executable=exif_exe) as et:
+# Generate a quick fingerprint from the size and the first and last blocks of the file
+def photo_fingerprint(file, size, block_size=65536):
+    fingerprint = hashlib.sha256(str(size).encode())
+    with open(file, 'rb', buffering=0) as fh:
+        fingerprint.update(fh.read(block_size))
+        if size > block_size:
+            fh.seek(max(block_size, size - block_size))
+            fingerprint.update(fh.read(block_size))
+    return fingerprint.hexdigest()
+
+
+# Date tags used by Photo.extract_date, these are the only tags requested from exiftool
+DATE_TAGS = ['File:FileModifyDate', 'File:FileCreateDate', 'EXIF:DateTimeOriginal', 'QuickTime:CreateDate',
+             'QuickTime:MediaCreateDate', 'QuickTime:CreationDate']
+
+
+# Long-lived exiftool process shared by an ingest run, metadata is requested in batches of files
+class MetadataSession:
+    def __init__(self, exif_exe, batch_size=100, timeout=60):
+        self.exif_exe = exif_exe
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.restarts = 0
+        self.helper = None
+        self.busy = threading.Event()
+        self.closed = threading.Event()
+        self.watchdog = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Start the exiftool process and the thread watching it
+    def start(self):
+        logger.debug('Starting exiftool {}'.format(self.exif_exe))
+        self.helper = exiftool.ExifToolHelper(executable=self.exif_exe)
+        self.helper.run()
+        if self.watchdog is None:
+            self.watchdog = threading.Thread(target=self.watch, daemon=True)
+            self.watchdog.start()
+
+    # Stop the exiftool process
+    def close(self):
+        self.closed.set()
+        if self.helper is not None:
+            # A process restarted by a worker thread will have exited along with that thread
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                try:
+                    self.helper.terminate()
+                except (exiftool.exceptions.ExifToolException, OSError, ValueError):
+                    pass
+            self.helper = None
+
+    # Kill and start a new exiftool process
+    def restart(self):
+        logger.warning('Restarting exiftool')
+        self.restarts += 1
+        helper = self.helper
+        self.helper = None
+        if helper is not None:
+            try:
+                helper._process.kill()
+                helper._process.wait(self.timeout)
+            except (AttributeError, OSError):
+                pass
+        self.start()
+
+    # pyexiftool spins forever reading the pipes of a process that died mid-command, closing them breaks it out
+    def watch(self):
+        while not self.closed.wait(0.5):
+            helper = self.helper
+            if not self.busy.is_set() or helper is None or helper._process is None:
+                continue
+            if helper._process.poll() is not None:
+                logger.warning('Exiftool exited with status {}'.format(helper._process.returncode))
+                for pipe in [helper._process.stdout, helper._process.stderr]:
+                    try:
+                        pipe.close()
+                    except OSError:
+                        pass
+
+    # Return the date tags for each file, in the same order as the files, None where the file couldn't be read
+    def get_metadata(self, files):
+        metadata = []
+        for index in range(0, len(files), self.batch_size):
+            metadata.extend(self.get_batch(files[index:index + self.batch_size]))
+        return metadata
+
+    # Query a single batch, splitting it up if exiftool keeps crashing on it
+    def get_batch(self, files):
+        start = metrics.registry.start()
         try:
-            return et.get_metadata(file)[0]
-        except exiftool.exceptions.ExifToolExecuteError:
-            return [None]
+            output = self.execute(files)
+        except (exiftool.exceptions.ExifToolProcessStateError, OSError, ValueError):
+            self.restart()
+            try:
+                output = self.execute(files)
+            except (exiftool.exceptions.ExifToolProcessStateError, OSError, ValueError):
+                self.restart()
+                # A single file is crashing exiftool, treat it as bad
+                if len(files) == 1:
+                    logger.error('Exiftool crashed reading {}'.format(files[0]))
+                    return [None]
+                middle = len(files) // 2
+                return self.get_batch(files[:middle]) + self.get_batch(files[middle:])
+
+        metrics.registry.record('exiftool_batch', start)
+        # Match the results back up against the requested files
+        results = dict()
+        for data in output:
+            results[data.get('SourceFile')] = data
+        return [results.get(file) for file in files]
+
+    # Run exiftool against the files, files it can't read are left out of the output
+    def execute(self, files):
+        if self.helper is None or not self.helper.running:
+            raise exiftool.exceptions.ExifToolNotRunning('Exiftool is not running')
+        self.busy.set()
+        try:
+            return self.helper.get_tags(files, DATE_TAGS)
+        except exiftool.exceptions.ExifToolExecuteError as e:
+            # Exit status is non-zero if any of the files failed, the rest of the output is still good
+            try:
+                return json.loads(e.stdout) if e.stdout else []
+            except ValueError:
+                return []
+        except exiftool.exceptions.ExifToolOutputEmptyError:
+            return []
+        finally:
+            self.busy.clear()
 
 
 # Photo class
 class Photo:
-    def __init__(self, name, path):
+    def __init__(self, name, path, fullname=None, entry=None):
         self.name = name
         self.path = path
-        self.fullname = None
+        self.fullname = fullname
+        # Directory entry the file was found through and its stat result
+        self.entry = entry
+        self.stat = None
         self.size = None
         self.hash = None
+        self.metadata = None
+        # What to do with the file, and the file it duplicates
+        self.status = None
+        self.original = None
+        # Perceptual hash and size in pixels, and the (distance, file) of the stored photo it looks like
+        self.phash = None
+        self.pixels = None
+        self.similar = None
         self.file_create_date = None
         self.file_modify_date = None
         self.exif_original_date = None
@@ -59,10 +201,19 @@ class Photo:
     def set_size(self, size):
         self.size = size
 
+    # Store the stat result and the file size from it
+    def set_stat(self, stat):
+        self.stat = stat
+        self.size = stat.st_size
+
     # Store the file hash
     def set_hash(self, filehash):
         self.hash = filehash
 
+    # Store the exiftool metadata
+    def set_metadata(self, metadata):
+        self.metadata = metadata
+
     # Store the creation date
     def set_file_create_date(self, date):
         self.file_create_date = date
@@ -117,7 +268,8 @@ class Photo:
             self.exif_tag = 'QuickTime:CreateDate'
         # If neither of the above work then use the file create date if it's older than the modify date
         # this is because the modify date can be changed when the file is copied or moved
-        elif self.file_create_date < self.file_modify_date:
+        # (exiftool doesn't have a create date on every platform)
+        elif self.file_create_date is not None and self.file_create_date < self.file_modify_date:
             date = self.file_create_date
             self.exif_tag = 'File:FileCreateDate'
         # All else fails use the modify date
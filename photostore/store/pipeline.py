@@ -0,0 +1,131 @@
+import logging
+import queue
+import threading
+import time
+from store import metrics
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Marks the end of the work in a queue
+DONE = object()
+
+
+# A single step of the pipeline
+# func is called with one item, or a list of up to batch items, and returns what to pass to the next stage. None
+# drops the item, a batch stage returns a list and a fanout stage returns an iterable of items. If func raises,
+# on_error is called with each of the items that are dropped
+class Stage:
+    def __init__(self, name, func, workers=1, batch=None, fanout=False, on_error=None):
+        self.name = name
+        self.func = func
+        self.on_error = on_error
+        self.workers = max(1, workers)
+        self.batch = batch
+        self.fanout = fanout
+        self.errors = 0
+        # Items taken in and seconds spent in func, across all the workers
+        self.items = 0
+        self.busy = 0.0
+
+
+# Stages run by their own threads, connected by bounded queues so a slow stage holds back the ones before it
+class Pipeline:
+    def __init__(self, stages, queue_size=100):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+
+    # Feed the items through every stage, returns once the last stage has finished
+    def run(self, items):
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            inbox = queues[index]
+            outbox = queues[index + 1] if index + 1 < len(self.stages) else None
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self.work, args=(index, inbox, outbox, remaining),
+                                          name='{}-{}'.format(stage.name, worker), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        # Load the first queue, then tell its workers there is nothing else coming. If the items fail part way, what's
+        # already queued is finished before the error is passed on, so no worker is left running
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(DONE)
+            for thread in threads:
+                thread.join()
+        return sum(stage.errors for stage in self.stages)
+
+    # Log how many items each stage took in and how long its workers were busy
+    def report(self):
+        for stage in self.stages:
+            logger.info('{} stage: {} items, {:.2f}s busy, {} workers'.format(stage.name, stage.items, stage.busy,
+                                                                           stage.workers))
+        return
+
+    # Worker loop for a stage
+    def work(self, index, inbox, outbox, remaining):
+        stage = self.stages[index]
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                break
+            items = [item]
+            # Grab whatever else is already waiting to fill up a batch
+            finished = False
+            while stage.batch and len(items) < stage.batch:
+                try:
+                    item = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is DONE:
+                    finished = True
+                    break
+                items.append(item)
+
+            start = time.monotonic()
+            try:
+                result = stage.func(items) if stage.batch else stage.func(items[0])
+                if outbox is not None and result is not None:
+                    for output in (result if stage.batch or stage.fanout else [result]):
+                        if output is not None:
+                            # Time spent waiting on a full queue belongs to the next stage
+                            waiting = time.monotonic()
+                            outbox.put(output)
+                            start += time.monotonic() - waiting
+            except Exception:
+                logger.exception('{} stage failed'.format(stage.name))
+                with self.lock:
+                    stage.errors += 1
+                if stage.on_error is not None:
+                    for item in items:
+                        stage.on_error(item)
+            busy = time.monotonic() - start
+            metrics.registry.observe('stage_' + stage.name, busy)
+            with self.lock:
+                stage.items += len(items)
+                stage.busy += busy
+            if finished:
+                break
+
+        # The last worker out of the stage closes the next queue
+        with self.lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1].workers):
+                outbox.put(DONE)
+        return
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import threading
+from store import catalog, index, journal, names, photos, transfer
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+PLAN_VERSION = 1
+
+
+# Ingest plan written by a store run with --plan, one JSON object per line after a header. Each entry has the
+# decision made for a source file, where it should go and what the file looked like when it was planned
+class PlanWriter:
+    def __init__(self, plan_file, source, destination):
+        self.destination = destination
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.fh = open(plan_file, 'w', encoding='utf-8')
+        self.fh.write(json.dumps({'plan': PLAN_VERSION, 'source': os.path.abspath(source),
+                                  'destination': os.path.abspath(destination)}) + '\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Add the decision for a photo, dest is None for files that are already in the library
+    def add(self, photo, dest):
+        entry = {'status': photo.status, 'source': os.path.abspath(photo.fullname),
+                 'dest': os.path.relpath(dest, self.destination) if dest else None,
+                 'size': photo.stat.st_size, 'mtime_ns': photo.stat.st_mtime_ns, 'inode': photo.stat.st_ino,
+                 'hash': photo.hash, 'directory_date': photo.directory_date, 'exif_tag': photo.exif_tag,
+                 'original': photo.original, 'phash': photo.phash}
+        with self.lock:
+            self.fh.write(json.dumps(entry) + '\n')
+            self.entries += 1
+        return
+
+    def close(self):
+        with self.lock:
+            self.fh.close()
+        logger.info('Planned {} files'.format(self.entries))
+        return
+
+
+# Read a plan, returning the header and the entries
+def read_plan(plan_file):
+    with open(plan_file, 'r', encoding='utf-8') as fh:
+        header = json.loads(fh.readline())
+        if header.get('plan') != PLAN_VERSION:
+            raise ValueError('{} is not a version {} plan'.format(plan_file, PLAN_VERSION))
+        entries = [json.loads(line) for line in fh if line.strip()]
+    return header, entries
+
+
+# Apply a plan to the destination. Every destination directory is created once up front, then the files are copied
+# in source inode order so the reads follow the disk layout as closely as possible. Files that have changed since
+# the plan was made are skipped, and new files are checked against the library again in case they've been stored
+# since. Duplicates are stored according to dup_mode as they are by store. Plans have no near duplicate moves, a
+# smaller photo that store would move to review when a larger one turns up stays in the library
+def execute(plan_file, destination, resume=False, dup_mode='link'):
+    logger.debug('Calling execute')
+    header, entries = read_plan(plan_file)
+    if os.path.abspath(destination) != header['destination']:
+        logger.warning('Plan was made for {}'.format(header['destination']))
+
+    library = catalog.Catalog(destination)
+    decisions = journal.Journal(destination, library.flush).load()
+    decisions.rollback(library)
+    decisions.open(resume)
+    directory_hashes = index.HashIndex(library).load()
+
+    copies = [entry for entry in entries if entry['dest'] is not None and not
+              (entry['status'] == 'dup' and dup_mode == 'catalog')]
+    for directory in sorted({os.path.dirname(entry['dest']) for entry in copies}):
+        os.makedirs(os.path.join(destination, directory), exist_ok=True)
+
+    registry = names.NameRegistry()
+    copied = recorded = skipped = errors = 0
+    try:
+        # Duplicates go last so the library copy they link to is in place
+        for entry in sorted(copies, key=lambda entry: (entry['status'] == 'dup', entry['inode'])):
+            photo = plan_photo(entry)
+            if photo is None:
+                skipped += 1
+                continue
+            if decisions.finished(photo):
+                logger.debug('%s already processed', photo.fullname)
+                continue
+            if photo.status == 'new' and photo.hash in directory_hashes:
+                photo.status = 'exists'
+                photo.original = directory_hashes[photo.hash]
+                logger.info('%s already exists %s', photo.fullname, photo.original)
+                directory_hashes.add_duplicate(photo, photo.original)
+                decisions.done(photo, photo.original)
+                continue
+
+            # The name may have been taken since the plan was made
+            dest_path, renamed = registry.reserve(os.path.join(destination, entry['dest']))
+            original = directory_hashes.get(photo.hash) if photo.status == 'dup' else None
+            try:
+                decisions.begin(photo, dest_path)
+                if original is not None and dup_mode == 'link':
+                    transfer.link_file(original, dest_path)
+                else:
+                    photo.set_hash(transfer.copy_file(photo.fullname, dest_path, photo.hash))
+                if photo.status == 'new':
+                    directory_hashes.add(photo.hash, dest_path, photo.directory_date, photo.exif_tag)
+                    if photo.phash is not None:
+                        library.put_phash(dest_path, photo.phash)
+                elif original is not None:
+                    directory_hashes.add_duplicate(photo, original, dest_path)
+                decisions.done(photo, dest_path)
+            except (OSError, ValueError) as e:
+                logger.error('Failed to copy {}: {}'.format(photo.fullname, e))
+                registry.release(dest_path)
+                errors += 1
+                continue
+            copied += 1
+            logger.info('%s copied to %s%s', photo.fullname, dest_path, renamed)
+
+        # Files already in the library are only recorded, after the copies so an original that is new in this plan
+        # is in place
+        for entry in entries:
+            if entry['dest'] is not None and not (entry['status'] == 'dup' and dup_mode == 'catalog'):
+                continue
+            photo = plan_photo(entry)
+            if photo is None:
+                skipped += 1
+                continue
+            if decisions.finished(photo):
+                logger.debug('%s already processed', photo.fullname)
+                continue
+            original = directory_hashes.get(photo.hash)
+            if original is None:
+                logger.error('{} has no library copy to record it against'.format(photo.fullname))
+                errors += 1
+                continue
+            directory_hashes.add_duplicate(photo, original)
+            decisions.done(photo, original)
+            recorded += 1
+            if photo.status == 'dup':
+                logger.info('%s is duplicate of %s', photo.fullname, original)
+            else:
+                logger.info('%s already exists %s', photo.fullname, original)
+    finally:
+        directory_hashes.save()
+        directory_hashes.close()
+        library.flush()
+        decisions.close()
+        library.close()
+    logger.info('{} files copied, {} recorded, {} skipped as changed, {} failed'.format(copied, recorded, skipped,
+                                                                                        errors))
+    transfer.stats.report()
+    return
+
+
+# Rebuild the photo for a plan entry, None if the source has gone or changed since it was planned
+def plan_photo(entry):
+    try:
+        stat = os.stat(entry['source'])
+    except OSError as e:
+        logger.warning('{} is no longer available: {}'.format(entry['source'], e))
+        return None
+    if stat.st_size != entry['size'] or stat.st_mtime_ns != entry['mtime_ns']:
+        logger.warning('{} has changed since it was planned'.format(entry['source']))
+        return None
+    photo = photos.Photo(os.path.basename(entry['source']), os.path.dirname(entry['source']), entry['source'])
+    photo.set_stat(stat)
+    photo.set_hash(entry['hash'])
+    photo.status = entry['status']
+    photo.original = entry['original']
+    photo.directory_date = entry['directory_date']
+    photo.exif_tag = entry['exif_tag']
+    photo.phash = entry.get('phash')
+    return photo
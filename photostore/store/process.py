@@ -1,9 +1,11 @@
+import functools
 import logging
 import os
-import pickle
-import concurrent.futures
-import shutil
-from store import photos
+import queue
+import signal
+import time
+from store import catalog, dedup, hashing, index, journal, metadata, names, perceptual, photos, pipeline, plan, transfer
+from store import shards, walker, watch
 
 
 # Setup logging
@@ -16,124 +18,455 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 
 
+# Stages of the ingest pipeline and their default number of workers
+DEFAULT_WORKERS = {'scan': 1, 'stat': 2, 'hash': 4, 'metadata': 2, 'date': 1, 'similar': 2, 'copy': 2}
+# Ways of storing duplicates, as a link to the library copy, a copy of their own or only a catalog entry
+DUP_MODES = ['link', 'copy', 'catalog']
+# Most files handed to the pipeline at once in watch mode
+WATCH_BATCH = 1000
+# In watch mode the hash snapshot is brought up to date once this many files have been stored since it was made, or
+# this many seconds have gone by with files stored
+WATCH_SAVE_FILES = 10000
+WATCH_SAVE_SECONDS = 600
+invalid_types = ['.db', '.aae', '.info', '.scn', '.lib', '.ini', '.zip', '.thm', '.log', '.txt', '.pkl']
+
+
 # Process each file in each directory
-def processing(source, destination, dryrun, exiftool):
+def processing(source, destination, dryrun, exiftool, batch_size=100, workers=None, queue_size=100, jobs=None,
+               native=True, resume=False, plan_file=None, dup_mode='link', watch_source=False, settle=2.0, poll=None,
+               near_dup='off', near_distance=perceptual.DEFAULT_DISTANCE, coordinator=None):
     logger.debug('Calling processing')
-    workers = 5
+    workers = dict(DEFAULT_WORKERS, **(workers or dict()))
 
     # Set variables
     dup_path = os.path.join(destination, 'Dup')
     bad_path = os.path.join(destination, 'Bad')
-    master_hashes = dict()
-    directory_hashes = dict()
-
-    # Create list of all the source directories
-    src_paths = [dir.path for dir in os.scandir(source) if dir.is_dir()]
-
-    # Create list of all the destination directories
-    dest_paths = [dir.path for dir in os.scandir(destination) if dir.is_dir()]
-    # Remote the duplicate and bad paths - don't want to process these
-    if dup_path in dest_paths:
-        dest_paths.remove(dup_path)
-    if bad_path in dest_paths:
-        dest_paths.remove(bad_path)
-
-    # Go through all the existing directories and read the file hashes and place them into the directory hash
-    for path in dest_paths:
-        hash_file = os.path.join(path, 'file_hash.pkl')
-        if os.path.isfile(hash_file):
-            with open(hash_file, 'rb') as f:
-                hash_map = pickle.load(f)
-        directory_hashes.update(hash_map)
-
-    # Process all the source directories
-    for path in src_paths:
-        process_files(path, destination, dryrun, exiftool, dup_path, bad_path, master_hashes, directory_hashes)
+    review_path = os.path.join(destination, 'Review')
+
+    # Making a plan is a dry run that records its decisions
+    planner = None
+    if plan_file is not None:
+        dryrun = True
+        planner = plan.PlanWriter(plan_file, source, destination)
+
+    # Load the hashes of everything already in the destination
+    library = catalog.Catalog(destination, create=not dryrun)
+    # Undo any copies left part way through by the last run before anything else is loaded. The journal is only
+    # written once the catalog entries for its decisions have been committed. With shards each shard has a journal of
+    # its own, opened as the shard is leased
+    decisions = None
+    if not dryrun and coordinator is None:
+        decisions = open_journal(destination, library, resume=resume)[0]
+    directory_hashes = index.HashIndex(library, writable=not dryrun).load()
+    # Full hashes are worked out by the hash stage workers, or handed off to a pool of processes
+    scheduler = hashing.HashScheduler(jobs) if jobs else None
+    detector = dedup.DuplicateDetector(library, directory_hashes, scheduler.hash if scheduler else photos.photo_hash)
+    # New photos are compared with the perceptual hashes of the library when looking for near duplicates
+    near_index = None
+    if near_dup != 'off':
+        near_index = perceptual.NearDuplicateIndex(library, near_distance, near_dup == 'review').load()
+
+    # Each metadata worker gets its own exiftool process, started from this thread as exiftool is set to exit
+    # along with the thread that started it
+    sessions = queue.Queue()
+    for _ in range(workers['metadata']):
+        session = photos.MetadataSession(exiftool, batch_size)
+        session.start()
+        sessions.put(session)
+
+    ingest = Ingest(destination, dryrun, sessions, dup_path, bad_path, directory_hashes, detector, native,
+                    decisions, planner, dup_mode, near_index, near_dup, review_path, coordinator)
+    stages = [pipeline.Stage('scan', ingest.scan, workers['scan'], fanout=True),
+              pipeline.Stage('stat', ingest.stat, workers['stat']),
+              pipeline.Stage('hash', ingest.hash, workers['hash']),
+              pipeline.Stage('metadata', ingest.metadata, workers['metadata'], batch=batch_size, on_error=ingest.drop),
+              pipeline.Stage('date', ingest.date, workers['date'], on_error=ingest.drop),
+              pipeline.Stage('copy', ingest.copy, workers['copy'], on_error=ingest.drop)]
+    if near_index is not None:
+        stages.insert(-1, pipeline.Stage('similar', ingest.similar, workers['similar'], on_error=ingest.drop))
+    ingest_pipeline = pipeline.Pipeline(stages, queue_size)
+    try:
+        if watch_source:
+            errors = watching(source, ingest_pipeline, ingest, library, settle, poll)
+        elif coordinator is not None:
+            errors = sharding(source, ingest_pipeline, ingest, library, coordinator)
+        else:
+            # The top of the source tree, each directory is walked by one of the scan workers
+            errors = ingest_pipeline.run(walker.top_level(source, invalid_types))
+    finally:
+        while not sessions.empty():
+            sessions.get().close()
+        if scheduler is not None:
+            scheduler.close()
+        # Commit the newly stored files for the next run, then the decisions that depend on them
+        if not dryrun:
+            directory_hashes.save()
+        directory_hashes.close()
+        library.flush()
+        if decisions is not None:
+            decisions.close()
+        if planner is not None:
+            planner.close()
+        library.close()
+    if errors:
+        logger.error('{} files failed to process'.format(errors))
+    ingest_pipeline.report()
+    transfer.stats.report()
 
     return
 
 
-# Check file doesn't already exist in target directory and return a suitable new name
-def check_file(file):
-    logger.debug('Checking file already exists')
-    tmp_file = file
-    incr = 1
-    renamed = ''
-    # Check if the file already exists then insert an incrementer into the file name keep checking until we
-    # have a unique name
-    while os.path.exists(tmp_file):
-        root, ext = os.path.splitext(file)
-        tmp_file = root + '.' + str(incr) + ext
-        incr += 1
-        renamed = ' (renamed)'
-    return tmp_file, renamed
-
-
-def process_files(path, destination, dryrun, exiftool, dup_path, bad_path, master_hashes, directory_hashes):
-    logger.debug('Processing directory {}'.format(path))
-    invalid_types = ['.db', '.aae', '.info', '.scn', '.lib', '.ini', '.zip', '.thm', '.log', '.txt', '.pkl']
-
-    files = [file for file in os.scandir(path) if file.is_file()]
-    for file in files:
-        # Ignore invalid file types
-        if os.path.splitext(file.name)[1].lower() in invalid_types:
-            continue
-
-        logger.debug('Processing file {}'.format(file.name))
-        # Pull file size, hash and metadata
-        photo_size = photos.photo_size(file.path)
-        photo_hash = photos.photo_hash(file.path)
-        photo_data = photos.photo_metadata(exiftool, file.path)
-
-        # If file size is 0 then the file is bad
-        if photo_size == 0:
-            bad_file = os.path.join(bad_path, file.name)
-            bad_file, renamed = check_file(bad_file)
-            if not dryrun:
-                shutil.copy2(file.path, bad_file)
-            logger.info('{} is empty{}'.format(file.path, renamed))
+# Read the journal left by the last run, undo the copies it was part way through and open it for this run. Returns the
+# journal and whether anything was rolled back
+def open_journal(destination, library, journal_file=None, resume=False):
+    decisions = journal.Journal(destination, library.flush, journal_file).load()
+    rolled_back = bool(decisions.unfinished)
+    decisions.rollback(library)
+    decisions.open(resume)
+    return decisions, rolled_back
+
+
+# Store each shard of the source this worker can lease. The shards all go through the same pipeline, so the catalog,
+# hash index and exiftool sessions are only set up once. Each shard has its own journal, so a worker taking over a
+# shard from one that died rolls back only that shard's copies before resuming it
+def sharding(source, ingest_pipeline, ingest, library, coordinator):
+    errors = 0
+    for shard in coordinator.leases():
+        ingest.decisions, rolled_back = open_journal(ingest.destination, library, coordinator.journal_file(shard),
+                                                     resume=True)
+        try:
+            # The files rolled back may already have been loaded
+            if rolled_back:
+                ingest.reload()
+            errors += ingest_pipeline.run(shards.shard_entries(source, invalid_types, shard, coordinator.shards))
+            ingest.reset()
+        finally:
+            # The shard's decisions are committed before it's marked done
+            library.flush()
+            ingest.decisions.close()
+            ingest.decisions = None
+    return errors
+
+
+# Keep ingesting files as they arrive in the source until interrupted. Each batch of settled files goes through the
+# same pipeline, so the catalog, hash index and exiftool sessions stay loaded between batches. Everything a batch
+# adds is committed once it's done, so what's held in memory and the journal don't grow the longer it runs
+def watching(source, ingest_pipeline, ingest, library, settle=2.0, poll=None):
+    errors = 0
+    last_save = time.monotonic()
+    with watch.Watcher(source, invalid_types, settle, poll) as watcher:
+        # Finish the batch in progress rather than leaving the pipeline part way through
+        handlers = {signum: signal.signal(signum, lambda signum, frame: watcher.stop())
+                    for signum in (signal.SIGINT, signal.SIGTERM)}
+        logger.info('Watching {} for new files'.format(source))
+        try:
+            for batch in watcher.batches(WATCH_BATCH):
+                logger.info('Ingesting {} new files'.format(len(batch)))
+                errors += ingest_pipeline.run(batch)
+                ingest.reset()
+                # Commit the batch so it's kept if the process is killed, after which its journal isn't needed
+                library.flush()
+                if ingest.decisions is not None:
+                    ingest.decisions.truncate()
+                # Move the files stored so far from memory into the snapshot
+                stored = len(ingest.directory_hashes.hashes)
+                if ingest.decisions is not None and stored and (stored >= WATCH_SAVE_FILES or
+                                                                time.monotonic() - last_save >= WATCH_SAVE_SECONDS):
+                    ingest.directory_hashes.save()
+                    last_save = time.monotonic()
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        logger.info('Stopped watching {}'.format(source))
+    return errors
+
+
+# Stage functions for the ingest pipeline, duplicates are decided in the hash stage so only new files go to exiftool
+class Ingest:
+    def __init__(self, destination, dryrun, sessions, dup_path, bad_path, directory_hashes, detector, native=True,
+                 decisions=None, planner=None, dup_mode='link', near_index=None, near_dup='off', review_path=None,
+                 claims=None):
+        self.destination = destination
+        self.dryrun = dryrun
+        self.sessions = sessions
+        self.dup_path = dup_path
+        self.bad_path = bad_path
+        self.directory_hashes = directory_hashes
+        self.detector = detector
+        self.native = native
+        self.decisions = decisions
+        self.planner = planner
+        # Duplicates are linked to the library copy, copied or only recorded in the catalog
+        self.dup_mode = dup_mode
+        # Other workers sharing the destination are kept from storing the same content, or using the same names
+        self.claims = claims
+        self.names = names.NameRegistry(exclusive=claims is not None)
+        # Near duplicates of stored photos are logged, or stored in the review directory
+        self.near_index = near_index
+        self.near_dup = near_dup
+        self.review_path = review_path
+
+    # Yield the files below a source directory as they are found, ignoring invalid file types
+    def scan(self, entry):
+        if not entry.is_dir(follow_symlinks=False):
+            yield photos.Photo(entry.name, os.path.dirname(entry.path), entry.path, entry)
+            return
+        logger.debug('Processing directory %s', entry.path)
+        for file in walker.walk_files(entry.path, invalid_types):
+            yield photos.Photo(file.name, os.path.dirname(file.path), file.path, file)
+
+    # Pull file size from the directory entry, if file size is 0 then the file is bad
+    def stat(self, photo):
+        photo.set_stat(photo.entry.stat())
+        photo.entry = None
+        # Files finished by the run being resumed are skipped before they're read
+        if self.decisions is not None and self.decisions.finished(photo):
+            logger.debug('%s already processed', photo.fullname)
+            return None
+        if photo.size == 0:
+            photo.status = 'empty'
+        return photo
+
+    # Check whether the file is a duplicate, the file is only read if there's another file of the same size
+    def hash(self, photo):
+        if photo.status is None:
+            photo.status = self.detector.check(photo)
+        return photo
+
+    # Pull metadata for a batch of new files, read directly from the file where possible otherwise from one of the
+    # exiftool processes
+    def metadata(self, batch):
+        new_photos = []
+        for photo in batch:
+            if photo.status != 'new':
+                continue
+            photo_data = metadata.read_dates(photo.fullname) if self.native else None
+            if photo_data is None:
+                new_photos.append(photo)
+            else:
+                photo.set_metadata(photo_data)
+        if not new_photos:
+            return batch
+        session = self.sessions.get()
+        try:
+            photo_metadata = session.get_metadata([photo.fullname for photo in new_photos])
+        except Exception:
+            logger.exception('Failed to read metadata')
+            photo_metadata = [None] * len(new_photos)
+        finally:
+            self.sessions.put(session)
+        for photo, photo_data in zip(new_photos, photo_metadata):
+            photo.set_metadata(photo_data)
+        return batch
+
+    # Determine the directory date for new files
+    def date(self, photo):
+        if photo.status != 'new':
+            return photo
         # If there is no metadata then the file is bad
-        elif photo_data is None:
-            bad_file = os.path.join(bad_path, file.name)
-            bad_file, renamed = check_file(bad_file)
-            if not dryrun:
-                shutil.copy2(file.path, bad_file)
-            logger.info('{} is bad{}'.format(file.path, renamed))
-        # If current hash in the list of master hashes
-        elif photo_hash in master_hashes:
-            dup_file = os.path.join(dup_path, file.name)
-            dup_file, renamed = check_file(dup_file)
-            if not dryrun:
-                shutil.copy2(file.path, dup_file)
-            logger.info('{} is duplicate of {}{}'.format(file.path, master_hashes[photo_hash], renamed))
-        # If the current hash in the list of already stored directory hashes
-        elif photo_hash in directory_hashes:
-            logger.info('{} already exists {}'.format(file.path, directory_hashes[photo_hash]))
+        if photo.metadata is None:
+            photo.status = 'bad'
+            self.detector.release(photo)
+            return photo
+        # A date that can't be read also makes the file bad
+        try:
+            photo.extract_date(photo.metadata)
+            photo.find_date()
+        except ValueError as e:
+            logger.warning('%s has a bad date: %s', photo.fullname, e)
+            photo.status = 'bad'
+            self.detector.release(photo)
+        return photo
+
+    # Work out the perceptual hash of a new photo, it's compared with the stored photos when it's copied
+    def similar(self, photo):
+        if photo.status == 'new':
+            photo.phash, photo.pixels = perceptual.image_phash(photo.fullname)
+        return photo
+
+    # Copy the file to the right place. A new photo that replaces near duplicates stored earlier in the run has them
+    # moved to the review directory once it's in place
+    def copy(self, photo):
+        logger.debug('Processing file %s', photo.name)
+        claimed = photo.status == 'new' and self.claims is not None and self.claim(photo)
+        kept, replaced = self.compare(photo)
+        try:
+            dest_path = self.place(photo, claimed)
+        except BaseException:
+            # Anything waiting on the photo is let go, and the photos it was to replace stay where they are
+            if kept is not None:
+                self.near_index.failed(kept, replaced)
+            raise
+        if kept is not None:
+            kept.stored(dest_path, photo.hash)
+            for other in replaced:
+                self.replace(other, photo)
+        return
+
+    # Look for a stored photo that a new photo looks like. Returns the photo's Kept if it's going in the library, and
+    # the photos from this run it replaces
+    def compare(self, photo):
+        if photo.status != 'new' or self.near_index is None or photo.phash is None:
+            return None, []
+        similar, kept, replaced = self.near_index.check(photo, photo.pixels)
+        if similar is not None:
+            photo.similar = (similar[0], self.near_index.location(similar[1]))
+            if self.near_dup == 'log':
+                logger.warning('%s looks like %s (distance %s)', photo.fullname, photo.similar[1], photo.similar[0])
+        return kept, replaced
+
+    # Store the file in the right place, the name registry makes sure workers can't pick the same name. Returns where
+    # it went, None if it was only recorded
+    def place(self, photo, claimed):
+        if photo.status == 'empty':
+            dest_path, renamed = self.reserve(os.path.join(self.bad_path, photo.name), photo)
+            message = ('%s is empty%s', photo.fullname, renamed)
+        elif photo.status == 'bad':
+            dest_path, renamed = self.reserve(os.path.join(self.bad_path, photo.name), photo)
+            message = ('%s is bad%s', photo.fullname, renamed)
+        elif photo.status == 'dup' and self.dup_mode == 'catalog':
+            logger.info('%s is duplicate of %s', photo.fullname, photo.original)
+            self.record(photo, self.directory_hashes.get(photo.hash))
+            return None
+        elif photo.status == 'dup':
+            dest_path, renamed = self.reserve(os.path.join(self.dup_path, photo.name), photo)
+            message = ('%s is duplicate of %s%s', photo.fullname, photo.original, renamed)
+        elif photo.status == 'exists':
+            logger.info('%s already exists %s', photo.fullname, photo.original)
+            self.record(photo, photo.original)
+            return None
+        elif photo.status == 'new' and photo.similar is not None and self.near_dup == 'review':
+            dest_path, renamed = self.reserve(os.path.join(self.review_path, photo.name), photo)
+            message = ('%s looks like %s (distance %s), copied to %s for review%s', photo.fullname, photo.similar[1],
+                       photo.similar[0], dest_path, renamed)
         # If the looks ok proceed
         else:
-            # Create object - store size, hash and determine the directory date
-            photo = photos.Photo(file.name, path)
-            photo.set_size(photo_size)
-            photo.set_hash(photo_hash)
-            photo.extract_date(photo_data)
-            photo.find_date()
+            # Build in the destination path to check the file name hasn't already been used for another file
+            dest_dir = os.path.join(self.destination, photo.directory_date)
+            dest_path, renamed = self.reserve(os.path.join(dest_dir, photo.name), photo)
+            message = ('%s copied to %s%s', photo.fullname, dest_path, renamed)
 
-            # Get the directory date and build in the destination path to check the file name hasn't already been
-            # used for another file
-            directory_date = getattr(photo, 'directory_date')
-            dest_dir = os.path.join(destination, directory_date)
-            dest_path = os.path.join(dest_dir, file.name)
-            dest_path, renamed = check_file(dest_path)
+        # If it's a dry run don't create the directory or copy the file
+        try:
+            if not self.dryrun:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                # Exclusive names had the begin record written when they were reserved
+                if not self.names.exclusive:
+                    self.decisions.begin(photo, dest_path)
+                if photo.status == 'dup' and self.dup_mode == 'link':
+                    # Duplicates point at the library copy rather than taking up space of their own
+                    transfer.link_file(self.directory_hashes.get(photo.hash), dest_path)
+                else:
+                    # The full hash of a new file is calculated while it is copied
+                    photo.set_hash(transfer.copy_file(photo.fullname, dest_path, photo.hash))
+            elif photo.status == 'new' and photo.hash is None:
+                photo.set_hash(photos.photo_hash(photo.fullname))
+        except BaseException:
+            # The name is free again if the file wasn't created, a dry run holds on so names stay unique. An empty
+            # reserved file has its begin record cancelled first, so a later rollback can't remove a file another
+            # process has stored under the name since
+            if not self.dryrun:
+                if self.names.placeholder(dest_path):
+                    self.decisions.cancel(dest_path)
+                self.names.release(dest_path)
+            if claimed:
+                self.claims.release_claim(photo.hash)
+            raise
+        if photo.status == 'new':
+            # New files go in the index, duplicates and bad files don't
+            if not self.dryrun:
+                self.directory_hashes.add(photo.hash, dest_path, photo.directory_date, photo.exif_tag)
+                if self.near_index is not None:
+                    self.near_index.store(dest_path, photo.phash)
+                if claimed:
+                    self.claims.placed(photo.hash, dest_path)
+            self.detector.stored(photo)
+        elif photo.status == 'dup' and not self.dryrun:
+            self.directory_hashes.add_duplicate(photo, self.directory_hashes.get(photo.hash), dest_path)
+        if not self.dryrun:
+            self.decisions.done(photo, dest_path)
+        elif self.planner is not None:
+            self.planner.add(photo, dest_path)
+        logger.info(*message)
+        return dest_path
 
-            # If it's a dry run don't create the directory or copy the file
-            if not dryrun:
-                if not os.path.exists(dest_dir):
-                    os.makedirs(dest_dir)
-                shutil.copy2(file.path, dest_path)
+    # Move a photo stored earlier in the run to the review directory, as a better version of it has been stored. A
+    # dry run only logs the move, plans don't include it so executing one keeps both photos in the library
+    def replace(self, other, photo):
+        file = other.wait()
+        if file is None:
+            return
+        if self.dryrun:
+            logger.info('%s would be moved to %s for review, %s looks like it', file, self.review_path, photo.fullname)
+            return
+        # The move is journalled like a copy, so if the process dies part way it's put back
+        review_file, renamed = self.reserve(os.path.join(self.review_path, os.path.basename(file)), other, file)
+        try:
+            os.makedirs(self.review_path, exist_ok=True)
+            if not self.names.exclusive:
+                self.decisions.begin(other, review_file, file)
+            os.replace(file, review_file)
+        except BaseException:
+            if self.names.placeholder(review_file):
+                self.decisions.cancel(review_file)
+            self.names.release(review_file)
+            raise
+        self.names.release(file)
+        self.directory_hashes.move(other.hash, file, review_file)
+        self.decisions.moved(review_file)
+        if self.claims is not None:
+            self.claims.placed(other.hash, review_file)
+        logger.info('%s moved to %s for review, %s looks like it%s', file, review_file, photo.fullname, renamed)
+        return
 
-            logger.info('{} copied to {}{}'.format(file.path, dest_path, renamed))
+    # Claim the content of a new photo, returns whether it's ours to store. If another worker is storing the same
+    # content the photo becomes a duplicate of their copy
+    def claim(self, photo):
+        if photo.hash is None:
+            photo.set_hash(photos.photo_hash(photo.fullname))
+        original = self.claims.claim(photo.hash)
+        if original is None:
+            return True
+        photo.status = 'dup'
+        photo.original = original
+        self.directory_hashes.remember(photo.hash, original)
+        # Anything from this run waiting on the photo is a duplicate of the same copy
+        self.detector.stored(photo)
+        return False
 
-            # Squirrel away the hash and file path
-            master_hashes[photo_hash] = file.path
+    # Record a file whose content is already in the library without storing anything
+    def record(self, photo, original):
+        if not self.dryrun:
+            self.directory_hashes.add_duplicate(photo, original)
+            self.decisions.done(photo, original)
+        elif self.planner is not None:
+            self.planner.add(photo, None)
+        return
 
-    return
+    # Treat everything stored so far as part of the library, between the batches of a watch
+    def reset(self):
+        self.detector.reset()
+        if self.near_index is not None:
+            self.near_index.reset()
+        return
+
+    # Read the library in again, after files have been rolled back out of it
+    def reload(self):
+        self.directory_hashes.reload()
+        if self.near_index is not None:
+            self.near_index.reload()
+        return
+
+    # A stage failed on the photo, anything waiting to compare against it needs to stop waiting
+    def drop(self, photo):
+        if photo.status == 'new':
+            self.detector.release(photo)
+        return
+
+    # Find an unused name for the file. Where names are reserved by creating an empty file, the begin record for the
+    # photo is written before the file is created so it's rolled back if the process dies before the copy
+    def reserve(self, file, photo=None, moved=None):
+        if photo is None or self.dryrun or not self.names.exclusive:
+            return self.names.reserve(file)
+        return self.names.reserve(file, functools.partial(self.decisions.begin, photo, moved=moved),
+                                  self.decisions.cancel)
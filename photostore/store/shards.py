@@ -0,0 +1,327 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import threading
+import time
+import zlib
+from store import walker
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# A lease or worker that hasn't been touched for this many seconds belongs to a worker that has died
+LEASE_SECONDS = 120
+# How long to wait before looking again at content another worker is storing (seconds)
+CLAIM_WAIT = 0.2
+# Filesystems that may be shared between hosts. Leases, claims and the catalog's WAL need every worker on one host
+NETWORK_FILESYSTEMS = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', 'ceph', 'glusterfs', 'lustre',
+                       'gpfs', 'beegfs', 'ocfs2', 'gfs2', '9p', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.cephfs']
+# Directories this many levels below the source are shared out between the shards, along with everything under them
+SHARD_DEPTH = 2
+
+
+# The shard a source directory belongs to, from its path relative to the source so every worker agrees
+def shard_of(directory, shards):
+    return zlib.crc32(os.fsencode(directory)) % shards
+
+
+# Yield the parts of the source that belong to a shard, for the scan stage to walk. Each directory SHARD_DEPTH levels
+# below the source goes to a shard along with everything under it, so a worker only reads the levels above that and
+# its own subtrees. Files in the levels above go to the shard of the directory they're in
+def shard_entries(source, skip_types, shard, shards):
+    stack = [(source, 0)]
+    while stack:
+        directory, depth = stack.pop()
+        ours = shard_of(os.path.relpath(directory, source), shards) == shard
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth + 1 < SHARD_DEPTH:
+                            stack.append((entry.path, depth + 1))
+                        elif shard_of(os.path.relpath(entry.path, source), shards) == shard:
+                            yield entry
+                    elif ours and entry.is_file() and not walker.skipped(entry.name, skip_types):
+                        yield entry
+        except OSError as e:
+            logger.warning('Unable to read {}: {}'.format(directory, e))
+    return
+
+
+# The type of filesystem a path is on, from the mount it's under. None if it can't be told, where there's no
+# /proc/mounts
+def filesystem_type(path):
+    path = os.path.realpath(path)
+    found = None
+    try:
+        with open('/proc/mounts', 'r') as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and the like in mount points are escaped as octal
+                mount_point = fields[1].encode().decode('unicode_escape')
+                if os.path.commonpath([path, mount_point]) == mount_point and \
+                        (found is None or len(mount_point) >= len(found[0])):
+                    found = (mount_point, fields[2])
+    except OSError:
+        return None
+    return found[1] if found is not None else None
+
+
+# Create a file only if it doesn't exist, returns whether it was created
+def create(path, content):
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(content)
+    return True
+
+
+# Read a small file, None if it has gone
+def read(path):
+    try:
+        with open(path, 'r') as fh:
+            return fh.read()
+    except FileNotFoundError:
+        return None
+
+
+# Seconds since a file was last touched, None if it has gone
+def age(path):
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+# Lets several store processes on one host split a source between them. The catalog's write ahead log and the lease
+# and claim files rely on every worker being on the same host, so workers on other hosts are turned away. The source
+# subtrees are divided into shards by a hash of their path. A worker takes a shard by creating its lease
+# file, keeps the lease alive by touching it and marks the shard done once it's stored. A lease that stops being
+# touched has expired and the shard is taken over, with the journal of the worker that died rolled back and resumed.
+# New content is claimed with a file named after its hash, so two workers never store the same content. Once every
+# shard is done the next run starts a new pass. The state is kept in the destination under .shards
+class Coordinator:
+    def __init__(self, destination, source, shards, lease_seconds=LEASE_SECONDS):
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        # Workers splitting the same source the same way share a group
+        group = hashlib.sha256('{}:{}'.format(os.path.abspath(source), shards).encode()).hexdigest()[:12]
+        self.directory = os.path.join(destination, '.shards', group)
+        self.claims_path = os.path.join(self.directory, 'claims')
+        self.host = socket.gethostname()
+        self.worker = '{}-{}-{}'.format(self.host, os.getpid(), os.urandom(3).hex())
+        self.worker_file = os.path.join(self.directory, 'workers', self.worker)
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat_thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Register the worker and start keeping its leases alive
+    def start(self):
+        os.makedirs(self.claims_path, exist_ok=True)
+        os.makedirs(os.path.dirname(self.worker_file), exist_ok=True)
+        create(self.worker_file, self.worker)
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+        logger.info('Worker {} sharing {} shards'.format(self.worker, self.shards))
+        return self
+
+    # Stop the heartbeat, any shard still held wasn't finished so it's handed back for another worker to resume
+    def close(self):
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+        for shard in list(self.held):
+            logger.warning('Giving up shard {} unfinished'.format(shard))
+            self.release(shard)
+        if os.path.exists(self.worker_file):
+            os.remove(self.worker_file)
+        return
+
+    def heartbeat(self):
+        while not self.stopped.wait(self.lease_seconds / 4):
+            with self.lock:
+                files = [self.worker_file] + [self.lease_file(shard) for shard in self.held]
+            for file in files:
+                try:
+                    os.utime(file)
+                except OSError as e:
+                    logger.error('Unable to renew {}: {}'.format(file, e))
+        return
+
+    def lease_file(self, shard):
+        return os.path.join(self.directory, '{:03d}.lease'.format(shard))
+
+    def done_file(self, shard):
+        return os.path.join(self.directory, '{:03d}.done'.format(shard))
+
+    # Journal of the decisions for a shard, kept with the shard so whoever takes it over can resume it
+    def journal_file(self, shard):
+        return os.path.join(self.directory, 'journal.{:03d}.log'.format(shard))
+
+    def claim_file(self, photo_hash):
+        return os.path.join(self.claims_path, photo_hash[:2], photo_hash)
+
+    # Yield shards as they're leased until every shard is done. The shard is marked done when the caller asks for
+    # the next one. Shards leased by other workers are waited on in case a worker dies and its lease expires
+    def leases(self):
+        self.new_pass()
+        while not self.stopped.is_set():
+            remaining = [shard for shard in range(self.shards) if not os.path.exists(self.done_file(shard))]
+            if not remaining:
+                logger.info('All {} shards are done'.format(self.shards))
+                return
+            # Workers starting together try the shards in different orders
+            random.shuffle(remaining)
+            for shard in remaining:
+                if self.acquire(shard):
+                    logger.info('Processing shard {} ({} left)'.format(shard, len(remaining)))
+                    yield shard
+                    self.finish(shard)
+                    break
+            else:
+                self.stopped.wait(self.lease_seconds / 4)
+        return
+
+    # Start a new pass over the source once the last one is finished, clearing its state
+    def new_pass(self):
+        if glob.glob(os.path.join(self.directory, '*.lease')):
+            return
+        if not all(os.path.exists(self.done_file(shard)) for shard in range(self.shards)):
+            return
+        logger.info('Starting a new pass over the source')
+        for shard in range(self.shards):
+            for file in (self.done_file(shard), self.journal_file(shard)):
+                if os.path.exists(file):
+                    os.remove(file)
+        shutil.rmtree(self.claims_path, ignore_errors=True)
+        os.makedirs(self.claims_path, exist_ok=True)
+        return
+
+    # Take the lease on a shard, taking it over if the worker holding it has died. Returns whether it was taken
+    def acquire(self, shard):
+        lease = self.lease_file(shard)
+        if not create(lease, self.worker):
+            holder = read(lease)
+            lease_age = age(lease)
+            if lease_age is None or lease_age < self.lease_seconds:
+                return False
+            logger.warning('Lease on shard {} held by {} has expired'.format(shard, holder))
+            if not self.take_over(lease, holder) or not create(lease, self.worker):
+                return False
+        # Another worker may have finished it since it was checked
+        if os.path.exists(self.done_file(shard)):
+            os.remove(lease)
+            return False
+        with self.lock:
+            self.held.add(shard)
+        return True
+
+    # Mark a shard done and give up its lease
+    def finish(self, shard):
+        create(self.done_file(shard), self.worker)
+        self.release(shard)
+        return
+
+    def release(self, shard):
+        with self.lock:
+            self.held.discard(shard)
+        if read(self.lease_file(shard)) == self.worker:
+            os.remove(self.lease_file(shard))
+        return
+
+    # Remove a lease or claim file left by a dead worker, given what it held. The file is first renamed, which only
+    # one worker can do, and put back if it turns out to have been replaced by a live worker in the meantime. Returns
+    # whether it was removed
+    def take_over(self, path, content):
+        stale = '{}.{}.stale'.format(path, self.worker)
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return False
+        if read(stale) != content:
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    # The other hosts with workers still running, meaning the destination is being shared between hosts
+    def other_hosts(self):
+        workers = os.listdir(os.path.dirname(self.worker_file))
+        return set(worker.rsplit('-', 2)[0] for worker in workers if self.alive(worker)) - {self.host}
+
+    # Check whether another worker is still running
+    def alive(self, worker):
+        worker_age = age(os.path.join(os.path.dirname(self.worker_file), worker))
+        return worker_age is not None and worker_age < self.lease_seconds
+
+    # Claim content for this worker to store. Returns None if it's ours, otherwise the file another worker has stored
+    # it in, waiting for them to finish. A claim left by a worker that died is taken over
+    def claim(self, photo_hash):
+        claim_file = self.claim_file(photo_hash)
+        os.makedirs(os.path.dirname(claim_file), exist_ok=True)
+        while True:
+            if create(claim_file, json.dumps({'worker': self.worker})):
+                return None
+            content = read(claim_file)
+            try:
+                claim = json.loads(content) if content else None
+            except ValueError:
+                claim = None
+            if claim is None:
+                # Being written or just removed
+                time.sleep(CLAIM_WAIT)
+                continue
+            if claim.get('file') and os.path.exists(claim['file']):
+                return claim['file']
+            if claim['worker'] == self.worker:
+                # Left by an earlier attempt of our own that failed
+                return None
+            if not self.alive(claim['worker']):
+                logger.warning('Taking over the claim on {} from {}'.format(photo_hash, claim['worker']))
+                self.take_over(claim_file, content)
+                continue
+            time.sleep(CLAIM_WAIT)
+
+    # Record where claimed content has been stored
+    def placed(self, photo_hash, file):
+        claim_file = self.claim_file(photo_hash)
+        tmp_file = '{}.{}.tmp'.format(claim_file, self.worker)
+        with open(tmp_file, 'w') as fh:
+            fh.write(json.dumps({'worker': self.worker, 'file': file}))
+        os.replace(tmp_file, claim_file)
+        return
+
+    # Give up a claim on content that wasn't stored after all
+    def release_claim(self, photo_hash):
+        claim_file = self.claim_file(photo_hash)
+        content = read(claim_file)
+        if content and json.loads(content).get('worker') == self.worker:
+            os.remove(claim_file)
+        return
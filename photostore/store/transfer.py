@@ -0,0 +1,180 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from store import metrics
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+BLOCK_SIZE = 1024 * 1024
+# Linux ioctl to share the data blocks of one file with another (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Copy buffer, one per thread and reused for every file
+buffers = threading.local()
+
+
+# Files, bytes and seconds spent copying, for each copy method
+class TransferStats:
+    def __init__(self):
+        self.totals = dict()
+        self.lock = threading.Lock()
+
+    def record(self, method, size, seconds):
+        with self.lock:
+            files, total_size, total_seconds = self.totals.get(method, (0, 0, 0.0))
+            self.totals[method] = (files + 1, total_size + size, total_seconds + seconds)
+
+    # Log the throughput of each method
+    def report(self):
+        with self.lock:
+            for method, (files, size, seconds) in sorted(self.totals.items()):
+                rate = size / seconds / 1024 / 1024 if seconds else 0
+                logger.info('{} copy: {} files, {:.1f} MB in {:.1f}s, {:.1f} MB/s'.format(
+                    method, files, size / 1024 / 1024, seconds, rate))
+
+
+stats = TransferStats()
+
+
+# Copy a file, returning its sha256. The source is read once, the destination is written to a temporary file,
+# synced and renamed into place so a partial file never appears under the destination name. If the sha256 is
+# already known and the source and destination share a filesystem the kernel does the copy
+def copy_file(source, destination, digest=None):
+    start = time.monotonic()
+    directory, name = os.path.split(destination)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(name), suffix='.tmp')
+    try:
+        with open(source, 'rb', buffering=0) as src, os.fdopen(fd, 'wb', buffering=0) as dst:
+            size = os.fstat(src.fileno()).st_size
+            same_filesystem = os.fstat(src.fileno()).st_dev == os.fstat(dst.fileno()).st_dev
+            method = None
+            if same_filesystem and reflink(src, dst):
+                method = 'reflink'
+                if digest is None:
+                    digest = hash_stream(src)
+            elif same_filesystem and digest is not None and kernel_copy(src, dst, size):
+                method = 'kernel'
+            else:
+                method = 'stream'
+                copied_digest = copy_stream(src, dst)
+                # The source has changed since it was hashed
+                if digest is not None and copied_digest != digest:
+                    raise ValueError('{} changed while being copied'.format(source))
+                digest = copied_digest
+            os.fsync(dst.fileno())
+        shutil.copystat(source, tmp_file)
+        os.replace(tmp_file, destination)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+    stats.record(method, size, time.monotonic() - start)
+    metrics.registry.observe('copy_' + method, time.monotonic() - start, size)
+    return digest
+
+
+# Make the destination another name for a file already in the library, a hard link where possible otherwise a copy
+# (which is a reflink if the filesystem supports it). Returns the method used
+def link_file(source, destination):
+    start = time.monotonic()
+    # Linked under a temporary name then moved into place, like a copy, so it can replace a reserved empty file
+    directory, name = os.path.split(destination)
+    tmp_file = os.path.join(directory, '.{}.{}.tmp'.format(name, os.urandom(4).hex()))
+    try:
+        os.link(source, tmp_file)
+        os.replace(tmp_file, destination)
+    except OSError as e:
+        logger.debug('Unable to link %s: %s', destination, e)
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        copy_file(source, destination)
+        return 'copy'
+    # Nothing is read or written for a link
+    stats.record('link', 0, time.monotonic() - start)
+    metrics.registry.observe('copy_link', time.monotonic() - start)
+    return 'link'
+
+
+# Return the reusable buffer for this thread
+def get_buffer():
+    if not hasattr(buffers, 'buffer'):
+        buffers.buffer = bytearray(BLOCK_SIZE)
+    return buffers.buffer
+
+
+# Copy src to dst through the buffer, hashing as it goes
+def copy_stream(src, dst):
+    buffer = get_buffer()
+    view = memoryview(buffer)
+    file_hash = hashlib.sha256()
+    while True:
+        length = src.readinto(buffer)
+        if not length:
+            break
+        file_hash.update(view[:length])
+        dst.write(view[:length])
+    return file_hash.hexdigest()
+
+
+# Hash the rest of src through the buffer
+def hash_stream(src):
+    buffer = get_buffer()
+    view = memoryview(buffer)
+    file_hash = hashlib.sha256()
+    while True:
+        length = src.readinto(buffer)
+        if not length:
+            break
+        file_hash.update(view[:length])
+    return file_hash.hexdigest()
+
+
+# Share the data blocks of src with dst, False if the filesystem doesn't support it
+def reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# Have the kernel copy src to dst without it passing through this process, False if it can't be used
+def kernel_copy(src, dst, size):
+    copied = 0
+    try:
+        while copied < size:
+            if hasattr(os, 'copy_file_range'):
+                length = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+            else:
+                length = os.sendfile(dst.fileno(), src.fileno(), copied, size - copied)
+            if not length:
+                break
+            copied += length
+    except OSError:
+        # Nothing written yet so the stream copy can take over
+        if copied == 0:
+            return False
+        raise
+    if copied != size:
+        raise ValueError('{} bytes copied, expected {}'.format(copied, size))
+    return True
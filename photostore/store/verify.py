@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from store import catalog, hashing, metrics
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# Progress is saved to the catalog this often (seconds)
+CHECKPOINT_SECONDS = 30
+# Files in the library directories that aren't photos
+IGNORED_TYPES = ['.log', '.txt', '.pkl']
+PROBLEMS = ['mismatched', 'missing', 'unexpected']
+# Files are read this much at a time when the rate is limited
+CHUNK_SIZE = 1024 * 1024
+
+
+# Keeps reads to rate bytes a second, by sleeping after each chunk that's read. Time spent below the rate is only
+# carried forward for a second so a pause doesn't allow a long burst afterwards
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.total = 0
+
+    def wait(self, size):
+        self.total += size
+        delay = self.total / self.rate - (time.monotonic() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            self.start = time.monotonic() - 1
+            self.total = 0
+        return
+
+
+# Rehash the library files and compare them with the catalog, reporting files whose hash has changed, catalog files
+# that have gone and files the catalog doesn't know about. Files are visited in a fixed order and progress is saved
+# in the catalog, so a pass can be spread over several runs of time_limit seconds each. Returns the number of problems
+# found by this run
+def verify(destination, rate=None, time_limit=None, restart=False):
+    logger.debug('Calling verify')
+    start = time.monotonic()
+    limiter = RateLimiter(rate * 1024 * 1024) if rate else None
+
+    with catalog.Catalog(destination) as library:
+        # The last (directory, name) checked and the totals for the pass so far
+        position = None if restart else library.get_meta('verify_position')
+        position = tuple(json.loads(position)) if position else None
+        totals = library.get_meta('verify_totals') if position else None
+        totals = json.loads(totals) if totals else dict.fromkeys(['verified'] + PROBLEMS, 0)
+        if position:
+            logger.info('Carrying on from {}'.format(os.path.join(*position)))
+        counts = dict.fromkeys(totals, 0)
+        checkpoint = time.monotonic()
+        finished = False
+
+        try:
+            for directory in library_directories(destination, library):
+                if position and directory < position[0]:
+                    continue
+                for name, result in verify_directory(destination, directory, library, limiter,
+                                                     position[1] if position and directory == position[0] else None):
+                    counts[result] += 1
+                    totals[result] += 1
+                    position = (directory, name)
+                    if time.monotonic() - checkpoint > CHECKPOINT_SECONDS:
+                        save_position(library, position, totals)
+                        checkpoint = time.monotonic()
+                    if time_limit and time.monotonic() - start > time_limit:
+                        logger.info('Time limit reached, stopping at {}'.format(os.path.join(*position)))
+                        return sum(counts[problem] for problem in PROBLEMS)
+            finished = True
+        finally:
+            if finished:
+                # Start over next time
+                save_position(library, None, None)
+                library.put_meta('verify_completed', time.strftime('%Y-%m-%d %H:%M:%S'))
+                library.flush()
+            else:
+                save_position(library, position, totals)
+            logger.info('{} files verified, {} mismatched, {} missing, {} unexpected'.format(
+                counts['verified'], counts['mismatched'], counts['missing'], counts['unexpected']))
+
+    logger.info('Pass complete: {} files verified, {} mismatched, {} missing, {} unexpected'.format(
+        totals['verified'], totals['mismatched'], totals['missing'], totals['unexpected']))
+    return sum(counts[problem] for problem in PROBLEMS)
+
+
+# The library directories on disk or in the catalog, in the order they're checked
+def library_directories(destination, library):
+    on_disk = {entry.name for entry in os.scandir(destination) if entry.is_dir()}
+    return sorted((on_disk | library.file_directories()) - {'Dup', 'Bad'})
+
+
+# Check the files in a directory after the name given, yielding (name, result) for each in name order. The result is
+# 'verified' or the kind of problem found
+def verify_directory(destination, directory, library, limiter=None, after=None):
+    path = os.path.join(destination, directory)
+    known_files = {os.path.basename(file): details for file, details in library.directory_files(path).items()}
+    on_disk = dict()
+    if os.path.isdir(path):
+        on_disk = {entry.name: entry for entry in os.scandir(path)
+                   if entry.is_file() and os.path.splitext(entry.name)[1].lower() not in IGNORED_TYPES}
+
+    for name in sorted(on_disk.keys() | known_files.keys()):
+        if after is not None and name <= after:
+            continue
+        file = os.path.join(path, name)
+        known = known_files.get(name)
+        if name not in on_disk:
+            logger.warning('Missing: {}'.format(file))
+            yield name, 'missing'
+        elif known is None or known[3] is None:
+            logger.warning('Unexpected: {} is not in the catalog'.format(file))
+            yield name, 'unexpected'
+        else:
+            yield name, verify_file(file, on_disk[name].stat(), known, limiter)
+    return
+
+
+# Rehash a file and compare it with its catalog (size, mtime_ns, inode, sha256)
+def verify_file(file, stat, known, limiter=None):
+    size, mtime_ns, inode, sha256 = known
+    # A file that has been modified since it was catalogued isn't bit rot, but is still not what was stored
+    modified = (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns)
+    if stat.st_size != size:
+        logger.warning('Mismatched: {} is {} bytes, catalog has {}'.format(file, stat.st_size, size))
+        return 'mismatched'
+
+    if limiter is None:
+        file, photo_hash, error, seconds = hashing.hash_files([file])[0]
+    else:
+        file, photo_hash, error, seconds = limited_hash(file, limiter)
+    metrics.registry.observe('verify', seconds, stat.st_size)
+    if error is not None:
+        logger.warning('Mismatched: {} could not be read: {}'.format(file, error))
+        return 'mismatched'
+    if photo_hash != sha256:
+        if modified:
+            logger.warning('Mismatched: {} has been modified since it was catalogued'.format(file))
+        else:
+            logger.warning('Mismatched: {} does not match its stored hash, its size and modified time have not '
+                           'changed'.format(file))
+        return 'mismatched'
+    return 'verified'
+
+
+# Hash a file a chunk at a time, keeping to the limiter's rate as it's read so a large video isn't read in one burst.
+# Returns (file, hash, error, seconds) like hashing.hash_files
+def limited_hash(file, limiter):
+    start = time.perf_counter()
+    digest = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    try:
+        with open(file, 'rb', buffering=0) as fh:
+            while True:
+                size = fh.readinto(buffer)
+                if not size:
+                    break
+                digest.update(view[:size])
+                limiter.wait(size)
+    except OSError as e:
+        return file, None, str(e), time.perf_counter() - start
+    return file, digest.hexdigest(), None, time.perf_counter() - start
+
+
+# Save how far the pass has got, or clear it once the pass is finished
+def save_position(library, position, totals):
+    if position is None:
+        library.remove_meta('verify_position')
+        library.remove_meta('verify_totals')
+    else:
+        library.put_meta('verify_position', json.dumps(position))
+        library.put_meta('verify_totals', json.dumps(totals))
+    library.flush()
+    return
@@ -0,0 +1,66 @@
+import logging
+import os
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+
+# Check whether a file should be skipped based on its extension
+def skipped(name, skip_types):
+    return os.path.splitext(name)[1].lower() in skip_types
+
+
+# Check whether a file in the destination was left behind by an interrupted store, either the temporary file of a
+# copy or the empty file that reserved a name
+def leftover(entry):
+    return (entry.name.startswith('.') and entry.name.endswith('.tmp')) or entry.stat().st_size == 0
+
+
+# Yield the entries directly inside a directory, sub directories and the files that aren't skipped
+def top_level(path, skip_types=()):
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) or (entry.is_file() and not skipped(entry.name, skip_types)):
+                yield entry
+
+
+# Yield every file below a directory as it is found, without building up lists. Only the directories still to be
+# visited are held, and the files are os.DirEntry objects so their cached stat results can be reused
+def walk_files(path, skip_types=()):
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and not skipped(entry.name, skip_types):
+                        yield entry
+        except OSError as e:
+            logger.warning('Unable to read {}: {}'.format(directory, e))
+    return
+
+
+# Stands in for an os.DirEntry for a file found some other way, with its stat result already taken
+class FileEntry:
+    def __init__(self, path, stat_result):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.stat_result = stat_result
+
+    def is_dir(self, follow_symlinks=True):
+        return False
+
+    def is_file(self, follow_symlinks=True):
+        return True
+
+    def stat(self, follow_symlinks=True):
+        return self.stat_result
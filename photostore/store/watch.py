@@ -0,0 +1,235 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from store import walker
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(funcName)s - %(message)s',
+                              '%Y-%m-%d %H:%M')
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(formatter)
+logger.addHandler(console_handler)
+
+# inotify event flags, from linux/inotify.h
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+EVENT = struct.Struct('iIII')
+# Allowance for file systems that keep times to the second or two, when deciding whether a scan has already seen a file
+MARGIN_NS = 2 * 10 ** 9
+
+
+# Directory tree watch using inotify through libc, one watch per directory
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = dict()
+
+    # Watch a directory, not the ones below it
+    def add(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            logger.warning('Unable to watch {}: {}'.format(directory, os.strerror(ctypes.get_errno())))
+            return
+        self.directories[wd] = directory
+        return
+
+    # Wait up to timeout seconds for events, returns a list of (path, is directory). None means events were lost
+    # and the tree needs to be scanned again
+    def read(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].split(b'\x00')[0]
+            offset += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            if wd in self.directories and name:
+                events.append((os.path.join(self.directories[wd], os.fsdecode(name)), bool(mask & IN_ISDIR)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+        return
+
+
+# Watches a source tree for new files, handing them out once their size and modification time have stopped changing
+# for settle seconds. Uses inotify where it's available, otherwise (or if poll is given) the tree is scanned every
+# poll seconds
+class Watcher:
+    def __init__(self, source, skip_types=(), settle=2.0, poll=None):
+        self.source = source
+        self.skip_types = skip_types
+        self.settle = settle
+        self.poll = poll
+        # Files waiting to settle, path: (size, mtime_ns, time last changed)
+        self.pending = dict()
+        # Files changed before this time (ns) have already been handed out, or are pending, so scans skip them
+        self.since = None
+        # Directories found by the last scan of the source
+        self.directories = set()
+        # Files handed out that changed after since, path: (size, mtime_ns, ctime_ns). Anything older is dropped as it's
+        # covered by since, so this doesn't grow with the number of files ingested
+        self.seen = dict()
+        self.stopped = threading.Event()
+        self.inotify = None
+        if poll is None:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.warning('inotify not available, polling instead: {}'.format(e))
+                self.poll = 5.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+        return
+
+    # Stop handing out batches, safe to call from a signal handler
+    def stop(self):
+        self.stopped.set()
+        return
+
+    # Yield lists of up to batch_size settled files, as walker.FileEntry objects, until stopped
+    def batches(self, batch_size=100):
+        self.advance(self.scan(self.source))
+        last_scan = time.monotonic()
+        while not self.stopped.is_set():
+            # Wake up often enough to check on the files that are settling and to notice being stopped
+            timeout = min(self.settle, 1.0)
+            if self.inotify is not None:
+                started = time.time_ns()
+                events = self.inotify.read(timeout)
+                if events is None:
+                    logger.warning('inotify events lost, scanning {}'.format(self.source))
+                    self.advance(self.scan(self.source, since=self.since))
+                else:
+                    # Every change before the read has been picked up from its event
+                    self.advance(started)
+                for path, is_dir in events or []:
+                    if is_dir:
+                        # Files may have landed before the watch was added, and a directory moved in keeps the old
+                        # times of its files
+                        self.scan(path)
+                    else:
+                        self.check(path)
+            else:
+                self.stopped.wait(timeout)
+                if time.monotonic() - last_scan >= self.poll:
+                    self.advance(self.scan(self.source, watch=False, since=self.since))
+                    last_scan = time.monotonic()
+
+            ready = self.settled()
+            if self.stopped.is_set():
+                return
+            for index in range(0, len(ready), batch_size):
+                yield ready[index:index + batch_size]
+
+    # Look for new or changed files below a directory, adding watches to its directories. Files that haven't changed
+    # since the given time (ns) are skipped, except in directories that weren't there last time as a directory moved
+    # into the source keeps the times of its files. Returns the time the scan started
+    def scan(self, directory, watch=True, since=None):
+        started = time.time_ns()
+        directories = set()
+        stack = [(directory, since)]
+        while stack:
+            path, path_since = stack.pop()
+            directories.add(path)
+            if self.inotify is not None and watch:
+                self.inotify.add(path)
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, path_since if entry.path in self.directories else None))
+                        elif entry.is_file() and not walker.skipped(entry.name, self.skip_types):
+                            stat = entry.stat()
+                            if path_since is None or stat.st_ctime_ns >= path_since or entry.path in self.pending:
+                                self.check(entry.path, stat)
+            except OSError as e:
+                logger.warning('Unable to read {}: {}'.format(path, e))
+        # A scan of the whole source also forgets the directories that have gone
+        if directory == self.source:
+            self.directories = directories
+        else:
+            self.directories |= directories
+        return started
+
+    # Everything that changed before the time (ns) has been seen, forget the files handed out before it
+    def advance(self, started):
+        self.since = started - MARGIN_NS
+        for path, (size, mtime_ns, ctime_ns) in list(self.seen.items()):
+            if ctime_ns < self.since:
+                del self.seen[path]
+        return
+
+    # Start or restart the settle time of a file that has appeared or changed
+    def check(self, path, stat=None):
+        if walker.skipped(os.path.basename(path), self.skip_types):
+            return
+        try:
+            stat = stat or os.stat(path)
+        except OSError:
+            return
+        state = (stat.st_size, stat.st_mtime_ns)
+        if self.seen.get(path, ())[:2] == state:
+            return
+        pending = self.pending.get(path)
+        if pending is None or pending[:2] != state:
+            self.pending[path] = state + (time.monotonic(),)
+        return
+
+    # Return the files that haven't changed for the settle time
+    def settled(self):
+        now = time.monotonic()
+        ready = []
+        for path, (size, mtime_ns, changed) in list(self.pending.items()):
+            if now - changed < self.settle:
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.pending[path]
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != (size, mtime_ns):
+                self.pending[path] = (stat.st_size, stat.st_mtime_ns, now)
+                continue
+            del self.pending[path]
+            self.seen[path] = (size, mtime_ns, stat.st_ctime_ns)
+            ready.append(walker.FileEntry(path, stat))
+        return ready
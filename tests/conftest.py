@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+
+# The store package is imported the way ps.py imports it, from the photostore directory
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'photostore'))
+
+
+# Stand-in exiftool, see tools/fake_exiftool.py
+@pytest.fixture
+def fake_exiftool():
+    return os.path.join(ROOT, 'tools', 'fake_exiftool.py')
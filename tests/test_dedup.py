@@ -0,0 +1,155 @@
+import os
+import threading
+import time
+import pytest
+from store import catalog, dedup, index, photos, process, transfer
+
+BLOCK = 65536
+
+
+class Reads:
+    def __init__(self, monkeypatch):
+        self.hashed = []
+        self.fingerprinted = []
+        fingerprint = photos.photo_fingerprint
+
+        def counting_fingerprint(file, size):
+            self.fingerprinted.append(os.path.basename(file))
+            return fingerprint(file, size)
+        monkeypatch.setattr(photos, 'photo_fingerprint', counting_fingerprint)
+
+    def hash_file(self, file):
+        self.hashed.append(os.path.basename(file))
+        return photos.photo_hash(file)
+
+
+@pytest.fixture
+def library(tmp_path):
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    with catalog.Catalog(str(destination)) as library:
+        yield library
+
+
+def detector(library, reads, stored=()):
+    directory_hashes = index.HashIndex(library).load()
+    for file in stored:
+        directory_hashes.add(photos.photo_hash(file), file)
+    return dedup.DuplicateDetector(library, directory_hashes, reads.hash_file)
+
+
+def photo(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    new_photo = photos.Photo(path.name, str(path.parent), str(path))
+    new_photo.set_size(len(data))
+    return new_photo
+
+
+# A file with a size of its own is new without being read
+def test_size_tier(tmp_path, library, monkeypatch):
+    reads = Reads(monkeypatch)
+    check = detector(library, reads)
+    assert check.check(photo(tmp_path / 'a.jpg', b'a' * 100)) == 'new'
+    assert check.check(photo(tmp_path / 'b.jpg', b'b' * 101)) == 'new'
+    assert (reads.fingerprinted, reads.hashed) == ([], [])
+
+
+# Files of the same size with different first blocks are told apart by their fingerprints, without a full hash
+def test_fingerprint_tier(tmp_path, library, monkeypatch):
+    reads = Reads(monkeypatch)
+    check = detector(library, reads)
+    assert check.check(photo(tmp_path / 'a.jpg', b'a' * 300000)) == 'new'
+    assert check.check(photo(tmp_path / 'b.jpg', b'b' * 300000)) == 'new'
+    assert sorted(reads.fingerprinted) == ['a.jpg', 'b.jpg']
+    assert reads.hashed == []
+
+
+# Files with the same size, first and last blocks but different middles are only told apart by the full hash
+def test_hash_tier(tmp_path, library, monkeypatch):
+    reads = Reads(monkeypatch)
+    check = detector(library, reads)
+    first = photo(tmp_path / 'a.jpg', b'h' * BLOCK + b'1' * 100000 + b't' * BLOCK)
+    second = photo(tmp_path / 'b.jpg', b'h' * BLOCK + b'2' * 100000 + b't' * BLOCK)
+    assert photos.photo_fingerprint(first.fullname, first.size) == \
+        photos.photo_fingerprint(second.fullname, second.size)
+    assert check.check(first) == 'new'
+    first.set_hash(photos.photo_hash(first.fullname))
+    check.stored(first)
+    assert check.check(second) == 'new'
+    assert reads.hashed == ['b.jpg']
+
+
+# A file already in the library exists, found through the library's fingerprints
+def test_library_tier(tmp_path, library, monkeypatch):
+    reads = Reads(monkeypatch)
+    stored = photo(tmp_path / 'dst' / '2020_01' / 'a.jpg', b'a' * 1000)
+    check = detector(library, reads, [stored.fullname])
+    new_photo = photo(tmp_path / 'src' / 'a.jpg', b'a' * 1000)
+    assert check.check(new_photo) == 'exists'
+    assert new_photo.original == stored.fullname
+    assert check.check(photo(tmp_path / 'src' / 'b.jpg', b'b' * 1000)) == 'new'
+    assert reads.hashed == ['a.jpg']
+
+
+# Check a photo on a thread, as it waits until the file it matches is stored or released
+def checking(check, new_photo):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(check.check(new_photo)), daemon=True)
+    thread.start()
+    time.sleep(0.2)
+    assert not result
+    return thread, result
+
+
+# A copy of a file from this run waits for it to be stored, then is its duplicate
+def test_waits_for_stored(tmp_path, library, monkeypatch):
+    check = detector(library, Reads(monkeypatch))
+    first = photo(tmp_path / 'a.jpg', b'same' * 1000)
+    assert check.check(first) == 'new'
+    second = photo(tmp_path / 'b.jpg', b'same' * 1000)
+    thread, result = checking(check, second)
+    first.set_hash(photos.photo_hash(first.fullname))
+    check.stored(first)
+    thread.join(10)
+    assert result == ['dup'] and second.original == first.fullname
+
+
+# When the file being waited on fails to copy the waiting copy is released, and stored in its place
+def test_released_on_failure(tmp_path, library, monkeypatch):
+    check = detector(library, Reads(monkeypatch))
+    first = photo(tmp_path / 'a.jpg', b'same' * 1000)
+    assert check.check(first) == 'new'
+    second = photo(tmp_path / 'b.jpg', b'same' * 1000)
+    thread, result = checking(check, second)
+    check.release(first)
+    thread.join(10)
+    assert result == ['new'] and second.original is None
+    # The next copy waits on the one that took its place
+    third = photo(tmp_path / 'c.jpg', b'same' * 1000)
+    thread, result = checking(check, third)
+    check.stored(second)
+    thread.join(10)
+    assert result == ['dup'] and third.original == second.fullname
+
+
+# Through the pipeline, a copy that fails lets the identical file waiting on it be stored instead
+def test_failed_copy_releases_waiting(tmp_path, fake_exiftool, monkeypatch):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    for name in ['a.jpg', 'b.jpg']:
+        photo(source / name, b'same' * 1000)
+    copy_file = transfer.copy_file
+    failed = []
+
+    def failing_copy(src, dst, digest=None):
+        if not failed:
+            failed.append(src)
+            raise OSError('disk full')
+        return copy_file(src, dst, digest)
+    monkeypatch.setattr(transfer, 'copy_file', failing_copy)
+    process.processing(str(source), str(destination), False, fake_exiftool)
+    stored = [name for root, dirs, names in os.walk(destination) for name in names if name.endswith('.jpg')]
+    assert len(failed) == 1
+    assert stored == [{'a.jpg': 'b.jpg', 'b.jpg': 'a.jpg'}[os.path.basename(failed[0])]]
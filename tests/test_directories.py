@@ -0,0 +1,87 @@
+import os
+import pyzipper
+from store import catalog, directories
+
+PASSWORD = 'secret'
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+def run(destination, compress=False):
+    assert directories.checksums(str(destination), compress, PASSWORD, 1) == 0
+    with catalog.Catalog(str(destination)) as library:
+        return library.directory_hashes(), library.directory_files(str(destination / '2020_01'))
+
+
+def archive(destination):
+    with pyzipper.AESZipFile(destination / '2020_01.zip') as zip_file:
+        zip_file.setpassword(PASSWORD.encode())
+        return {name: zip_file.read(name) for name in zip_file.namelist()}
+
+
+# The directory hash only changes when a file is added, changed or removed
+def test_directory_hash_changes(tmp_path):
+    write(tmp_path / '2020_01' / 'a.jpg', b'first')
+    directory = str(tmp_path / '2020_01')
+    first = run(tmp_path)[0][directory]
+    assert run(tmp_path)[0][directory] == first
+    write(tmp_path / '2020_01' / 'b.jpg', b'second')
+    second = run(tmp_path)[0][directory]
+    assert second != first
+    write(tmp_path / '2020_01' / 'b.jpg', b'changed')
+    assert run(tmp_path)[0][directory] not in [first, second]
+    os.remove(tmp_path / '2020_01' / 'b.jpg')
+    assert run(tmp_path)[0][directory] == first
+
+
+# Temporary files from a copy and empty reserved names left by an interrupted store are ignored
+def test_leftovers_ignored(tmp_path):
+    write(tmp_path / '2020_01' / 'a.jpg', b'first')
+    directory = str(tmp_path / '2020_01')
+    clean = run(tmp_path)[0][directory]
+    write(tmp_path / '2020_01' / '.b.jpg.1a2b3c4d.tmp', b'part of a copy')
+    write(tmp_path / '2020_01' / 'c.jpg', b'')
+    hashes, files = run(tmp_path, compress=True)
+    assert hashes[directory] == clean
+    assert list(files) == [str(tmp_path / '2020_01' / 'a.jpg')]
+    assert list(archive(tmp_path)) == ['a.jpg']
+
+
+# New files are appended to the archive, a changed file means it's rebuilt
+def test_archive_append_and_rebuild(tmp_path):
+    write(tmp_path / '2020_01' / 'a.jpg', b'first')
+    run(tmp_path, compress=True)
+    assert archive(tmp_path) == {'a.jpg': b'first'}
+    zip_file = str(tmp_path / '2020_01.zip')
+
+    write(tmp_path / '2020_01' / 'b.jpg', b'second')
+    run(tmp_path)
+    with catalog.Catalog(str(tmp_path)) as library:
+        changes = directories.archive_changes(str(tmp_path / '2020_01'), library)
+    assert (changes[0], [name for path, name, sha256 in changes[1]], changes[2]) == (zip_file, ['b.jpg'], False)
+    run(tmp_path, compress=True)
+    assert archive(tmp_path) == {'a.jpg': b'first', 'b.jpg': b'second'}
+
+    write(tmp_path / '2020_01' / 'a.jpg', b'changed')
+    run(tmp_path)
+    with catalog.Catalog(str(tmp_path)) as library:
+        changes = directories.archive_changes(str(tmp_path / '2020_01'), library)
+    assert changes[2] is True and len(changes[1]) == 2
+    run(tmp_path, compress=True)
+    assert archive(tmp_path) == {'a.jpg': b'changed', 'b.jpg': b'second'}
+    with catalog.Catalog(str(tmp_path)) as library:
+        assert directories.archive_changes(str(tmp_path / '2020_01'), library) is None
+
+
+# An archive that doesn't hold what the catalog says it does is rebuilt
+def test_damaged_archive_rebuilt(tmp_path):
+    write(tmp_path / '2020_01' / 'a.jpg', b'first')
+    run(tmp_path, compress=True)
+    write(tmp_path / '2020_01.zip', b'not a zip')
+    write(tmp_path / '2020_01' / 'b.jpg', b'second')
+    run(tmp_path, compress=True)
+    assert archive(tmp_path) == {'a.jpg': b'first', 'b.jpg': b'second'}
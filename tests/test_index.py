@@ -0,0 +1,70 @@
+import hashlib
+import os
+from store import catalog, index
+
+
+def digest(number):
+    return hashlib.sha256(str(number).encode()).hexdigest()
+
+
+# Fill a catalog with files, some sharing content and some in the duplicate and bad directories
+def make_library(destination, count=2000):
+    library = catalog.Catalog(str(destination))
+    expected = dict()
+    for number in range(count):
+        directory = ['2020_01', '2021_05', 'Dup', 'Bad'][number % 4]
+        path = os.path.join(directory, 'IMG_{:05d}.JPG'.format(number))
+        photo_hash = digest(number % (count - 100))
+        library.put_file(library.absolute(path), number, 0, photo_hash)
+        if directory not in ['Dup', 'Bad']:
+            expected[photo_hash] = path
+    return library, expected
+
+
+def test_snapshot_matches_catalog(tmp_path):
+    library, expected = make_library(tmp_path)
+    for writable in [True, False]:
+        directory_hashes = index.HashIndex(library, writable=writable).load()
+        assert len(directory_hashes) == len(expected)
+        for photo_hash, path in expected.items():
+            assert directory_hashes.get(photo_hash) == library.absolute(path)
+        assert directory_hashes.get(digest(-1)) is None
+        directory_hashes.close()
+    library.close()
+
+
+def test_snapshot_reused_until_files_change(tmp_path):
+    library, expected = make_library(tmp_path, 200)
+    directory_hashes = index.HashIndex(library).load()
+    token = library.get_meta('hash_snapshot')
+    directory_hashes.close()
+    assert index.HashIndex(library).load().snapshot.token == token
+
+    library.put_file(library.absolute('2022_02/new.jpg'), 1, 0, digest('new'))
+    library.flush()
+    directory_hashes = index.HashIndex(library).load()
+    assert directory_hashes.snapshot.token != token
+    assert directory_hashes.get(digest('new')) == library.absolute('2022_02/new.jpg')
+    directory_hashes.close()
+    library.close()
+
+
+def test_empty_library(tmp_path):
+    library = catalog.Catalog(str(tmp_path))
+    directory_hashes = index.HashIndex(library).load()
+    assert len(directory_hashes) == 0
+    assert directory_hashes.get(digest(1)) is None
+    directory_hashes.close()
+    library.close()
+
+
+# Hashes known from the snapshot and again this run are only counted once
+def test_length_counts_each_hash_once(tmp_path):
+    library, expected = make_library(tmp_path, 200)
+    directory_hashes = index.HashIndex(library).load()
+    moved = next(iter(expected))
+    directory_hashes.move(moved, library.absolute(expected[moved]), library.absolute('Review/moved.jpg'))
+    directory_hashes.remember(digest(-1), library.absolute('2022_02/other.jpg'))
+    assert len(directory_hashes) == len(expected) + 1
+    directory_hashes.close()
+    library.close()
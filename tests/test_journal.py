@@ -0,0 +1,105 @@
+import functools
+import os
+from store import journal, names, photos
+
+
+def reserve(registry, decisions, file, source):
+    photo = photos.Photo(os.path.basename(source), os.path.dirname(source), source)
+    return registry.reserve(file, functools.partial(decisions.begin, photo), decisions.cancel)
+
+
+# A process that dies after reserving a name leaves an empty file, which the next run rolls back
+def test_reserved_name_rolled_back(tmp_path):
+    decisions = journal.Journal(str(tmp_path)).open()
+    registry = names.NameRegistry(exclusive=True)
+    dest, renamed = reserve(registry, decisions, str(tmp_path / '2020_01' / 'a.jpg'), '/src/a.jpg')
+    assert os.path.getsize(dest) == 0
+    decisions.close()
+
+    resumed = journal.Journal(str(tmp_path)).load()
+    assert list(resumed.unfinished) == [dest]
+    resumed.rollback()
+    assert not os.path.exists(dest)
+
+
+# A name another process has taken is left alone by the rollback
+def test_taken_name_not_rolled_back(tmp_path):
+    decisions = journal.Journal(str(tmp_path)).open()
+    registry = names.NameRegistry(exclusive=True)
+    # The directory is read before the other process stores its file
+    registry.reserve(str(tmp_path / '2020_01' / 'b.jpg'))
+    taken = tmp_path / '2020_01' / 'a.jpg'
+    taken.write_bytes(b'stored by another process')
+    dest, renamed = reserve(registry, decisions, str(taken), '/src/a.jpg')
+    assert (dest, renamed) == (str(tmp_path / '2020_01' / 'a.1.jpg'), ' (renamed)')
+    decisions.close()
+
+    resumed = journal.Journal(str(tmp_path)).load()
+    assert list(resumed.unfinished) == [dest]
+    resumed.rollback()
+    assert taken.read_bytes() == b'stored by another process'
+
+
+# Records written after the journal is truncated are read back by the next run
+def test_records_after_truncate(tmp_path):
+    decisions = journal.Journal(str(tmp_path)).open()
+    first = photos.Photo('a.jpg', '/src', '/src/a.jpg')
+    decisions.begin(first, str(tmp_path / '2020_01' / 'a.jpg'))
+    decisions.truncate()
+    second = photos.Photo('b.jpg', '/src', '/src/b.jpg')
+    decisions.begin(second, str(tmp_path / '2020_01' / 'b.jpg'))
+    decisions.fh.close()
+
+    with open(tmp_path / 'journal.log', 'rb') as fh:
+        assert b'\x00' not in fh.read()
+    resumed = journal.Journal(str(tmp_path)).load()
+    assert list(resumed.unfinished) == [str(tmp_path / '2020_01' / 'b.jpg')]
+
+
+def stored_photo(tmp_path, name):
+    source = tmp_path / 'src' / name
+    source.parent.mkdir(exist_ok=True)
+    source.write_bytes(name.encode())
+    photo = photos.Photo(name, str(source.parent), str(source))
+    photo.set_stat(os.stat(source))
+    photo.status = 'new'
+    file = tmp_path / '2020_01' / name
+    file.parent.mkdir(exist_ok=True)
+    file.write_bytes(name.encode())
+    return photo, str(file)
+
+
+# A stored photo that was being moved to review when the process died is put back, a finished move is left alone
+def test_interrupted_move_put_back(tmp_path):
+    decisions = journal.Journal(str(tmp_path)).open()
+    (tmp_path / 'Review').mkdir()
+    for name in ['a.jpg', 'b.jpg']:
+        photo, file = stored_photo(tmp_path, name)
+        decisions.begin(photo, file)
+        decisions.done(photo, file)
+        review_file = str(tmp_path / 'Review' / name)
+        decisions.begin(photo, review_file, file)
+        os.replace(file, review_file)
+    decisions.moved(str(tmp_path / 'Review' / 'b.jpg'))
+    decisions.close()
+
+    resumed = journal.Journal(str(tmp_path)).load()
+    assert list(resumed.unfinished) == [str(tmp_path / 'Review' / 'a.jpg')]
+    resumed.rollback()
+    assert sorted(os.listdir(tmp_path / '2020_01')) == ['a.jpg']
+    assert sorted(os.listdir(tmp_path / 'Review')) == ['b.jpg']
+
+
+# A photo moved before its own copy was finished is rolled back with it
+def test_unfinished_move_of_unfinished_copy(tmp_path):
+    decisions = journal.Journal(str(tmp_path)).open()
+    photo, file = stored_photo(tmp_path, 'a.jpg')
+    decisions.begin(photo, file)
+    review_file = tmp_path / 'Review' / 'a.jpg'
+    review_file.parent.mkdir()
+    decisions.begin(photo, str(review_file), file)
+    os.replace(file, review_file)
+    decisions.close()
+
+    journal.Journal(str(tmp_path)).load().rollback()
+    assert os.listdir(tmp_path / '2020_01') == [] and os.listdir(tmp_path / 'Review') == []
@@ -0,0 +1,138 @@
+import datetime
+import os
+import struct
+import pytest
+from store import metadata, photos, process
+
+
+# TIFF formatted EXIF block holding a 20 byte DateTimeOriginal, in either byte order
+def exif_block(date, order='<'):
+    tiff = (b'II' if order == '<' else b'MM') + struct.pack(order + 'HI', 42, 8)
+    # IFD0 pointing to the Exif IFD at 26, which holds the date string at 44
+    tiff += struct.pack(order + 'HHHII', 1, 0x8769, 4, 1, 26) + struct.pack(order + 'I', 0)
+    tiff += struct.pack(order + 'HHHII', 1, 0x9003, 2, 20, 44) + struct.pack(order + 'I', 0)
+    return tiff + date + b'\x00'
+
+
+def jpeg(date, order='<'):
+    app1 = b'Exif\x00\x00' + exif_block(date, order)
+    return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + b'\xff\xda' + os.urandom(64) + b'\xff\xd9'
+
+
+def box(box_type, data):
+    return struct.pack('>I4s', len(data) + 8, box_type) + data
+
+
+# HEIF file with the EXIF block as item 1, located through iinf and iloc in the meta box
+def heic(date):
+    ftyp = box(b'ftyp', b'heic' + struct.pack('>I', 0) + b'mif1heic')
+    infe = box(b'infe', struct.pack('>BxxxHH', 2, 1, 0) + b'Exif' + b'\x00')
+    iinf = box(b'iinf', b'\x00\x00\x00\x00' + struct.pack('>H', 1) + infe)
+    item = struct.pack('>I', 0) + exif_block(date, '>')
+
+    # The item offset depends on the size of the boxes in front of it
+    def iloc(offset):
+        return box(b'iloc', b'\x00\x00\x00\x00' + bytes([0x44, 0x00]) + struct.pack('>HHHHII', 1, 1, 0, 1, offset,
+                                                                                     len(item)))
+    meta = box(b'meta', b'\x00\x00\x00\x00' + iinf + iloc(0))
+    offset = len(ftyp) + len(meta) + 8
+    meta = box(b'meta', b'\x00\x00\x00\x00' + iinf + iloc(offset))
+    return ftyp + meta + box(b'mdat', item)
+
+
+# QuickTime movie with the movie header and one track's media header
+def mov(created, media_created):
+    def seconds(date):
+        return int((date - metadata.QUICKTIME_EPOCH).total_seconds()) if date else 0
+    mvhd = box(b'mvhd', struct.pack('>BxxxII', 0, seconds(created), 0) + bytes(88))
+    mdhd = box(b'mdhd', struct.pack('>BxxxII', 0, seconds(media_created), 0) + bytes(12))
+    trak = box(b'trak', box(b'tkhd', bytes(84)) + box(b'mdia', mdhd))
+    return box(b'ftyp', b'qt  ' + struct.pack('>I', 0) + b'qt  ') + box(b'moov', mvhd + trak) + box(b'mdat', bytes(16))
+
+
+# Write a file with the given modification time
+def write(path, data, modified=datetime.datetime(2019, 6, 15, 10, 0)):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, (modified.timestamp(), modified.timestamp()))
+    return str(path)
+
+
+# The directory date a file ends up in for a set of metadata
+def directory_date(file, photo_data):
+    photo = photos.Photo(os.path.basename(file), os.path.dirname(file), file)
+    photo.extract_date(photo_data)
+    photo.find_date()
+    return photo.directory_date, photo.exif_tag
+
+
+@pytest.mark.parametrize('order', ['<', '>'])
+def test_jpeg(tmp_path, order):
+    file = write(tmp_path / 'IMG_0001.JPG', jpeg(b'2021:03:04 05:06:07', order))
+    tags = metadata.read_dates(file)
+    assert tags['EXIF:DateTimeOriginal'] == '2021:03:04 05:06:07'
+    assert tags['File:FileModifyDate'].startswith('2019:06:15 10:00:00')
+    assert directory_date(file, tags) == ('2021_03', 'JPG Unknown')
+
+
+def test_jpeg_in_dated_directory(tmp_path):
+    # JPEG dates aren't trusted, the date of the directory it's in is used instead
+    file = write(tmp_path / '2015' / 'IMG_0001.JPG', jpeg(b'2021:03:04 05:06:07'))
+    assert directory_date(file, metadata.read_dates(file)) == ('2015_01', 'JPG Unknown')
+
+
+def test_jpeg_blank_date(tmp_path):
+    file = write(tmp_path / 'IMG_0001.JPG', jpeg(b'    :  :     :  :  '))
+    tags = metadata.read_dates(file)
+    # Unstripped, the way exiftool returns it, so the blank date is skipped
+    assert tags['EXIF:DateTimeOriginal'] == '    :  :     :  :  '
+    assert directory_date(file, tags) == ('2019_06', 'JPG Unknown')
+
+
+def test_jpeg_without_exif(tmp_path):
+    file = write(tmp_path / 'IMG_0001.JPG', b'\xff\xd8\xff\xdb\x00\x04\x00\x00\xff\xda' + os.urandom(32))
+    tags = metadata.read_dates(file)
+    assert 'EXIF:DateTimeOriginal' not in tags
+    assert directory_date(file, tags) == ('2019_06', 'JPG Unknown')
+
+
+def test_heic(tmp_path):
+    file = write(tmp_path / 'IMG_0001.HEIC', heic(b'2022:11:12 13:14:15'))
+    tags = metadata.read_dates(file)
+    assert tags['EXIF:DateTimeOriginal'] == '2022:11:12 13:14:15'
+    assert directory_date(file, tags) == ('2022_11', 'EXIF:DateTimeOriginal')
+
+
+def test_mov(tmp_path):
+    file = write(tmp_path / 'IMG_0001.MOV', mov(datetime.datetime(2018, 2, 3, 4, 5, 6),
+                                                 datetime.datetime(2018, 2, 3, 4, 5, 7)))
+    tags = metadata.read_dates(file)
+    assert tags['QuickTime:CreateDate'] == '2018:02:03 04:05:06'
+    assert tags['QuickTime:MediaCreateDate'] == '2018:02:03 04:05:07'
+    assert directory_date(file, tags) == ('2018_02', 'QuickTime:CreateDate')
+
+
+def test_mov_without_date(tmp_path):
+    file = write(tmp_path / 'IMG_0001.MOV', mov(None, None))
+    tags = metadata.read_dates(file)
+    assert tags['QuickTime:CreateDate'] == '0000:00:00 00:00:00'
+    assert directory_date(file, tags) == ('2019_06', 'File:FileModifyDate')
+
+
+def test_unknown_format(tmp_path):
+    file = write(tmp_path / 'notes.jpg', b'not a photo at all')
+    assert metadata.read_dates(file) is None
+
+
+# Files with dates that can't be read go to Bad rather than being dropped
+def test_bad_dates_stored_in_bad(tmp_path, fake_exiftool):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    write(source / 'blank.jpg', jpeg(b'    :  :     :  :  '))
+    write(source / 'invalid.jpg', jpeg(b'2021:13:45 05:06:07'))
+    write(source / 'good.heic', heic(b'2022:11:12 13:14:15'))
+    process.processing(str(source), str(destination), False, fake_exiftool)
+    assert os.listdir(destination / 'Bad') == ['invalid.jpg']
+    assert os.listdir(destination / '2019_06') == ['blank.jpg']
+    assert os.listdir(destination / '2022_11') == ['good.heic']
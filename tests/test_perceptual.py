@@ -0,0 +1,104 @@
+import json
+import os
+import pytest
+from store import catalog, perceptual, photos, process
+
+numpy = pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+
+# Smooth gradient image, resized copies of it have the same difference hash
+def image(path, width, height, quality=90):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    x = numpy.linspace(0, 255, width)
+    y = numpy.linspace(0, 255, height)
+    pixels = (numpy.add.outer(y, x) / 2).astype(numpy.uint8)
+    Image.fromarray(numpy.stack([pixels, 255 - pixels, pixels // 2], axis=2)).save(path, quality=quality)
+    return str(path)
+
+
+def files(directory):
+    return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+
+def test_hash_and_pixels(tmp_path):
+    large = image(tmp_path / 'large.jpg', 800, 600)
+    small = image(tmp_path / 'small.jpg', 200, 150)
+    large_hash, large_pixels = perceptual.image_phash(large)
+    small_hash, small_pixels = perceptual.image_phash(small)
+    assert (large_pixels, small_pixels) == (480000, 30000)
+    assert perceptual.distance(int(large_hash, 16), int(small_hash, 16)) <= perceptual.DEFAULT_DISTANCE
+    assert perceptual.image_phash(str(tmp_path / 'missing.jpg')) == (None, None)
+
+
+def photo(path, pixels):
+    new_photo = photos.Photo(os.path.basename(path), os.path.dirname(path), path)
+    new_photo.set_size(pixels // 10)
+    new_photo.phash = 'ff00ff00ff00ff00'
+    return new_photo
+
+
+# Whichever order they're checked in, the photo with more pixels is the one kept
+@pytest.mark.parametrize('large_first', [True, False])
+def test_larger_photo_kept(tmp_path, large_first):
+    with catalog.Catalog(str(tmp_path)) as library:
+        near_index = perceptual.NearDuplicateIndex(library, replace=True).load()
+        large = photo('/src/large.jpg', 480000)
+        small = photo('/src/small.jpg', 30000)
+        if large_first:
+            similar, kept, replaced = near_index.check(large, 480000)
+            assert similar is None
+            similar, small_kept, replaced = near_index.check(small, 30000)
+            assert similar[1] is kept and small_kept is None
+        else:
+            similar, small_kept, replaced = near_index.check(small, 30000)
+            assert similar is None
+            similar, kept, replaced = near_index.check(large, 480000)
+            assert similar is None and replaced == [small_kept]
+            small_kept.stored('/dst/small.jpg')
+        kept.stored('/dst/large.jpg')
+        # Only the kept photo carries on into the library
+        near_index.reset()
+        assert near_index.check(photo('/src/other.jpg', 30000), 30000)[0] == (0, '/dst/large.jpg')
+
+
+# The smaller image stored first is moved to review once the larger one is stored, the catalog follows the move
+def test_larger_image_stored(tmp_path, fake_exiftool):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    image(source / 'small.jpg', 200, 150)
+    image(source / 'later' / 'large.jpg', 800, 600)
+    # One worker a stage so the smaller image is always stored first
+    process.processing(str(source), str(destination), False, fake_exiftool, near_dup='review',
+                       workers=dict.fromkeys(process.DEFAULT_WORKERS, 1))
+
+    library = [name for name in files(destination) if name not in ['Review', 'Dup', 'Bad']
+               and os.path.isdir(destination / name)]
+    assert len(library) == 1
+    assert files(destination / library[0]) == ['large.jpg']
+    assert files(destination / 'Review') == ['small.jpg']
+    with catalog.Catalog(str(destination)) as stored:
+        paths = sorted(path for path, phash in stored.phashes())
+    assert paths == sorted([str(destination / 'Review' / 'small.jpg'), str(destination / library[0] / 'large.jpg')])
+    # The move was journalled and finished
+    with open(destination / 'journal.log') as fh:
+        records = [json.loads(line) for line in fh]
+    assert [record['op'] for record in records if record['dest'] == os.path.join('Review', 'small.jpg')] == \
+        ['begin', 'moved']
+
+
+def test_log_reports_stored_file(tmp_path, fake_exiftool, caplog):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    image(source / '1' / 'large.jpg', 800, 600)
+    image(source / '2' / 'small.jpg', 200, 150)
+    with caplog.at_level('WARNING', logger='store.process'):
+        process.processing(str(source), str(destination), False, fake_exiftool, near_dup='log',
+                           workers={'copy': 1})
+    warnings = [record.getMessage() for record in caplog.records if 'looks like' in record.getMessage()]
+    assert len(warnings) == 1
+    # The photo it looks like is reported where it was stored, not where it came from
+    assert str(destination) in warnings[0].split(' looks like ')[1]
+    assert not os.path.isdir(destination / 'Review')
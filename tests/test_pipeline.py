@@ -0,0 +1,106 @@
+import os
+import threading
+import pytest
+from store import pipeline, process
+
+
+# Run the pipeline on a thread, so a pipeline that hangs fails the test rather than stopping the run
+def run(stages, items, queue_size=100, timeout=30):
+    result = dict()
+
+    def target():
+        try:
+            result['errors'] = pipeline.Pipeline(stages, queue_size).run(items)
+        except Exception as e:
+            result['exception'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'pipeline hung'
+    return result
+
+
+class Collector:
+    def __init__(self):
+        self.items = []
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            self.items.append(item)
+        return item
+
+
+# Every item makes it through a bounded queue much smaller than the work, through batch and fanout stages
+def test_items_drain_through_small_queues():
+    collected = Collector()
+    stages = [pipeline.Stage('fanout', lambda item: range(item * 10, item * 10 + 10), 2, fanout=True),
+              pipeline.Stage('double', lambda item: item * 2, 3),
+              pipeline.Stage('batch', lambda items: [item + 1 for item in items], 2, batch=7),
+              pipeline.Stage('collect', collected.add, 2)]
+    result = run(stages, range(100), queue_size=1)
+    assert result == {'errors': 0}
+    assert sorted(collected.items) == [item * 2 + 1 for item in range(1000)]
+    assert [stage.items for stage in stages[:2]] == [100, 1000]
+
+
+# A failing item is counted and handed to on_error, the rest carry on
+def test_worker_exception_reported():
+    collected = Collector()
+    dropped = Collector()
+
+    def check(item):
+        if item % 10 == 3:
+            raise ValueError('bad item {}'.format(item))
+        return item
+    stages = [pipeline.Stage('check', check, 3, on_error=dropped.add),
+              pipeline.Stage('collect', collected.add, 1)]
+    result = run(stages, range(50), queue_size=2)
+    assert result == {'errors': 5}
+    assert sorted(dropped.items) == [3, 13, 23, 33, 43]
+    assert len(collected.items) == 45
+
+
+# A failing batch hands every item in it to on_error
+def test_batch_exception_drops_batch():
+    dropped = Collector()
+
+    def fail(items):
+        raise OSError('batch failed')
+    stages = [pipeline.Stage('batch', fail, 1, batch=4, on_error=dropped.add)]
+    # Ten items in batches of at most four
+    assert run(stages, range(10))['errors'] >= 3
+    assert sorted(dropped.items) == list(range(10))
+
+
+# When the source of items fails the workers are still shut down and the error comes back to the caller
+def test_source_failure_shuts_down():
+    collected = Collector()
+
+    def items():
+        yield from range(20)
+        raise OSError('source gone')
+    before = threading.active_count()
+    result = run([pipeline.Stage('collect', collected.add, 4)], items(), queue_size=1)
+    assert isinstance(result['exception'], OSError)
+    assert sorted(collected.items) == list(range(20))
+    assert threading.active_count() == before
+
+
+# Identical files handled by different hash and copy workers end up as one library copy and the rest duplicates
+def test_identical_files_stored_once(tmp_path, fake_exiftool):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    data = os.urandom(200000)
+    for number in range(40):
+        directory = source / 'dir{}'.format(number % 8)
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / 'photo{}.jpg'.format(number)).write_bytes(data)
+    process.processing(str(source), str(destination), False, fake_exiftool,
+                       workers={'scan': 4, 'stat': 4, 'hash': 8, 'copy': 4}, queue_size=2)
+    stored = [os.path.join(root, name) for root, dirs, names in os.walk(destination) for name in names
+              if name.endswith('.jpg')]
+    library = [file for file in stored if os.path.basename(os.path.dirname(file)) != 'Dup']
+    assert len(library) == 1
+    assert len(stored) - len(library) == 39
@@ -0,0 +1,75 @@
+import os
+import pytest
+from store import catalog, plan, process
+
+
+def make_plan(tmp_path, fake_exiftool, dup_mode='link'):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    (source / 'b').mkdir(parents=True)
+    destination.mkdir()
+    (source / 'x.jpg').write_bytes(b'same photo')
+    (source / 'b' / 'y.jpg').write_bytes(b'same photo')
+    (source / 'z.jpg').write_bytes(b'other photo')
+    plan_file = str(tmp_path / 'plan.jsonl')
+    process.processing(str(source), str(destination), False, fake_exiftool, plan_file=plan_file, dup_mode=dup_mode,
+                       workers={'hash': 1, 'copy': 1})
+    return source, destination, plan_file
+
+
+def stored(destination):
+    return sorted(os.path.relpath(os.path.join(root, name), destination)
+                  for root, dirs, names in os.walk(destination) for name in names if name.endswith('.jpg'))
+
+
+def duplicates(destination):
+    with catalog.Catalog(str(destination)) as library:
+        return library.query('SELECT source, original, path, status FROM duplicates')
+
+
+# A duplicate of a file that is new in the same plan is stored according to the dup mode
+@pytest.mark.parametrize('plan_mode', ['link', 'catalog'])
+@pytest.mark.parametrize('dup_mode', ['link', 'copy', 'catalog'])
+def test_execute_dup_modes(tmp_path, fake_exiftool, plan_mode, dup_mode):
+    source, destination, plan_file = make_plan(tmp_path, fake_exiftool, plan_mode)
+    assert stored(destination) == []
+    plan.execute(plan_file, str(destination), dup_mode=dup_mode)
+
+    files = stored(destination)
+    library = [file for file in files if not file.startswith('Dup')]
+    assert len(library) == 2
+    rows = duplicates(destination)
+    assert len(rows) == 1
+    source_file, original, path, status = rows[0]
+    assert status == 'dup' and original in library
+    duplicate = os.path.basename(source_file)
+    # The first copy found goes in the library, the other is the duplicate
+    assert os.path.basename(original) != duplicate
+    if dup_mode == 'catalog' or plan_mode == 'catalog':
+        assert path is None and not any(file.startswith('Dup') for file in files)
+    else:
+        assert path == os.path.join('Dup', duplicate)
+        linked = os.stat(destination / path).st_ino == os.stat(destination / original).st_ino
+        assert linked == (dup_mode == 'link')
+
+
+# Resuming finds the recorded duplicate in the journal and doesn't record it again
+def test_execute_resume(tmp_path, fake_exiftool):
+    source, destination, plan_file = make_plan(tmp_path, fake_exiftool, 'catalog')
+    plan.execute(plan_file, str(destination), dup_mode='catalog')
+    with open(destination / 'journal.log') as fh:
+        journal = fh.read()
+    assert journal.count('"op": "done"') == 3
+    plan.execute(plan_file, str(destination), resume=True, dup_mode='catalog')
+    with open(destination / 'journal.log') as fh:
+        assert fh.read() == journal
+    assert len(stored(destination)) == 2
+
+
+# A file changed since the plan was made is skipped
+def test_execute_skips_changed(tmp_path, fake_exiftool):
+    source, destination, plan_file = make_plan(tmp_path, fake_exiftool)
+    (source / 'z.jpg').write_bytes(b'changed since')
+    plan.execute(plan_file, str(destination))
+    assert not any(os.path.basename(file) == 'z.jpg' for file in stored(destination))
+    assert len(stored(destination)) == 2
@@ -0,0 +1,76 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from conftest import ROOT
+from store import catalog, process
+
+# Store run that commits its decisions two at a time, so a run that is killed leaves both finished and unfinished
+# copies behind
+RUN = '''
+import sys
+from store import journal, process
+journal.FLUSH_SIZE = 2
+process.processing(sys.argv[1], sys.argv[2], False, sys.argv[3], batch_size=1, workers={'metadata': 1, 'copy': 1})
+'''
+
+
+def library_files(destination):
+    return sorted(os.path.relpath(os.path.join(root, name), destination)
+                  for root, dirs, names in os.walk(destination) for name in names
+                  if not name.startswith(('catalog', 'journal', 'hash')))
+
+
+def journal_records(destination):
+    with open(os.path.join(destination, 'journal.log')) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+# A run killed part way through is rolled back and resumed: partial copies are removed, finished files are left
+# alone and nothing is stored twice
+def test_killed_run_resumed(tmp_path, fake_exiftool):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    source.mkdir()
+    destination.mkdir()
+    for number in range(10):
+        (source / 'photo{}.jpg'.format(number)).write_bytes(os.urandom(1000 + number))
+
+    # Slow exiftool down so the run can be killed once some files are stored
+    env = dict(os.environ, FAKE_EXIFTOOL_FILE_LATENCY='0.3')
+    run = subprocess.Popen([sys.executable, '-c', RUN, str(source), str(destination), fake_exiftool],
+                           cwd=os.path.join(ROOT, 'photostore'), env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            if os.path.exists(destination / 'journal.log') and \
+                    sum(record['op'] == 'done' for record in journal_records(destination)) >= 2 and \
+                    sum(record['op'] == 'begin' for record in journal_records(destination)) >= 5:
+                break
+            time.sleep(0.05)
+    finally:
+        run.send_signal(signal.SIGKILL)
+        run.wait()
+
+    records = journal_records(destination)
+    finished = {record['dest'] for record in records if record['op'] == 'done'}
+    unfinished = {record['dest'] for record in records if record['op'] == 'begin'} - finished
+    assert finished and unfinished
+    inodes = {dest: os.stat(destination / dest).st_ino for dest in finished}
+    # A copy that was part written when the run died
+    partial = sorted(unfinished)[0]
+    directory, name = os.path.split(partial)
+    (destination / directory / '.{}.1a2b3c4d.tmp'.format(name)).write_bytes(b'part')
+
+    process.processing(str(source), str(destination), False, fake_exiftool, resume=True)
+
+    stored = library_files(destination)
+    assert sorted(os.path.basename(file) for file in stored) == ['photo{}.jpg'.format(number) for number in range(10)]
+    # The finished files weren't copied again
+    assert {dest: os.stat(destination / dest).st_ino for dest in finished} == inodes
+    with catalog.Catalog(str(destination)) as library:
+        rows = library.query('SELECT path FROM files')
+    assert sorted(path for path, in rows) == stored
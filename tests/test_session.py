@@ -0,0 +1,75 @@
+import os
+import pytest
+from store import photos
+
+
+# Create some small files to ask exiftool about
+@pytest.fixture
+def files(tmp_path):
+    names = []
+    for index in range(7):
+        name = tmp_path / 'photo{}.jpg'.format(index)
+        name.write_bytes(os.urandom(100))
+        names.append(str(name))
+    return names
+
+
+# Record the size of each batch sent to exiftool
+def count_batches(session, monkeypatch):
+    batches = []
+    execute = session.execute
+
+    def counting(files):
+        batches.append(len(files))
+        return execute(files)
+    monkeypatch.setattr(session, 'execute', counting)
+    return batches
+
+
+def test_batches(fake_exiftool, files, monkeypatch):
+    with photos.MetadataSession(fake_exiftool, batch_size=3) as session:
+        batches = count_batches(session, monkeypatch)
+        metadata = session.get_metadata(files)
+    assert batches == [3, 3, 1]
+    assert [data['SourceFile'] for data in metadata] == files
+    assert all('File:FileModifyDate' in data for data in metadata)
+    assert session.restarts == 0
+
+
+def test_unreadable_file(fake_exiftool, files):
+    missing = files[0] + '.missing'
+    with photos.MetadataSession(fake_exiftool, batch_size=10) as session:
+        metadata = session.get_metadata([missing] + files)
+    assert metadata[0] is None
+    assert [data['SourceFile'] for data in metadata[1:]] == files
+
+
+def test_crash_restarts_and_bisects(fake_exiftool, files, tmp_path, monkeypatch):
+    bad = str(tmp_path / 'explode.jpg')
+    with open(bad, 'wb') as fh:
+        fh.write(os.urandom(100))
+    monkeypatch.setenv('FAKE_EXIFTOOL_CRASH', 'explode')
+    batch = files[:3] + [bad] + files[3:]
+    with photos.MetadataSession(fake_exiftool, batch_size=8, timeout=10) as session:
+        batches = count_batches(session, monkeypatch)
+        metadata = session.get_metadata(batch)
+        # The session carries on working once the file crashing it has been found
+        after = session.get_metadata(files[:2])
+    assert metadata[3] is None
+    assert [data['SourceFile'] for data in metadata if data is not None] == files
+    assert [data['SourceFile'] for data in after] == files[:2]
+    # The whole batch is retried once, then split in half until the bad file is on its own
+    assert batches[:2] == [8, 8]
+    assert 1 in batches
+    assert session.restarts >= 2
+
+
+def test_restart(fake_exiftool, files):
+    with photos.MetadataSession(fake_exiftool) as session:
+        first = session.helper
+        session.restart()
+        assert session.helper is not first
+        assert session.helper.running
+        metadata = session.get_metadata(files)
+    assert session.restarts == 1
+    assert [data['SourceFile'] for data in metadata] == files
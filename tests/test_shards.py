@@ -0,0 +1,81 @@
+import os
+import pytest
+from store import index, process, shards
+
+
+def tree(source):
+    for path in ['top.jpg', 'notes.txt', '2019/loose.jpg', '2019/01/a.jpg', '2019/01/deep/b.jpg', '2019/02/c.jpg',
+                 '2020/03/d.jpg', '2020/04/e.jpg', '2021/f.jpg']:
+        (source / path).parent.mkdir(parents=True, exist_ok=True)
+        (source / path).write_bytes(b'x')
+    return source
+
+
+# The files a shard stores, walking the subtrees as the scan stage would
+def shard_files(source, shard, count):
+    found = []
+    for entry in shards.shard_entries(str(source), ['.txt'], shard, count):
+        if entry.is_dir():
+            found.extend(os.path.relpath(os.path.join(root, name), source)
+                         for root, dirs, names in os.walk(entry.path) for name in names)
+        else:
+            found.append(os.path.relpath(entry.path, source))
+    return found
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7])
+def test_every_file_in_one_shard(tmp_path, count):
+    source = tree(tmp_path)
+    found = []
+    for shard in range(count):
+        found.extend(shard_files(source, shard, count))
+    assert sorted(found) == ['2019/01/a.jpg', '2019/01/deep/b.jpg', '2019/02/c.jpg', '2019/loose.jpg',
+                             '2020/03/d.jpg', '2020/04/e.jpg', '2021/f.jpg', 'top.jpg']
+
+
+# A worker only reads the top levels of the source and the subtrees in its own shard
+def test_other_subtrees_not_read(tmp_path, monkeypatch):
+    source = tree(tmp_path)
+    read = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: read.append(os.path.relpath(path, source)) or scandir(path))
+    subtree = os.path.join('2019', '01')
+    shard = shards.shard_of(subtree, 3)
+    entries = list(shards.shard_entries(str(source), [], shard, 3))
+    assert subtree in [os.path.relpath(entry.path, source) for entry in entries]
+    assert sorted(read) == ['.', '2019', '2020', '2021']
+
+
+def test_filesystem_type(tmp_path):
+    assert shards.filesystem_type(str(tmp_path)) not in shards.NETWORK_FILESYSTEMS
+
+
+# Workers on another host sharing the destination are noticed, ones that have stopped aren't
+def test_other_hosts(tmp_path):
+    with shards.Coordinator(str(tmp_path), str(tmp_path / 'src'), 2) as coordinator:
+        workers = os.path.dirname(coordinator.worker_file)
+        assert coordinator.other_hosts() == set()
+        shards.create(os.path.join(workers, '{}-1-abcdef'.format(coordinator.host)), 'same host')
+        shards.create(os.path.join(workers, 'other-host-2-abcdef'), 'other host')
+        shards.create(os.path.join(workers, 'stopped-3-abcdef'), 'stopped')
+        stale = os.path.getmtime(coordinator.worker_file) - shards.LEASE_SECONDS * 2
+        os.utime(os.path.join(workers, 'stopped-3-abcdef'), (stale, stale))
+        assert coordinator.other_hosts() == {'other-host'}
+
+
+# One worker stores every shard, loading the library once rather than for each shard
+def test_worker_stores_every_shard(tmp_path, fake_exiftool, monkeypatch):
+    source = tree(tmp_path / 'src')
+    for number, path in enumerate(sorted(source.rglob('*.jpg'))):
+        path.write_bytes(b'photo %d' % number)
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    loads = []
+    load = index.HashIndex.load
+    monkeypatch.setattr(index.HashIndex, 'load', lambda self: loads.append(self) or load(self))
+    with shards.Coordinator(str(destination), str(source), 3) as coordinator:
+        process.processing(str(source), str(destination), False, fake_exiftool, coordinator=coordinator)
+        assert all(os.path.exists(coordinator.done_file(shard)) for shard in range(3))
+    assert len(loads) == 1
+    stored = [name for root, dirs, names in os.walk(destination) for name in names if name.endswith('.jpg')]
+    assert sorted(stored) == ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg', 'f.jpg', 'loose.jpg', 'top.jpg']
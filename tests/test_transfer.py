@@ -0,0 +1,62 @@
+import errno
+import os
+import pytest
+from store import catalog, process, transfer
+
+
+def store(tmp_path, fake_exiftool, dup_mode):
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    (source / 'b').mkdir(parents=True)
+    destination.mkdir()
+    (source / 'x.jpg').write_bytes(b'same photo')
+    (source / 'b' / 'y.jpg').write_bytes(b'same photo')
+    process.processing(str(source), str(destination), False, fake_exiftool, dup_mode=dup_mode,
+                       workers={'hash': 1, 'copy': 1})
+    with catalog.Catalog(str(destination)) as library:
+        rows = library.query('SELECT source, original, path, status FROM duplicates')
+    assert len(rows) == 1
+    source_file, original, path, status = rows[0]
+    assert status == 'dup' and path == os.path.join('Dup', os.path.basename(source_file))
+    assert (destination / path).read_bytes() == (destination / original).read_bytes() == b'same photo'
+    return os.stat(destination / path), os.stat(destination / original)
+
+
+# Linked duplicates share the library copy, copied ones take up space of their own
+@pytest.mark.parametrize('dup_mode', ['link', 'copy'])
+def test_dup_modes(tmp_path, fake_exiftool, dup_mode):
+    duplicate, original = store(tmp_path, fake_exiftool, dup_mode)
+    assert (duplicate.st_ino == original.st_ino) == (dup_mode == 'link')
+    assert duplicate.st_nlink == original.st_nlink == (2 if dup_mode == 'link' else 1)
+
+
+# Stand in for os.link on a destination that can't hold links
+def link_error(error):
+    def no_link(source, destination):
+        raise OSError(error, os.strerror(error))
+    return no_link
+
+
+# A destination that can't hold links, or another filesystem, gets a copy of the duplicate instead
+@pytest.mark.parametrize('error', [errno.EXDEV, errno.EPERM])
+def test_link_falls_back_to_copy(tmp_path, fake_exiftool, monkeypatch, error):
+    monkeypatch.setattr(os, 'link', link_error(error))
+    duplicate, original = store(tmp_path, fake_exiftool, 'link')
+    assert duplicate.st_ino != original.st_ino
+    assert duplicate.st_nlink == original.st_nlink == 1
+
+
+# Either way the reserved name is replaced and no temporary file is left behind
+def test_link_file_replaces_reserved(tmp_path, monkeypatch):
+    source = tmp_path / 'a.jpg'
+    source.write_bytes(b'photo')
+    linked = tmp_path / 'linked.jpg'
+    copied = tmp_path / 'copied.jpg'
+    # Names are reserved with an empty file
+    linked.touch()
+    copied.touch()
+    assert transfer.link_file(str(source), str(linked)) == 'link'
+    monkeypatch.setattr(os, 'link', link_error(errno.EXDEV))
+    assert transfer.link_file(str(source), str(copied)) == 'copy'
+    assert linked.read_bytes() == copied.read_bytes() == b'photo'
+    assert sorted(os.listdir(tmp_path)) == ['a.jpg', 'copied.jpg', 'linked.jpg']
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import time
+from store import catalog, verify
+
+
+# Store some files in a library and record them in its catalog
+def make_library(destination, count=3, size=1024):
+    library = catalog.Catalog(str(destination))
+    files = []
+    for number in range(count):
+        file = destination / '2020_01' / 'photo{}.jpg'.format(number)
+        file.parent.mkdir(exist_ok=True)
+        data = os.urandom(size)
+        file.write_bytes(data)
+        stat = os.stat(file)
+        library.put_file(str(file), stat.st_size, stat.st_mtime_ns, hashlib.sha256(data).hexdigest())
+        files.append(file)
+    library.close()
+    return files
+
+
+def test_problems_found(tmp_path):
+    files = make_library(tmp_path)
+    data = bytearray(files[0].read_bytes())
+    data[10] ^= 1
+    files[0].write_bytes(bytes(data))
+    files[1].unlink()
+    (tmp_path / '2020_01' / 'extra.jpg').write_bytes(b'extra')
+    assert verify.verify(str(tmp_path)) == 3
+    assert verify.verify(str(tmp_path), rate=100) == 3
+
+
+def test_rate_limited_while_reading(tmp_path):
+    files = make_library(tmp_path, 1, 4 * verify.CHUNK_SIZE)
+    limiter = verify.RateLimiter(2 * verify.CHUNK_SIZE)
+    reads = []
+    wait = limiter.wait
+
+    def timed_wait(size):
+        reads.append(time.monotonic())
+        wait(size)
+    limiter.wait = timed_wait
+    file, photo_hash, error, seconds = verify.limited_hash(str(files[0]), limiter)
+    assert photo_hash == hashlib.sha256(files[0].read_bytes()).hexdigest()
+    assert error is None
+    # Four chunks at two a second, spread out rather than read in one go and then slept off
+    assert len(reads) == 4
+    assert 1.4 < seconds < 3
+    assert reads[3] - reads[0] > 1.0
+
+
+def test_missing_file(tmp_path):
+    file, photo_hash, error, seconds = verify.limited_hash(str(tmp_path / 'gone.jpg'), verify.RateLimiter(1024))
+    assert photo_hash is None
+    assert error is not None
@@ -0,0 +1,126 @@
+import os
+import signal
+import threading
+import time
+import pytest
+from store import catalog, index, process, watch
+
+
+# Run a watcher in the background, collecting the files it hands out
+class Collector:
+    def __init__(self, watcher):
+        self.watcher = watcher
+        self.files = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for batch in self.watcher.batches(10):
+            self.files.extend(entry.path for entry in batch)
+
+    # Wait for the number of files handed out to reach count
+    def wait(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while len(self.files) < count and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return sorted(self.files)
+
+    def stop(self):
+        self.watcher.stop()
+        self.thread.join()
+        self.watcher.close()
+
+
+def write(path, data=b'photo'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.fixture(params=['inotify', 'poll'])
+def watcher(request, tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    return watch.Watcher(str(source), ['.txt'], settle=0.2, poll=0.1 if request.param == 'poll' else None)
+
+
+def test_files_handed_out_once(watcher, tmp_path):
+    first = write(tmp_path / 'src' / 'old.jpg')
+    collector = Collector(watcher)
+    try:
+        assert collector.wait(1) == [first]
+        second = write(tmp_path / 'src' / 'a' / 'b' / 'new.jpg')
+        write(tmp_path / 'src' / 'notes.txt')
+        assert collector.wait(2) == sorted([first, second])
+        # Several more scans or reads go by without handing them out again
+        time.sleep(1)
+        assert collector.wait(3, timeout=0) == sorted([first, second])
+        # A file that changes is handed out again
+        write(tmp_path / 'src' / 'old.jpg', b'changed')
+        assert collector.wait(3) == sorted([first, first, second])
+    finally:
+        collector.stop()
+
+
+def test_seen_is_pruned(watcher, tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, 'MARGIN_NS', 0)
+    collector = Collector(watcher)
+    try:
+        files = [write(tmp_path / 'src' / 'photo{}.jpg'.format(number)) for number in range(5)]
+        assert collector.wait(5) == sorted(files)
+        os.remove(files[0])
+        time.sleep(1)
+        # Only files changed since the last scan or read are remembered, and nothing is handed out again
+        assert watcher.seen == dict()
+        assert watcher.pending == dict()
+        assert collector.wait(6, timeout=0) == sorted(files)
+    finally:
+        collector.stop()
+
+
+def test_directory_moved_in(watcher, tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, 'MARGIN_NS', 0)
+    write(tmp_path / 'elsewhere' / 'a' / 'photo.jpg')
+    collector = Collector(watcher)
+    try:
+        # The files keep their old times when the directory is moved into the source
+        time.sleep(1)
+        os.rename(tmp_path / 'elsewhere', tmp_path / 'src' / 'elsewhere')
+        assert collector.wait(1) == [str(tmp_path / 'src' / 'elsewhere' / 'a' / 'photo.jpg')]
+    finally:
+        collector.stop()
+
+
+# A watch keeps the journal, and the files stored since the hash snapshot was made, down to the last batch
+def test_watch_commits_each_batch(tmp_path, fake_exiftool, monkeypatch):
+    monkeypatch.setattr(process, 'WATCH_SAVE_FILES', 1)
+    source = tmp_path / 'src'
+    destination = tmp_path / 'dst'
+    destination.mkdir()
+    journal_sizes = []
+    saves = []
+    save = index.HashIndex.save
+
+    def counting_save(self):
+        saves.append(len(self.hashes))
+        return save(self)
+    monkeypatch.setattr(index.HashIndex, 'save', counting_save)
+
+    # Drop files into the source in two goes, then stop the watch the way Ctrl-C would
+    def drop_files():
+        for number in range(2):
+            for name in range(3):
+                write(source / 'drop{}'.format(number) / 'photo{}.jpg'.format(name), os.urandom(100 + name))
+            time.sleep(2)
+            journal_sizes.append(os.path.getsize(destination / 'journal.log'))
+        os.kill(os.getpid(), signal.SIGINT)
+    source.mkdir()
+    thread = threading.Thread(target=drop_files)
+    thread.start()
+    process.processing(str(source), str(destination), False, fake_exiftool, watch_source=True, settle=0.2, poll=0.1)
+    thread.join()
+
+    assert journal_sizes == [0, 0]
+    assert saves[:2] == [3, 3]
+    with catalog.Catalog(str(destination)) as library:
+        assert len(list(library.hashes())) == 6
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+tools_path = os.path.dirname(os.path.abspath(__file__))
+photostore_path = os.path.join(tools_path, '..', 'photostore')
+fake_exiftool = os.path.join(tools_path, 'fake_exiftool.py')
+stage_line = re.compile(r'(\w+) stage: (\d+) items, ([\d.]+)s busy, (\d+) workers')
+
+
+# Build the start of a JPEG with an EXIF block holding just DateTimeOriginal, enough for the built in date reader
+def jpeg_header(date):
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    # IFD0 pointing to the Exif IFD at 26, which holds the 20 byte date string at 44
+    tiff += struct.pack('<HHHII', 1, 0x8769, 4, 1, 26) + struct.pack('<I', 0)
+    tiff += struct.pack('<HHHII', 1, 0x9003, 2, 20, 44) + struct.pack('<I', 0)
+    tiff += date.strftime('%Y:%m:%d %H:%M:%S').encode() + b'\x00'
+    app1 = b'Exif\x00\x00' + tiff
+    return b'\xff\xd8\xff\xe1' + struct.pack('>H', len(app1) + 2) + app1 + b'\xff\xda'
+
+
+# Write a tree of files, count files spread over nested directories. A dup_ratio share of them are copies of files
+# written earlier (from this tree or the existing pool), an exif_ratio share have an EXIF date the built in reader
+# can get and the rest are left to exiftool. Returns the files written and their total size
+def make_tree(root, count, args, rng, pool):
+    files = []
+    total = 0
+    for number in range(count):
+        # Nest the files depth levels down, fanout directories wide at each level
+        parts = ['dir{}'.format(rng.randrange(args.fanout)) for _ in range(args.depth)]
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        file = os.path.join(directory, 'IMG_{:06d}.JPG'.format(number))
+        if pool and rng.random() < args.dup_ratio:
+            shutil.copyfile(rng.choice(pool), file)
+        else:
+            date = datetime.datetime(2015, 1, 1) + datetime.timedelta(seconds=rng.randrange(10 * 365 * 86400))
+            size = max(1024, int(rng.lognormvariate(0, args.size_sigma) * args.size_kb * 1024))
+            header = jpeg_header(date) if rng.random() < args.exif_ratio else b''
+            with open(file, 'wb') as fh:
+                fh.write(header)
+                fh.write(rng.randbytes(size - len(header)))
+                fh.write(b'\xff\xd9')
+            os.utime(file, (date.timestamp(), date.timestamp()))
+        files.append(file)
+        pool.append(file)
+        total += os.path.getsize(file)
+    return files, total
+
+
+# Total size of the files below a directory
+def tree_size(root):
+    count = 0
+    total = 0
+    for path, dirs, names in os.walk(root):
+        for name in names:
+            count += 1
+            total += os.path.getsize(os.path.join(path, name))
+    return count, total
+
+
+# Run a ps.py subcommand, returning wall time, peak RSS and the stage times from its log
+def run(command, env, log_file):
+    with open(log_file, 'w') as log:
+        start = time.monotonic()
+        process = subprocess.Popen([sys.executable, 'ps.py'] + command, cwd=photostore_path, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # wait4 gives the resource use of this child (and the processes it waited for) rather than every child
+        pid, status, usage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    stages = dict()
+    with open(log_file) as log:
+        for line in log:
+            match = stage_line.search(line)
+            if match:
+                stages[match.group(1)] = {'items': int(match.group(2)), 'busy_seconds': float(match.group(3)),
+                                          'workers': int(match.group(4))}
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'returncode': process.returncode, 'seconds': round(seconds, 3), 'peak_rss_mb': round(peak_rss / 2 ** 20, 1),
+            'stages': stages}
+
+
+# Add the rates for a run over count files of size bytes
+def rates(result, count, size):
+    result['files'] = count
+    result['mb'] = round(size / 2 ** 20, 1)
+    result['files_per_second'] = round(count / result['seconds'], 1) if result['seconds'] else None
+    result['mb_per_second'] = round(size / 2 ** 20 / result['seconds'], 1) if result['seconds'] else None
+    return result
+
+
+# Current commit of the repository, to label the results
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=tools_path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark store, file and directory on a synthetic photo tree')
+    parser.add_argument('-n', '--files', type=int, default=1000, help='Number of source files')
+    parser.add_argument('--library', type=int, default=0, help='Number of files already in the destination')
+    parser.add_argument('--size-kb', type=float, default=512, help='Median file size in KB')
+    parser.add_argument('--size-sigma', type=float, default=0.5, help='Spread of the log-normal file sizes')
+    parser.add_argument('--dup-ratio', type=float, default=0.1, help='Share of files that are duplicates')
+    parser.add_argument('--exif-ratio', type=float, default=0.5,
+                        help='Share of files with an EXIF date that can be read without exiftool')
+    parser.add_argument('--depth', type=int, default=2, help='Directory levels below the source')
+    parser.add_argument('--fanout', type=int, default=4, help='Directories at each level')
+    parser.add_argument('--latency', type=float, default=0.0, help='Stub exiftool delay for each request (seconds)')
+    parser.add_argument('--file-latency', type=float, default=0.001,
+                        help='Stub exiftool delay for each file (seconds)')
+    parser.add_argument('--commands', default='store,file,directory', help='Subcommands to run, in order')
+    parser.add_argument('--store-args', default='', help='Extra arguments for store, e.g. "--jobs 4"')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the tree')
+    parser.add_argument('--workdir', help='Directory for the trees (a temporary directory by default)')
+    parser.add_argument('--keep', action='store_true', help='Keep the trees and logs afterwards')
+    parser.add_argument('-o', '--output', help='Write the results to this JSON file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='photostore-bench-'))
+    source = os.path.join(workdir, 'source')
+    library = os.path.join(workdir, 'library')
+    destination = os.path.join(workdir, 'destination')
+    os.makedirs(destination, exist_ok=True)
+
+    env = dict(os.environ, FAKE_EXIFTOOL_LATENCY=str(args.latency), FAKE_EXIFTOOL_FILE_LATENCY=str(args.file_latency),
+               PHOTOSTORE_ZIP_PASSWORD='benchmark')
+    env.pop('FAKE_EXIFTOOL_DATE', None)
+    results = {'commit': commit(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'parameters': vars(args), 'results': dict()}
+
+    try:
+        # Fill the destination with the library first, this isn't timed
+        pool = []
+        if args.library:
+            make_tree(library, args.library, args, rng, pool)
+            setup = run(['store', '-s', library, '-d', destination, '-e', fake_exiftool],
+                        env, os.path.join(workdir, 'library.log'))
+            if setup['returncode']:
+                sys.exit('Loading the library failed, see {}'.format(os.path.join(workdir, 'library.log')))
+        start = time.monotonic()
+        files, size = make_tree(source, args.files, args, rng, pool)
+        print('Generated {} files, {:.1f} MB in {:.1f}s'.format(len(files), size / 2 ** 20, time.monotonic() - start))
+
+        for command in args.commands.split(','):
+            log_file = os.path.join(workdir, '{}.log'.format(command))
+            if command == 'store':
+                result = rates(run(['store', '-s', source, '-d', destination, '-e', fake_exiftool] +
+                                   args.store_args.split(), env, log_file), len(files), size)
+            elif command == 'file':
+                count, total = tree_size(destination)
+                result = rates(run(['file', '-d', destination, '-f'], env, log_file), count, total)
+            elif command == 'directory':
+                count, total = tree_size(destination)
+                result = rates(run(['directory', '-d', destination, '-c'], env, log_file), count, total)
+            else:
+                sys.exit('Unknown command {}'.format(command))
+            results['results'][command] = result
+            print('{}: {} files/s, {} MB/s, {}s, peak RSS {} MB{}'.format(
+                command, result['files_per_second'], result['mb_per_second'], result['seconds'],
+                result['peak_rss_mb'], '' if result['returncode'] == 0 else ' (exit {})'.format(result['returncode'])))
+            for stage, times in result['stages'].items():
+                print('    {}: {} items, {}s busy'.format(stage, times['items'], times['busy_seconds']))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
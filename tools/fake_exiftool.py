@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import datetime
+import json
+import os
+import sys
+import time
+
+
+# Stand-in for exiftool that speaks just enough of the -stay_open protocol for pyexiftool. Dates are taken from
+# the file modification time unless overridden with the environment variables below:
+#   FAKE_EXIFTOOL_DATE          canned EXIF:DateTimeOriginal (or QuickTime:CreateDate for .mov), e.g. 2020:01:31
+#   FAKE_EXIFTOOL_LATENCY       seconds to sleep for every -execute
+#   FAKE_EXIFTOOL_FILE_LATENCY  seconds to sleep for every file in an -execute
+#   FAKE_EXIFTOOL_CRASH         exit abruptly when a file name contains this text
+#   FAKE_EXIFTOOL_VERSION       value returned for -ver
+options_with_value = ['-echo1', '-echo2', '-echo3', '-echo4', '-charset', '-api', '-stay_open', '-@', '-common_args']
+
+
+# Format a timestamp the way exiftool does
+def format_date(timestamp):
+    date = datetime.datetime.fromtimestamp(timestamp).astimezone()
+    offset = date.strftime('%z')
+    return date.strftime('%Y:%m:%d %H:%M:%S') + offset[:3] + ':' + offset[3:]
+
+
+# Build the tags for a single file
+def file_tags(file, tags):
+    metadata = {'SourceFile': file,
+                'File:FileName': os.path.basename(file),
+                'File:FileModifyDate': format_date(os.stat(file).st_mtime)}
+    canned_date = os.environ.get('FAKE_EXIFTOOL_DATE')
+    if canned_date:
+        if os.path.splitext(file)[1].lower() == '.mov':
+            metadata['QuickTime:CreateDate'] = canned_date[0:10] + ' 12:00:00'
+        else:
+            metadata['EXIF:DateTimeOriginal'] = canned_date[0:10] + ' 12:00:00'
+    if tags:
+        metadata = {tag: value for tag, value in metadata.items() if tag == 'SourceFile' or tag in tags or
+                    tag.split(':')[-1] in tags}
+    return metadata
+
+
+# Run one command and return stdout, stderr and exit status
+def run_command(args):
+    files = []
+    tags = []
+    echo = []
+    version = False
+    stdout = ''
+    stderr = ''
+    status = 0
+
+    # Split the arguments into options, tags and files
+    index = 0
+    while index < len(args):
+        arg = args[index]
+        if arg in options_with_value:
+            if arg == '-echo4' and index + 1 < len(args):
+                echo.append(args[index + 1])
+            index += 2
+            continue
+        if arg == '-ver':
+            version = True
+        elif arg.startswith('-'):
+            if arg[1:] not in ['j', 'G', 'n', 'json', 'fast', 'fast2']:
+                tags.append(arg[1:])
+        else:
+            files.append(arg)
+        index += 1
+
+    if version:
+        stdout = os.environ.get('FAKE_EXIFTOOL_VERSION', '12.60') + '\n'
+
+    crash = os.environ.get('FAKE_EXIFTOOL_CRASH')
+    file_latency = float(os.environ.get('FAKE_EXIFTOOL_FILE_LATENCY', 0))
+    output = []
+    for file in files:
+        if crash and crash in file:
+            os._exit(1)
+        if file_latency:
+            time.sleep(file_latency)
+        if not os.path.isfile(file):
+            stderr += 'Error: File not found - {}\n'.format(file)
+            status = 1
+            continue
+        output.append(file_tags(file, tags))
+    if output:
+        stdout += json.dumps(output, indent=4) + '\n'
+
+    for text in echo:
+        stderr += text.replace('${status}', str(status)) + '\n'
+    return stdout, stderr, status
+
+
+# Entrypoint
+def main():
+    latency = float(os.environ.get('FAKE_EXIFTOOL_LATENCY', 0))
+    args = sys.argv[1:]
+
+    # One shot mode, e.g. exiftool -ver
+    if '-stay_open' not in args:
+        stdout, stderr, status = run_command(args)
+        sys.stdout.write(stdout)
+        sys.stderr.write(stderr)
+        return status
+
+    common_args = args[args.index('-common_args') + 1:] if '-common_args' in args else []
+    command = []
+    for line in sys.stdin:
+        line = line.rstrip('\n')
+        if line.startswith('-execute'):
+            if latency:
+                time.sleep(latency)
+            stdout, stderr, status = run_command(command + common_args)
+            sequence = line[len('-execute'):]
+            sys.stdout.write(stdout + '{ready' + sequence + '}\n')
+            sys.stdout.flush()
+            sys.stderr.write(stderr)
+            sys.stderr.flush()
+            command = []
+        elif command[-1:] == ['-stay_open'] and line.lower() == 'false':
+            return 0
+        else:
+            command.append(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
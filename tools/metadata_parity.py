@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'photostore'))
+from store import metadata, photos
+
+
+# Work out the directory date and tag used for a file from a set of metadata
+def resolve(file, photo_data):
+    photo = photos.Photo(os.path.basename(file), os.path.dirname(file), file)
+    photo.extract_date(photo_data)
+    photo.find_date()
+    return photo.directory_date, photo.exif_tag
+
+
+# Compare the dates read directly from sample files with the ones from exiftool, both must resolve to the same
+# directory date. Exits with a non-zero status if any file differs
+def main():
+    parser = argparse.ArgumentParser(description='Check the built in date reader against exiftool')
+    parser.add_argument('-e', '--exiftool', required=True, type=str, help='Location of exiftool executable')
+    parser.add_argument('samples', nargs='+', help='Sample files or directories')
+    args = parser.parse_args()
+
+    files = []
+    for sample in args.samples:
+        if os.path.isdir(sample):
+            for root, dirs, names in os.walk(sample):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(sample)
+
+    checked = unsupported = mismatched = 0
+    with photos.MetadataSession(args.exiftool) as session:
+        for file, exif_data in zip(files, session.get_metadata(files)):
+            native_data = metadata.read_dates(file)
+            if native_data is None or exif_data is None:
+                unsupported += 1
+                continue
+            checked += 1
+            native_result = resolve(file, native_data)
+            exif_result = resolve(file, exif_data)
+            if native_result != exif_result:
+                mismatched += 1
+                print('{}: native {} exiftool {}'.format(file, native_result, exif_result))
+                for tag in photos.DATE_TAGS:
+                    print('    {}: {} / {}'.format(tag, native_data.get(tag), exif_data.get(tag)))
+
+    print('{} files checked, {} mismatched, {} left to exiftool'.format(checked, mismatched, unsupported))
+    return 1 if mismatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())